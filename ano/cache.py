@@ -0,0 +1,233 @@
+# -*- coding: utf-8; -*-
+
+import os
+import errno
+import hashlib
+import json
+import shlex
+import shutil
+import subprocess
+import tempfile
+
+from contextlib import contextmanager
+
+from ano.utils import makedirs
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: cache is still usable, stats could lose updates
+    fcntl = None
+
+
+def tool_identity(tool):
+    """
+    Return a string that changes whenever `tool` binary is replaced.
+    """
+    path = os.path.realpath(tool)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path
+    return '%s:%d:%d' % (path, st.st_size, int(st.st_mtime))
+
+
+class ObjectCache(object):
+    """
+    Content-addressed storage of compiled object files shared by all
+    projects and board builds of the current user.
+
+    An object is keyed on the preprocessed translation unit, the compiler
+    arguments that affect code generation and the compiler identity.
+    Entries are evicted in least recently used order once the total size
+    grows over `max_size` bytes.
+    """
+
+    # options that only affect where headers are searched or where
+    # outputs are written; their effect is already captured by
+    # preprocessed output, so they are not part of a key
+    path_options = ('-o', '-I', '-iquote', '-isystem', '-MF', '-MT', '-MQ')
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.objects_dir = os.path.join(root, 'objects')
+        self.stats_path = os.path.join(root, 'stats.json')
+        self.lock_path = os.path.join(root, 'lock')
+
+    def object_path(self, key):
+        return os.path.join(self.objects_dir, key[:2], key[2:] + '.o')
+
+    def key(self, compiler_args, preprocessed):
+        h = hashlib.sha1()
+        h.update(tool_identity(compiler_args[0]))
+        for arg in self.significant_args(compiler_args[1:]):
+            h.update('\0' + arg)
+        h.update('\0\0')
+        h.update(preprocessed)
+        return h.hexdigest()
+
+    def significant_args(self, args):
+        skip_next = False
+        for arg in args:
+            if skip_next:
+                skip_next = False
+                continue
+            if arg.startswith('@') and os.path.isfile(arg[1:]):
+                # a response file, its path is insignificant
+                with open(arg[1:]) as f:
+                    for inner in self.significant_args(shlex.split(f.read())):
+                        yield inner
+                continue
+            if arg in self.path_options:
+                skip_next = True
+                continue
+            if any(arg.startswith(opt) for opt in self.path_options if len(opt) == 2):
+                continue
+            yield arg
+
+    def lookup(self, key, target):
+        """
+        Copy cached object for `key` into `target`. Return True on a hit.
+        """
+        path = self.object_path(key)
+        try:
+            shutil.copyfile(path, target)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.update_stats(misses=1)
+            return False
+
+        # mark as recently used
+        os.utime(path, None)
+        self.update_stats(hits=1)
+        return True
+
+    def store(self, key, source):
+        path = self.object_path(key)
+        dirname = os.path.dirname(path)
+        makedirs(dirname)
+
+        # copy to a temporary file first so that a concurrent lookup
+        # never sees a partially written object
+        fd, tmp_path = tempfile.mkstemp(dir=dirname)
+        os.close(fd)
+        shutil.copyfile(source, tmp_path)
+        os.rename(tmp_path, path)
+
+        stats = self.update_stats(size=os.path.getsize(path))
+        if stats['size'] > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used objects until the cache takes no more
+        than 90% of `max_size`.
+        """
+        with self.locked():
+            entries = []
+            for dirpath, _, filenames in os.walk(self.objects_dir):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+
+            entries.sort()
+            size = sum(e[1] for e in entries)
+            limit = self.max_size * 9 / 10
+            for _, entry_size, path in entries:
+                if size <= limit:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= entry_size
+
+            stats = self._read_stats()
+            stats['size'] = size
+            self._write_stats(stats)
+
+    def clear(self):
+        with self.locked():
+            if os.path.isdir(self.objects_dir):
+                shutil.rmtree(self.objects_dir)
+            self._write_stats(self._empty_stats())
+
+    def stats(self):
+        stats = self._read_stats()
+        entries = 0
+        for _, _, filenames in os.walk(self.objects_dir):
+            entries += len(filenames)
+        stats['entries'] = entries
+        stats['max_size'] = self.max_size
+        return stats
+
+    def update_stats(self, **increments):
+        with self.locked():
+            stats = self._read_stats()
+            for key, value in increments.iteritems():
+                stats[key] += value
+            self._write_stats(stats)
+        return stats
+
+    @contextmanager
+    def locked(self):
+        makedirs(self.root)
+        with open(self.lock_path, 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _empty_stats(self):
+        return {'hits': 0, 'misses': 0, 'size': 0}
+
+    def _read_stats(self):
+        stats = self._empty_stats()
+        try:
+            with open(self.stats_path) as f:
+                stats.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+        return stats
+
+    def _write_stats(self, stats):
+        with open(self.stats_path, 'w') as f:
+            json.dump(stats, f)
+
+    def compile(self, args):
+        """
+        Run compiler command line `args` (like `cc ... -o obj -c src`)
+        taking the object from cache if possible. Return the exit code.
+        """
+        try:
+            target = args[args.index('-o') + 1]
+        except (ValueError, IndexError):
+            return subprocess.call(args)
+
+        # preprocessed source captures the content of all included headers
+        preprocess_args = [a for i, a in enumerate(args)
+                           if a != '-o' and (i == 0 or args[i - 1] != '-o')]
+        preprocess_args = ['-E' if a == '-c' else a for a in preprocess_args]
+        proc = subprocess.Popen(preprocess_args, stdout=subprocess.PIPE)
+        preprocessed = proc.communicate()[0]
+        if proc.returncode != 0:
+            # let the compiler itself report the error
+            return subprocess.call(args)
+
+        key = self.key(args, preprocessed)
+        if self.lookup(key, target):
+            return 0
+
+        ret = subprocess.call(args)
+        if ret == 0:
+            self.store(key, target)
+        return ret
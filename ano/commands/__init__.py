@@ -1,10 +1,42 @@
 # -*- coding: utf-8; -*-
 
-from ano.commands.init import Init
-from ano.commands.preproc import Preprocess
-from ano.commands.build import Build
-from ano.commands.clean import Clean
-from ano.commands.upload import Upload
-from ano.commands.serial import Serial
-from ano.commands.listmodels import ListModels
-from ano.commands.version import Version
+import importlib
+
+from ano.utils import OrderedDict
+
+
+# Command name -> (module, class name, help line). A module is imported
+# only when its command is run, so that heavy dependencies of one command
+# (jinja2, serial, configobj) do not slow down all the others
+registry = OrderedDict([
+    ('build', ('ano.commands.build', 'Build',
+               "Build firmware from the current directory project")),
+    ('cache', ('ano.commands.cache', 'Cache',
+               "Show statistics of or clear the object cache")),
+    ('clean', ('ano.commands.clean', 'Clean',
+               "Remove intermediate compilation files completely")),
+    ('doctor', ('ano.commands.doctor', 'Doctor',
+                "Show or refresh cached locations of tools")),
+    ('init', ('ano.commands.init', 'Init',
+              "Setup a new project in the current directory")),
+    ('list-models', ('ano.commands.listmodels', 'ListModels',
+                     'List supported Arduino board models')),
+    ('preproc', ('ano.commands.preproc', 'Preprocess',
+                 "Transform a sketch file into valid C++ source")),
+    ('serial', ('ano.commands.serial', 'Serial',
+                "Open a serial monitor")),
+    ('size', ('ano.commands.size', 'Size',
+              "Show flash and RAM usage of the firmware by file and symbol")),
+    ('upload', ('ano.commands.upload', 'Upload',
+                "Upload built firmware to the device")),
+    ('version', ('ano.commands.version', 'Version',
+                 "Print the current version of ano.")),
+])
+
+
+def load_command(name):
+    """
+    Import and return the `Command' subclass registered as `name'.
+    """
+    module, cls, _ = registry[name]
+    return getattr(importlib.import_module(module), cls)
@@ -1,19 +1,108 @@
 # -*- coding: utf-8; -*-
 
+import argparse
+import hashlib
 import inspect
+import json
+import multiprocessing
 import os.path
 import re
 import shlex
+import shutil
 import subprocess
-
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+from ano import __version__
+from ano.cache import tool_identity
 from ano.commands.base import Command
+from ano.commands.preproc import Preprocess
+from ano.engine import BuildFailed, ConcatTask, Executor, ToolTask, parse_depfile
 from ano.environment import BoardModels
 from ano.exc import Abort
 import ano.filters
-from ano.utils import SpaceList, list_subdirs
+from ano.filters import GlobFile, colorize
+from ano.includes import HeaderIndex, IncludeResolver, UnresolvedInclude
+from ano.trace import Trace
+from ano.utils import DirectoryIndex, OrderedDict, SpaceList, list_subdirs, makedirs, write_if_changed
 import jinja2
 from jinja2.runtime import StrictUndefined
 
+try:
+    from jinja2 import pass_context as contextfilter
+except ImportError:
+    # Jinja2 < 3.0
+    from jinja2 import contextfilter
+
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    Cache of compiled templates shared by all ano processes. Writes are
+    atomic so that concurrent builds never read a partial file.
+    """
+
+    def dump_bytecode(self, bucket):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            bucket.write_bytecode(f)
+        os.rename(tmp_path, self._get_cache_filename(bucket))
+
+
+class CapturedOutput(object):
+    """
+    A replacement of sys.stdout that collects what threads print while
+    they capture output, so that output of builds running at once is not
+    interleaved. Other threads print to `stream` directly.
+    """
+
+    # kept by the print statement
+    softspace = 0
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    @contextmanager
+    def capture(self):
+        self.local.buffer = []
+        try:
+            yield self.local.buffer
+        finally:
+            self.local.buffer = None
+
+    def forward(self, func):
+        """
+        Return `func` wrapped to capture output into the buffer of the
+        calling thread when run by another one, e.g. by a thread pool.
+        """
+        buffer = getattr(self.local, 'buffer', None)
+
+        def forwarded(*args, **kwargs):
+            previous = getattr(self.local, 'buffer', None)
+            self.local.buffer = buffer
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.buffer = previous
+        return forwarded
+
+    def write(self, data):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            self.stream.write(data)
+        else:
+            buffer.append(data)
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
 
 class Build(Command):
     """
@@ -43,15 +132,58 @@ class Build(Command):
     default_objcopy = 'avr-objcopy'
     default_memsize= 'avr-size'
 
-    default_cppflags = '-ffunction-sections -fdata-sections -g -Os -w'
+    default_cppflags = '-g -w'
     default_cflags = ''
     default_cxxflags = '-fno-exceptions'
     default_asmflags = '-x assembler-with-cpp'
-    default_ldflags = '-Os --gc-sections'
+    default_ldflags = ''
     default_arch = 'AVR'
 
+    # Optimization settings --profile selects. `cppflags' and `ldflags'
+    # precede the ones given with options of the same names, `linkflags'
+    # are passed to the compiler when linking and `ar' replaces the default
+    # archiver, e.g. to archive LTO objects with the linker plugin
+    default_profile = 'size'
+    profiles = OrderedDict([
+        ('size', {
+            'cppflags': '-ffunction-sections -fdata-sections -Os',
+            'ldflags': '-Os --gc-sections',
+        }),
+        ('speed', {
+            'cppflags': '-ffunction-sections -fdata-sections -O2',
+            'ldflags': '--gc-sections',
+        }),
+        ('lto', {
+            'cppflags': '-ffunction-sections -fdata-sections -Os -flto',
+            'ldflags': '--gc-sections',
+            'linkflags': '-Os -flto',
+            'ar': 'avr-gcc-ar',
+        }),
+        ('debug', {
+            'cppflags': '-ffunction-sections -fdata-sections -Og',
+            'ldflags': '--gc-sections',
+        }),
+    ])
+
+    # limits of --check-budget, in percent of memories of the board
+    default_flash_budget = 100.0
+    default_ram_budget = 75.0
+    default_max_growth = 1.0
+
+    arg_parser = None
+
+    # longer -I flags are passed in a response file
+    response_file_threshold = 4096
+
+    try:
+        default_jobs = multiprocessing.cpu_count()
+    except NotImplementedError:
+        default_jobs = 1
+
     def setup_arg_parser(self, parser):
         super(Build, self).setup_arg_parser(parser)
+        # defaults, including ones of ano.ini, tell options given explicitly
+        self.arg_parser = parser
         self.e.add_board_model_arg(parser)
         self.e.add_arduino_dist_arg(parser)
 
@@ -90,9 +222,46 @@ class Build(Command):
                             'is not given, searches in Arduino directories '
                             'before PATH. Default: "%(default)s".')
 
+        parser.add_argument('--profile', choices=self.profiles.keys(),
+                            default=self.default_profile,
+                            help='Optimization profile: size, speed, link-time '
+                            'optimization or debugging. Sizes of the last build of '
+                            'every profile are kept to be compared against the '
+                            'baseline, see --set-baseline. Default: "%(default)s".')
+
+        parser.add_argument('--set-baseline', default=False, action='store_true',
+                            help='Remember flash and RAM usage of this build to '
+                            'report how every profile differs from it.')
+
+        parser.add_argument('--check-budget', default=False, action='store_true',
+                            help='Fail if flash or RAM usage exceeds its budget or '
+                            'grew since the baseline of the board more than '
+                            '--max-growth allows; sections that grew are shown. '
+                            'Limits for a board model are set in ano.ini with '
+                            'the model appended, e.g. `flash_budget.mega2560\', '
+                            'and win over ones for all boards unless those are '
+                            'given on the command line.')
+
+        parser.add_argument('--flash-budget', metavar='PERCENT', type=float,
+                            default=self.default_flash_budget,
+                            help='Flash usage allowed by --check-budget, in percent '
+                            'of the program storage of the board. Default: %(default)s.')
+
+        parser.add_argument('--ram-budget', metavar='PERCENT', type=float,
+                            default=self.default_ram_budget,
+                            help='RAM usage allowed by --check-budget, in percent of '
+                            'the dynamic memory of the board. Default: %(default)s.')
+
+        parser.add_argument('--max-growth', metavar='PERCENT', type=float,
+                            default=self.default_max_growth,
+                            help='Growth of flash or RAM usage since the baseline '
+                            'allowed by --check-budget, in percent of the memory '
+                            'of the board. Default: %(default)s.')
+
         parser.add_argument('-f', '--cppflags', metavar='FLAGS',
                             default=self.default_cppflags,
-                            help='Flags that will be passed to the compiler. '
+                            help='Flags that will be passed to the compiler '
+                            'after the ones of --profile. '
                             'Note that multiple (space-separated) flags must '
                             'be surrounded by quotes, e.g. '
                             '`--cppflags="-DC1 -DC2"\' specifies flags to define '
@@ -130,6 +299,76 @@ class Build(Command):
                             'during compilation as  -DARDUINO_ARCH_<ARCH>. '
                             'Default: "%(default)s".')
 
+        parser.add_argument('--engine', choices=['make', 'native'],
+                            default='make',
+                            help='Run build steps with the make tool from '
+                            'generated Makefiles or natively by ano itself. '
+                            'Both produce the same firmware. Default: "%(default)s".')
+
+        parser.add_argument('--scan', choices=['headers', 'compiler'],
+                            default='headers',
+                            help='Find libraries a project uses by resolving '
+                            '#include directives against headers libraries '
+                            'provide, like the Arduino IDE does, or by running '
+                            'the compiler over every source. Directories whose '
+                            'includes could not be followed, e.g. ones that '
+                            'include a library under #if, are scanned with '
+                            'the compiler anyway. Default: "%(default)s".')
+
+        parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                            default=self.default_jobs,
+                            help='Number of files to compile in parallel. '
+                            'Default: number of CPUs ("%(default)s").')
+
+        parser.add_argument('--object-cache', default=False, action='store_true',
+                            help='Take compiled objects from the user-wide object '
+                            'cache when the same source was already compiled with '
+                            'the same flags. See `ano cache\'.')
+
+        parser.add_argument('--prebuilt-core', default=False, action='store_true',
+                            help='Build the Arduino core once per board model, '
+                            'CPU variant and flags into an archive kept in the '
+                            'user-wide cache and link all projects against it.')
+
+        parser.add_argument('--pch', default=False, action='store_true',
+                            help='Precompile the Arduino core header once per '
+                            'board model and flags and use it for C++ sources of '
+                            'the project and its libraries that include it first, '
+                            'as preprocessed sketches do.')
+
+        parser.add_argument('--unity', metavar='N', type=int, nargs='?', const=8, default=0,
+                            help='Compile C and C++ sources of the project and of '
+                            'each library in batches of N files (%(const)s if N is '
+                            'omitted) included into generated sources. Fewer, '
+                            'bigger compilations save compiler startup and header '
+                            'parsing, but sources must not define equal static '
+                            'names. Preprocessed sketches and the core are '
+                            'compiled on their own.')
+
+        parser.add_argument('--matrix', default=False, action='store_true',
+                            help='Build firmware for every target of --targets '
+                            'at once, sharing the work that does not depend on '
+                            'the board, and print flash and RAM usage and build '
+                            'time of each target. Jobs of -j are split among '
+                            'targets.')
+
+        parser.add_argument('--targets', metavar='MODEL[:CPU],...',
+                            help='Comma separated board models to build with '
+                            '--matrix, each optionally followed by a CPU variant, '
+                            'e.g. "uno,mega2560,pro:8MHzatmega328". Usually set '
+                            'as `targets\' in the [build] section of ano.ini.')
+
+        parser.add_argument('--trace', metavar='FILE',
+                            help='Record timings of build steps into FILE in '
+                            'Chrome trace event format and print the slowest '
+                            'compiled files. Every compile, archive and link step '
+                            'is recorded with either engine; with make, recipes '
+                            'log their times with date(1).')
+
+        parser.add_argument('--trace-top', metavar='N', type=int, default=10,
+                            help='Number of the slowest files to print with '
+                            '--trace. Default: %(default)s.')
+
         parser.add_argument('-v', '--verbose', default=False, action='store_true',
                             help='Verbose make output')
 
@@ -155,16 +394,23 @@ class Build(Command):
         self.e.find_arduino_user_dir('arduino_user_libraries_dir', ['libraries'],
                                 human_name='Arduino user libraries', optional=True)
 
+        # a profile could replace the default archiver only
+        ar = args.ar
+        if ar == self.default_ar:
+            ar = self.profiles[args.profile].get('ar', ar)
+
         toolset = [
             ('make', args.make),
             ('cc', args.cc),
             ('cxx', args.cxx),
-            ('ar', args.ar),
+            ('ar', ar),
             ('objcopy', args.objcopy),
             ('memsize', args.memsize )
         ]
 
         for tool_key, tool_binary in toolset:
+            if tool_key == 'make' and args.engine == 'native':
+                continue
             self.e.find_arduino_tool(
                 tool_key, ['hardware', 'tools', 'avr', 'bin'],
                 items=[tool_binary], human_name=tool_binary)
@@ -183,6 +429,8 @@ class Build(Command):
             '-I' + self.e['arduino_core_dir'],
         ])
         # Add additional flags as specified
+        profile = self.profiles[args.profile]
+        self.e['cppflags'] += SpaceList(shlex.split(profile['cppflags']))
         self.e['cppflags'] += SpaceList(shlex.split(args.cppflags))
 
         try:
@@ -205,10 +453,17 @@ class Build(Command):
 
         # Again, hard-code the flags that are essential to building the sketch
         self.e['ldflags'] = SpaceList([mcu])
+        self.e['ldflags'] += SpaceList(shlex.split(profile.get('linkflags', '')))
         self.e['ldflags'] += SpaceList([
-            '-Wl,' + flag for flag in shlex.split(args.ldflags)
+            '-Wl,' + flag for flag in shlex.split(profile['ldflags']) + shlex.split(args.ldflags)
         ])
 
+        # the core does not depend on libraries, so it is built with
+        # flags known before dependencies are scanned
+        self.e['core_cppflags'] = SpaceList(self.e['cppflags'])
+        self.e['prebuilt_libs'] = {}
+        self.e['pch'] = None
+
         self.e['names'] = {
             'obj': '%s.o',
             'lib': 'lib%s.a',
@@ -219,8 +474,11 @@ class Build(Command):
 
     def create_jinja(self, verbose):
         templates_dir = os.path.join(os.path.dirname(__file__), '..', 'make')
+        bytecode_dir = os.path.join(self.e.cache_dir, 'jinja')
+        makedirs(bytecode_dir)
         self.jenv = jinja2.Environment(
             loader=jinja2.FileSystemLoader(templates_dir),
+            bytecode_cache=BytecodeCache(bytecode_dir),
             undefined=StrictUndefined, # bark on Undefined render
             extensions=['jinja2.ext.do'])
 
@@ -228,38 +486,384 @@ class Build(Command):
         for name, f in inspect.getmembers(ano.filters, lambda x: getattr(x, 'filter', False)):
             self.jenv.filters[name] = f
 
+        # globs are logged so that a render could be skipped
+        # next time if they give the same files again
+        @contextfilter
+        def logged_glob(context, dirname, *patterns, **kwargs):
+            result = ano.filters.glob(dirname, *patterns, index=self.dir_index, **kwargs)
+            context['glob_log'].append([str(dirname), patterns, kwargs,
+                                        [f.path for f in result]])
+            return result
+        self.jenv.filters['glob'] = logged_glob
+        self.jenv.filters['unity'] = self.unity_sources
+
+        h = hashlib.sha1()
+        for name in sorted(self.jenv.list_templates()):
+            h.update(self.jenv.loader.get_source(self.jenv, name)[0].encode('utf-8'))
+        self.templates_digest = h.hexdigest()
+
         # inject globals
         self.jenv.globals['e'] = self.e
         self.jenv.globals['v'] = '' if verbose else '@'
         self.jenv.globals['slash'] = os.path.sep
         self.jenv.globals['SpaceList'] = SpaceList
 
+    def render_digest(self, source, ctx):
+        """
+        Return a digest of everything a render of `source` depends on
+        except for the files it globs. Templates colorize messages only
+        when printing to a terminal, so that is part of it too.
+        """
+        env = dict((key, value) for key, value in self.e.iteritems() if key != 'board_models')
+        h = hashlib.sha1()
+        for part in [self.templates_digest, source, self.jenv.globals['v'],
+                     self.e.src_dir, self.e.ano, sys.stdout.isatty()]:
+            h.update(str(part) + '\0')
+        h.update(json.dumps([env, ctx], sort_keys=True, default=str))
+        return h.hexdigest()
+
+    def render_is_current(self, out_path, digest, digest_path):
+        try:
+            with open(digest_path) as f:
+                previous = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        if previous['digest'] != digest or not os.path.exists(out_path):
+            return False
+
+        for dirname, patterns, kwargs, paths in previous['globs']:
+            result = ano.filters.glob(dirname, *patterns, index=self.dir_index, **kwargs)
+            if [f.path for f in result] != paths:
+                return False
+
+        return True
+
     def render_template(self, source, target, **ctx):
-        template = self.jenv.get_template(source)
-        contents = template.render(**ctx)
         out_path = os.path.join(self.e.build_dir, target)
+        digest_path = out_path + '.digest'
+        digest = self.render_digest(source, ctx)
+        # a makefile is not rewritten if it would be the same; amalgamations
+        # and their dependencies are written while rendering, so always then
+        if not self.e.unity and self.render_is_current(out_path, digest, digest_path):
+            return out_path
+
+        glob_log = []
+        with self.trace.span(target, 'render'):
+            template = self.jenv.get_template(source)
+            contents = template.render(glob_log=glob_log, **ctx)
+        makedirs(os.path.dirname(out_path))
         with open(out_path, 'wt') as f:
             f.write(contents)
+        with open(digest_path, 'wt') as f:
+            json.dump({'digest': digest, 'globs': glob_log}, f)
 
         return out_path
 
-    def make(self, makefile, **kwargs):
-        makefile = self.render_template(makefile + '.jinja', makefile, **kwargs)
-        ret = subprocess.call([self.e.make, '-f', makefile, 'all'])
+    def setup_make(self, args):
+        self.jobs = max(args.jobs, 1)
+        self.engine = args.engine
+        self.scan = args.scan
+        self.verbose = args.verbose
+        # make runs recipes out of process, those log their timings
+        self.trace_recipes = bool(args.trace) and self.engine == 'make'
+        if args.object_cache:
+            self.e['compile_prefix'] = SpaceList([self.e.ano, 'cache', 'compile', '--'])
+        else:
+            self.e['compile_prefix'] = SpaceList()
+        self.e['unity'] = max(args.unity, 0)
+        self.make_flags = []
+        if args.jobs > 1 and self.engine == 'make':
+            self.make_flags.append('-j%d' % args.jobs)
+            # keep output of parallel jobs grouped per target
+            # so that compiler messages are not interleaved
+            if self.make_output_sync():
+                self.make_flags.append('--output-sync=target')
+
+    def make_output_sync(self):
+        """
+        Return True if the make tool supports --output-sync, i.e.
+        it is GNU Make 4.0 or newer.
+        """
+        cached = self.e.discovery.get('make_output_sync')
+        if cached and cached[0] == self.e.make:
+            return cached[1]
+
+        output = subprocess.Popen([self.e.make, '--version'],
+            stdout=subprocess.PIPE).communicate()[0]
+        match = re.search(r'GNU Make (\d+)', output)
+        supported = match is not None and int(match.group(1)) >= 4
+        self.e.discovery['make_output_sync'] = [self.e.make, supported]
+        return supported
+
+    def make(self, makefile, target=None, **kwargs):
+        target = target or makefile
+        if self.engine == 'native':
+            return self.build_natively(makefile, target, **kwargs)
+
+        failures_log = os.path.join(self.e.build_dir, target + '.failures')
+        trace_log = os.path.join(self.e.build_dir, target + '.trace') if self.trace_recipes else None
+        for path in [failures_log, trace_log]:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+        makefile = self.render_template(makefile + '.jinja', target, failures_log=failures_log,
+                                        trace_log=trace_log, **kwargs)
+        cmd = [self.e.make, '-f', makefile] + self.make_flags + ['all']
+        with self.trace.span(target, 'make'):
+            if sys.stdout is sys.__stdout__:
+                ret = subprocess.call(cmd)
+            else:
+                # e.g. captured while building several targets
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+                sys.stdout.write(proc.communicate()[0])
+                ret = proc.returncode
+        if trace_log is not None and os.path.exists(trace_log):
+            self.trace.merge(trace_log)
         if ret != 0:
+            failures = []
+            if os.path.exists(failures_log):
+                with open(failures_log) as f:
+                    failures = [line.strip() for line in f if line.strip()]
+            if failures:
+                raise Abort("Make failed with code %s, first failure in %s" %
+                            (ret, failures[0]))
             raise Abort("Make failed with code %s" % ret)
 
-    def recursive_inc_lib_flags(self, libdirs):
-        flags = SpaceList()
+    def build_natively(self, makefile, target, **kwargs):
+        """
+        Run the steps `makefile` template describes without make. Task
+        signatures are kept in a `.state' file next to where the rendered
+        makefile would be.
+        """
+        builders = {
+            'Makefile': self.firmware_tasks,
+            'Makefile.deps': self.deps_tasks,
+            'Makefile.core': self.core_tasks,
+        }
+        executor = Executor(os.path.join(self.e.build_dir, target + '.state'),
+                            jobs=self.jobs, verbose=self.verbose, trace=self.trace)
+        goals = builders[makefile](executor, **kwargs)
+        try:
+            executor.run(goals)
+        except BuildFailed as e:
+            raise Abort("Build failed with code %s, first failure in %s" %
+                        (e.returncode, e.source))
+
+    def split_flags(self, *flags):
+        return shlex.split(' '.join(map(str, flags)))
+
+    def iquote_flags(self, source):
+        # sketches preprocessed into build_dir include files from their origin
+        src_build_dir = os.path.join(self.e.build_dir, os.path.basename(self.e.src_dir))
+        if not source.path.startswith(src_build_dir):
+            return []
+        origin = os.path.join(self.e.src_dir, os.path.relpath(source.path, src_build_dir))
+        return ['-iquote', os.path.dirname(origin)]
+
+    def compile_tasks(self, filemap, tool, cppflags, flags, group, pch=None):
+        for source, target in filemap.iteritems():
+            args = list(self.e.compile_prefix) + [tool] + \
+                self.split_flags(cppflags, flags) + self.iquote_flags(source) + \
+                ['-o', target.path, '-c', source.path]
+            message = colorize(os.path.join(os.path.basename(source.dirname), source.filename), 'yellow')
+            # response files hold flags, those are inputs too
+            inputs = [source.path] + [arg[1:] for arg in args if arg.startswith('@')]
+            if pch:
+                inputs.append(pch)
+            yield ToolTask(target.path, inputs, args, message=message,
+                           source=source.path, depfile=ano.filters.depsname(target.path),
+                           category='compile', group=group)
+
+    def library_tasks(self, executor, source_dir, target, cppflags, pch=None, unity=False):
+        group = os.path.basename(source_dir) if unity else None
+        objs = []
+        for pattern, tool, flags, header in [('*.c', self.e.cc, self.e.cflags, None),
+                                             ('*.cpp', self.e.cxx, self.e.cxxflags, pch),
+                                             ('*.S', self.e.cc, self.e.asmflags, None)]:
+            sources = ano.filters.glob(source_dir, pattern, index=self.dir_index)
+            if pattern != '*.S':
+                sources = self.unity_sources(sources, group, target.dirname)
+            filemap = ano.filters.filemap(sources, target.dirname, self.e.names['obj'])
+            executor.extend(self.compile_tasks(filemap, tool, cppflags, flags,
+                                               group=os.path.basename(source_dir), pch=header))
+            objs.extend(filemap.target_paths())
+
+        message = colorize('Linking ' + os.path.basename(target.filename), 'green')
+        executor.add(ToolTask(target.path, objs, [self.e.ar, 'rcs', target.path] + objs,
+                              message=message, category='archive',
+                              group=os.path.basename(source_dir)))
+
+    def firmware_tasks(self, executor):
+        """
+        Native counterpart of Makefile.jinja
+        """
+        src_build_dir = os.path.join(self.e.build_dir, os.path.basename(self.e.src_dir))
+        glob = lambda dirname, *patterns: ano.filters.glob(dirname, *patterns, index=self.dir_index)
+        objname = self.e.names['obj']
+        group = os.path.basename(self.e.src_dir)
+
+        pch = None
+        if self.e.pch:
+            pch = self.e.pch['path']
+            header = self.e.pch['header']
+            args = [self.e.cxx] + self.split_flags(self.e.core_cppflags, self.e.cxxflags) + \
+                ['-x', 'c++-header', '-MMD', '-MF', self.e.pch['deps'], '-o', pch, '-c', header]
+            executor.add(ToolTask(pch, [header], args,
+                                  message=colorize('Precompiling ' + os.path.basename(header), 'yellow'),
+                                  source=header, depfile=self.e.pch['deps'], category='compile',
+                                  group=os.path.basename(self.e.arduino_core_dir)))
+
+        libs = ano.filters.libmap(self.e.used_libs, self.e.build_dir, self.e.prebuilt_libs)
+        for source_dir, target in libs.iteritems():
+            if source_dir not in self.e.prebuilt_libs:
+                self.library_tasks(executor, source_dir, target, self.e.cppflags, pch,
+                                   unity=source_dir != self.e.arduino_core_dir)
+
+        unity = lambda sources: self.unity_sources(sources, group, src_build_dir)
+        c = ano.filters.filemap(unity(glob(self.e.src_dir, '*.c')), src_build_dir, objname)
+        executor.extend(self.compile_tasks(c, self.e.cc, self.e.cppflags, self.e.cflags, group))
+
+        cpp = ano.filters.filemap(unity(glob(self.e.src_dir, '*.cpp')) + glob(src_build_dir, '*.cpp'),
+                                  src_build_dir, objname)
+        executor.extend(self.compile_tasks(cpp, self.e.cxx, self.e.cppflags, self.e.cxxflags, group, pch))
+
+        asm = ano.filters.filemap(glob(self.e.src_dir, '*.S') + glob(src_build_dir, '*.S'),
+                                  src_build_dir, objname)
+        executor.extend(self.compile_tasks(asm, self.e.cc, self.e.cppflags, self.e.asmflags, group))
+
+        objs = c.target_paths() + cpp.target_paths() + libs.target_paths()
+        elf = os.path.join(self.e.build_dir, 'firmware.elf')
+        executor.add(ToolTask(elf, objs,
+                              [self.e.cc] + self.split_flags(self.e.ldflags) + ['-o', elf] + objs + ['-lm'],
+                              message=colorize('Linking firmware.elf', 'green'),
+                              category='link'))
+
+        executor.add(ToolTask(self.e.hex_path, [elf],
+                              [self.e.objcopy, '-O', 'ihex', '-R', '.eeprom', elf, self.e.hex_path],
+                              message=colorize('Converting to ' + self.e.hex_filename, 'green'),
+                              category='objcopy'))
+        return [self.e.hex_path]
+
+    def deps_tasks(self, executor, inc_flags, src_dir, output_filepath):
+        """
+        Native counterpart of Makefile.deps.jinja
+        """
+        src_build_dir = os.path.join(self.e.build_dir, os.path.basename(src_dir))
+        sources = ano.filters.glob(src_dir, '*.c', '*.cpp', '*.S', index=self.dir_index)
+        if src_dir == self.e.src_dir:
+            sources += ano.filters.glob(src_build_dir, '*.cpp', index=self.dir_index)
+
+        deps = ano.filters.filemap(sources, src_build_dir, self.e.names['deps'])
+        for source, target in deps.iteritems():
+            args = [self.e.cc] + self.split_flags(self.e.cppflags, inc_flags) + \
+                self.iquote_flags(source) + ['-MM', source.path]
+            # like in the Makefile, a .d file names itself as a target too and
+            # object targets are placed in build directory
+            prefix = '%s %s%s' % (target.path, os.path.dirname(target.path), os.path.sep)
+            executor.add(ToolTask(target.path, [source.path], args, stdout_prefix=prefix,
+                                  source=source.path, depfile=target.path,
+                                  category='scan', group=os.path.basename(src_dir)))
+
+        message = colorize('Scanning dependencies of ' + os.path.basename(src_dir), 'cyan')
+        executor.add(ConcatTask(output_filepath, deps.target_paths(), message=message,
+                                category='scan', group=os.path.basename(src_dir)))
+        return [output_filepath]
+
+    def core_tasks(self, executor, core_build_dir):
+        """
+        Native counterpart of Makefile.core.jinja
+        """
+        core = ano.filters.libmap([self.e.arduino_core_dir], core_build_dir)
+        for source_dir, target in core.iteritems():
+            self.library_tasks(executor, source_dir, target, self.e.core_cppflags)
+        return core.target_paths()
+
+    def preprocess_sketches(self):
+        """
+        Transform *.ino and *.pde sketches into C++ sources in build_dir.
+
+        All sketches are processed in-process in a batch. An output is
+        rewritten only when its contents change so that make would not
+        recompile a sketch that is not modified.
+        """
+        preproc = Preprocess(self.e)
+        src_build_dir = os.path.join(self.e.build_dir, os.path.basename(self.e.src_dir))
+        sketches = ano.filters.glob(self.e.src_dir, '*.pde', '*.ino', index=self.dir_index)
+        for source, target in ano.filters.filemap(sketches, src_build_dir,
+                                                  self.e.names['cpp']).iterpaths():
+            contents = preproc.preprocess(source)
+            if os.path.exists(target):
+                with open(target, 'rt') as f:
+                    if f.read() == contents:
+                        continue
+
+            print colorize(source, 'yellow')
+            target_dir = os.path.dirname(target)
+            makedirs(target_dir)
+            with open(target, 'wt') as f:
+                f.write(contents)
+
+        # sources produced are globbed later
+        self.dir_index.invalidate(src_build_dir)
+
+    def recursive_inc_lib_dirs(self, libdirs):
+        dirs = []
         for d in libdirs:
-            flags.append('-I' + "\"" + d + "\"")
-            flags.extend('-I' + "\"" + subd + "\"" for subd in list_subdirs(d, recursive=True, exclude=['examples', 'extras']))
-        return flags
-
-    def _scan_dependencies(self, dirName, lib_dirs, inc_flags):
-        output_filepath = os.path.join(self.e.build_dir, os.path.basename(dirName), 'dependencies.d')
-        self.make('Makefile.deps', inc_flags=inc_flags, src_dir=dirName, output_filepath=output_filepath)
-        self.e['deps'].append(output_filepath)
+            dirs.append(d)
+            dirs.extend(list_subdirs(d, recursive=True, exclude=['examples', 'extras'],
+                                     index=self.dir_index))
+        return dirs
+
+    def include_flags(self, dirs, name):
+        """
+        Return -I flags for `dirs`. Flags longer than
+        `response_file_threshold` are written to a response file `name` in
+        the build directory that is passed as @file instead. The file is
+        rewritten only when its contents change.
+        """
+        flags = SpaceList('-I' + "\"" + d + "\"" for d in dirs)
+        if len(' '.join(flags)) <= self.response_file_threshold:
+            return flags
+
+        # backslashes and quotes are escapes in response files
+        escape = lambda d: d.replace('\\', '\\\\').replace('"', '\\"')
+        contents = ''.join('-I"%s"\n' % escape(d) for d in dirs)
+        path = os.path.join(self.e.build_dir, name)
+        write_if_changed(path, contents)
+        return SpaceList(['@"%s"' % path])
+
+    def scan_include_flags(self, lib_dirs):
+        """
+        Return -I flags for every directory of every library in `lib_dirs`.
+        Those are computed once and only if a directory is scanned with
+        the compiler.
+        """
+        with self.scan_lock:
+            if self.scan_flags is None:
+                self.scan_flags = self.include_flags(self.recursive_inc_lib_dirs(lib_dirs),
+                                                     'scan-includes.rsp')
+            return self.scan_flags
+
+    def _scan_dependencies(self, dirName, lib_dirs):
+        # every scanned directory gets its own makefile so that
+        # several scans could run at the same time
+        output_dirname = os.path.basename(dirName)
+        output_filepath = os.path.join(self.e.build_dir, output_dirname, 'dependencies.d')
+        if self.resolver is not None:
+            try:
+                with self.trace.span(output_dirname, 'resolve-includes'):
+                    return output_filepath, self.resolve_dependencies(dirName, output_filepath)
+            except UnresolvedInclude as e:
+                if self.verbose:
+                    print '%s, scanning with the compiler' % e
+
+        self.compiler_scanned = True
+        inc_flags = self.scan_include_flags(lib_dirs)
+        with self.trace.span(output_dirname, 'scan-library'):
+            self.make('Makefile.deps', target=os.path.join(output_dirname, 'Makefile.deps'),
+                      inc_flags=inc_flags, src_dir=dirName, output_filepath=output_filepath)
 
         # search for dependencies on libraries
         # for this scan dependency file generated by make
@@ -273,8 +877,85 @@ class Build(Command):
                     if regex.search(line) and lib != dirName:
                         used_libs.add(lib)
 
+        return output_filepath, used_libs
+
+    def resolve_dependencies(self, src_dir, output_filepath):
+        """
+        Write the same dependency files a compiler scan of `src_dir` would,
+        following includes with `self.resolver` instead. Return the set of
+        libraries sources of `src_dir` include headers of.
+        """
+        src_build_dir = os.path.join(self.e.build_dir, os.path.basename(src_dir))
+        sources = ano.filters.glob(src_dir, '*.c', '*.cpp', '*.S', index=self.dir_index)
+        if src_dir == self.e.src_dir:
+            sources += ano.filters.glob(src_build_dir, '*.cpp', index=self.dir_index)
+
+        used_libs = set()
+        rules = []
+        for source, target in ano.filters.filemap(sources, src_build_dir,
+                                                  self.e.names['deps']).iteritems():
+            headers = self.resolver.dependencies(source.path, src_dir,
+                                                 self.iquote_flags(source)[1:])
+            used_libs.update(lib for _, lib in headers if lib is not None)
+
+            # as `cc -MM' output with the prefix Makefile.deps adds
+            obj = os.path.join(target.dirname, ano.filters.objname(source.filename))
+            rule = self.depfile_rule([target.path, obj],
+                                     [source.path] + [path for path, _ in headers])
+            makedirs(os.path.dirname(target.path))
+            with open(target.path, 'wt') as f:
+                f.write(rule)
+            rules.append(rule)
+
+        makedirs(os.path.dirname(output_filepath))
+        with open(output_filepath, 'wt') as f:
+            f.write(''.join(rules))
+
+        used_libs.discard(src_dir)
         return used_libs
 
+    def depfile_rule(self, targets, prerequisites):
+        escape = lambda path: path.replace(' ', '\\ ')
+        return '%s: %s\n' % (' '.join(map(escape, targets)),
+                              ' '.join(map(escape, prerequisites)))
+
+    def unity_sources(self, sources, group, target_dir):
+        """
+        Return `sources` batched into amalgamation sources of up to
+        `e.unity` files each, or `sources` as is if unity builds are off
+        or `group` is None. An amalgamation #include's its sources, so
+        diagnostics and debug info still name their original files and
+        lines.
+
+        Amalgamations are written into a `.unity' directory of the build
+        directory along with dependency files for their objects, to be
+        compiled into `target_dir`. Their dependencies are the ones scans
+        found for their sources.
+        """
+        if not self.e.unity or group is None or len(sources) < 2:
+            return sources
+
+        unit_dir = os.path.join(self.e.build_dir, '.unity', group)
+        sources = sorted(sources, key=lambda source: source.path)
+        units = SpaceList()
+        for i in range(0, len(sources), self.e.unity):
+            batch = sources[i:i + self.e.unity]
+            ext = os.path.splitext(batch[0].filename)[1]
+            unit = GlobFile('unity-%d%s' % (len(units) + 1, ext), unit_dir)
+            write_if_changed(unit.path, ''.join('#include "%s"\n' % os.path.abspath(source.path)
+                                                for source in batch))
+
+            prerequisites = [unit.path]
+            for source in batch:
+                depfile = os.path.join(target_dir, ano.filters.oxname(source.filename,
+                                                                      self.e.names['deps']))
+                prerequisites.extend(parse_depfile(depfile) or [source.path])
+            obj = os.path.join(target_dir, ano.filters.objname(unit.filename))
+            prerequisites = list(OrderedDict.fromkeys(prerequisites))
+            write_if_changed(ano.filters.depsname(obj), self.depfile_rule([obj], prerequisites))
+            units.append(unit)
+        return units
+
     def _size_by_search(self, patternstr, output):
         patternmatch = re.search(patternstr, output)
         if patternmatch is None:
@@ -285,7 +966,10 @@ class Build(Command):
             except IndexError:
                 return 0
 
-    def check_memory(self, args):
+    def memory_limits(self, args):
+        """
+        Return flash and RAM sizes of the board, 0 if unknown.
+        """
         board = self.e.board_model(args.board_model)
         boardVariant = args.cpu if ('cpu' in args) else None;
         flash_max = sram_max = 0
@@ -302,9 +986,14 @@ class Build(Command):
         except KeyError:
             pass
 
+        return flash_max, sram_max
+
+    def check_memory(self, args):
+        flash_max, sram_max = self.memory_limits(args)
         firmware = os.path.join(self.e.build_dir, "firmware.elf")
-        output = subprocess.Popen( [self.e.memsize, "--format=sysv", firmware],
-            stdout=subprocess.PIPE).communicate()[0]
+        with self.trace.span(firmware, 'size'):
+            output = subprocess.Popen( [self.e.memsize, "--format=sysv", firmware],
+                stdout=subprocess.PIPE).communicate()[0]
         text_size = self._size_by_search('\.text\s+(\d+)', output)
         data_size = self._size_by_search('\.data\s+(\d+)', output)
         bss_size = self._size_by_search('\.bss\s+(\d+)', output)
@@ -339,51 +1028,544 @@ class Build(Command):
             print "\033[91mLow memory available, stability problems may " \
                 "occur.\033[0m"
 
+        sections = {'.text': text_size, '.data': data_size, '.bss': bss_size}
+        self.report_profiles(args, flash_size, sram_size, sections)
+        if args.check_budget:
+            self.check_budget(args, flash_size, sram_size, sections)
+
+    def report_profiles(self, args, flash_size, sram_size, sections):
+        """
+        Record flash and RAM usage of the build for its profile and print
+        how the last builds of every profile differ from the baseline.
+        """
+        profiles = dict(self.e.sizes.get('profiles', {}))
+        profiles[args.profile] = [flash_size, sram_size]
+        self.e.sizes['profiles'] = profiles
+        profile_sections = dict(self.e.sizes.get('sections', {}))
+        profile_sections[args.profile] = sections
+        self.e.sizes['sections'] = profile_sections
+        if args.set_baseline:
+            self.set_baseline(args.profile)
+
+        baseline = self.e.sizes.get('baseline')
+        if baseline is None:
+            return
+        base_profile, base_flash, base_sram = baseline[:3]
+        print 'Last builds compared to the baseline built with the %s profile:' % base_profile
+        print '  {:<6} {:>8} {:>8} {:>8} {:>8}'.format('', 'flash', '+/-', 'RAM', '+/-')
+        for name in self.profiles:
+            if name in profiles:
+                flash, sram = profiles[name]
+                print '{} {:<6} {:>8,d} {:>+8,d} {:>8,d} {:>+8,d}'.format(
+                    '*' if name == args.profile else ' ', name,
+                    flash, flash - base_flash, sram, sram - base_sram)
+
+    def set_baseline(self, profile):
+        try:
+            flash, sram = self.e.sizes.get('profiles', {})[profile]
+        except KeyError:
+            raise Abort('Usage of the %s profile is unknown, rebuild to set the baseline' % profile)
+        sections = self.e.sizes.get('sections', {}).get(profile, {})
+        self.e.sizes['baseline'] = [profile, flash, sram, sections]
+        print colorize('Baseline set to %s profile usage' % profile, 'green')
+
+    def budget(self, args, name):
+        """
+        Return the limit `name` of --check-budget for the board model
+        built, e.g. `flash_budget.uno' of ano.ini, or the one for all. An
+        option given on the command line wins over both.
+        """
+        key = '--' + name.replace('_', '-')
+        value = getattr(args, name)
+        model_key = '%s.%s' % (name, args.board_model)
+        default = getattr(self, 'default_' + name) if self.arg_parser is None else \
+            self.arg_parser.get_default(name)
+        # argparse converts a default given as a string, e.g. by ano.ini
+        if hasattr(args, model_key) and value == float(default):
+            key, value = model_key, getattr(args, model_key)
+        try:
+            return float(value)
+        except ValueError:
+            raise Abort('%s should be a percentage, not %s' % (key, value))
+
+    def check_budget(self, args, flash_size, sram_size, sections):
+        """
+        Abort if flash or RAM usage exceeds its budget, or grew since the
+        baseline more than allowed. Both are percentages of the memory of
+        the board and are not checked if its size is unknown.
+        """
+        flash_max, sram_max = self.memory_limits(args)
+        max_growth = self.budget(args, 'max_growth')
+        baseline = self.e.sizes.get('baseline')
+        if baseline is None:
+            print 'No baseline to check growth of memory usage against, see --set-baseline'
+            base_profile, base_flash, base_sram, base_sections = None, None, None, {}
+        else:
+            base_profile, base_flash, base_sram = baseline[:3]
+            base_sections = baseline[3] if len(baseline) > 3 else {}
+
+        exceeded = []
+        for name, size, size_max, budget, base in [
+                ('Flash', flash_size, flash_max, self.budget(args, 'flash_budget'), base_flash),
+                ('RAM', sram_size, sram_max, self.budget(args, 'ram_budget'), base_sram)]:
+            if size_max <= 0:
+                continue
+            if size * 100.0 / size_max > budget:
+                exceeded.append('{} usage of {:,d} bytes is more than {:g}% of {:,d} bytes'.format(
+                    name, size, budget, size_max))
+            if base is not None and (size - base) * 100.0 / size_max > max_growth:
+                exceeded.append('{} usage grew by {:,d} bytes ({:.1f}% of {:,d} bytes) since the '
+                                'baseline of the {} profile, more than {:g}% allowed'.format(
+                                    name, size - base, (size - base) * 100.0 / size_max,
+                                    size_max, base_profile, max_growth))
+
+        if not exceeded:
+            print colorize('Memory usage is within the budget', 'green')
+            return
+
+        for message in exceeded:
+            print colorize(message, 'red')
+        print '  {:<8} {:>8} {:>8} {:>8}'.format('section', 'baseline', 'current', '+/-')
+        for name in sorted(sections):
+            base = base_sections.get(name)
+            if base is None:
+                print '  {:<8} {:>8} {:>8,d} {:>8}'.format(name, '?', sections[name], '?')
+            else:
+                print '  {:<8} {:>8,d} {:>8,d} {:>+8,d}'.format(name, base, sections[name],
+                                                              sections[name] - base)
+        raise Abort('Memory budget exceeded')
+
+    def prebuild_core(self, args):
+        """
+        Build the Arduino core into an archive in the user-wide cache unless
+        there is one built for the same board model, CPU variant, flags and
+        toolchain already. The archive is then linked instead of core sources
+        compiled within the project.
+        """
+        core_dir = self.e.arduino_core_dir
+        if core_dir not in self.e.used_libs:
+            return
+
+        board = self.e.board_model(args.board_model)
+        boardVariant = args.cpu if ('cpu' in args) else None
+        h = hashlib.sha1()
+        for part in [args.board_model, boardVariant,
+                     BoardModels.getValueForVariant(board, boardVariant, 'build', 'f_cpu'),
+                     self.e.arduino_lib_version.as_int(),
+                     self.e.core_cppflags, self.e.cflags, self.e.cxxflags, self.e.asmflags,
+                     tool_identity(self.e.cc), tool_identity(self.e.cxx), tool_identity(self.e.ar)]:
+            h.update(str(part) + '\0')
+
+        # core sources could be updated in place
+        for dirpath, dirnames, filenames in os.walk(core_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                st = os.stat(path)
+                h.update('%s:%d:%d\0' % (path, st.st_size, int(st.st_mtime)))
+
+        cores_dir = os.path.join(self.e.cache_dir, 'cores')
+        archive_dir = os.path.join(cores_dir, '%s-%s' % (args.board_model, h.hexdigest()[:16]))
+        archive = ano.filters.libmap([core_dir], archive_dir).target_paths()[0]
+
+        if not os.path.exists(archive):
+            makedirs(cores_dir)
+
+            # build aside and move in place at once so that
+            # concurrent builds never link a partial archive
+            tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(archive_dir) + '.', dir=cores_dir)
+            try:
+                self.make('Makefile.core', core_build_dir=tmp_dir)
+                try:
+                    os.rename(tmp_dir, archive_dir)
+                except OSError:
+                    # built by another project meanwhile
+                    if not os.path.exists(archive):
+                        raise
+            finally:
+                if os.path.isdir(tmp_dir):
+                    shutil.rmtree(tmp_dir)
+
+        self.e['prebuilt_libs'] = {core_dir: archive}
+
+    def setup_pch(self):
+        """
+        Precompile the core header into a directory searched before the
+        core itself. GCC takes `Arduino.h.gch' from there instead of parsing
+        `Arduino.h' when it is included before any other code and flags match;
+        otherwise the header is found in the core as usual.
+
+        The directory is named after the compiler and flags the header is
+        precompiled with, so changing any of them gives a new one that
+        every C++ object depends on. Headers of the core it reads are
+        tracked like those of any source.
+        """
+        core_header = 'Arduino.h' if self.e.arduino_lib_version.major else 'WProgram.h'
+        h = hashlib.sha1()
+        for part in [tool_identity(self.e.cxx), self.e.core_cppflags, self.e.cxxflags]:
+            h.update(str(part) + '\0')
+
+        pch_dir = os.path.join(self.e.build_dir, 'pch', h.hexdigest()[:16])
+        self.e['pch'] = {
+            'header': os.path.join(self.e.arduino_core_dir, core_header),
+            'path': os.path.join(pch_dir, core_header + '.gch'),
+            'deps': os.path.join(pch_dir, core_header + '.d'),
+        }
+        core_flag = '-I' + self.e.arduino_core_dir
+        self.e.cppflags.insert(self.e.cppflags.index(core_flag), '-I' + pch_dir)
+
     def scan_dependencies(self):
         self.e['deps'] = SpaceList()
 
         lib_dirs = [self.e.arduino_core_dir] + \
-            list_subdirs(self.e.lib_dir) + \
-            list_subdirs(self.e.arduino_libraries_dir) + \
-            list_subdirs(self.e.arduino_core_libraries_dir) + \
-            list_subdirs(self.e.arduino_user_libraries_dir)
-        inc_flags = self.recursive_inc_lib_flags(lib_dirs)
+            list_subdirs(self.e.lib_dir, index=self.dir_index) + \
+            list_subdirs(self.e.arduino_libraries_dir, index=self.dir_index) + \
+            list_subdirs(self.e.arduino_core_libraries_dir, index=self.dir_index) + \
+            list_subdirs(self.e.arduino_user_libraries_dir, index=self.dir_index)
+
+        self.scan_flags = None
+        self.scan_lock = threading.Lock()
+        self.compiler_scanned = False
+        self.resolver = None
+        if self.scan == 'headers':
+            # targets of --matrix share library headers and parsed sources
+            headers = self.scan_cache.get(tuple(lib_dirs))
+            if headers is None:
+                headers = self.scan_cache.setdefault(tuple(lib_dirs), HeaderIndex(
+                    lib_dirs, self.e.user_state.namespace('headers'), self.dir_index))
+            include_dirs = [flag[2:] for flag in self.split_flags(self.e.cppflags)
+                            if flag.startswith('-I')]
+            self.resolver = IncludeResolver(include_dirs, headers,
+                                            self.scan_cache.setdefault('includes', {}))
 
         # If lib A depends on lib B it have to appear before B in final
         # list so that linker could link all together correctly
         # but order of `_scan_dependencies` is not defined, so...
 
+        scan = lambda dirName: self._scan_dependencies(dirName, lib_dirs)
+        if isinstance(sys.stdout, CapturedOutput):
+            scan = sys.stdout.forward(scan)
+
         # 1. Get dependencies of sources in arbitrary order
-        used_libs = list(self._scan_dependencies(self.e.src_dir, lib_dirs, inc_flags))
+        deps_filepath, dep_libs = scan(self.e.src_dir)
+        self.e['deps'].append(deps_filepath)
+        used_libs = list(dep_libs)
 
         # 2. Get dependencies of dependency libs themselves: existing dependencies
-        # are moved to the end of list maintaining order, new dependencies are appended
-        scanned_libs = set()
-        while scanned_libs != set(used_libs):
-            for lib in set(used_libs) - scanned_libs:
-                dep_libs = self._scan_dependencies(lib, lib_dirs, inc_flags)
-
-                i = 0
-                for ulib in used_libs[:]:
-                    if ulib in dep_libs:
-                        # dependency lib used already, move it to the tail
-                        used_libs.append(used_libs.pop(i))
-                        dep_libs.remove(ulib)
-                    else:
-                        i += 1
-
-                # append new dependencies to the tail
-                used_libs.extend(dep_libs)
-                scanned_libs.add(lib)
+        # are moved to the end of list maintaining order, new dependencies are appended.
+        # Libraries discovered at the same step are scanned concurrently, but
+        # their results are merged in the order a one by one scan would use
+        pool = ThreadPool(self.jobs)
+        try:
+            scanned_libs = set()
+            while scanned_libs != set(used_libs):
+                wave = list(set(used_libs) - scanned_libs)
+                for lib, (deps_filepath, dep_libs) in zip(wave, pool.map(scan, wave)):
+                    self.e['deps'].append(deps_filepath)
+
+                    i = 0
+                    for ulib in used_libs[:]:
+                        if ulib in dep_libs:
+                            # dependency lib used already, move it to the tail
+                            used_libs.append(used_libs.pop(i))
+                            dep_libs.remove(ulib)
+                        else:
+                            i += 1
+
+                    # append new dependencies to the tail
+                    used_libs.extend(dep_libs)
+                    scanned_libs.add(lib)
+        finally:
+            pool.close()
 
         self.e['used_libs'] = used_libs
-        self.e['cppflags'].extend(self.recursive_inc_lib_flags(used_libs))
+
+        if self.compiler_scanned:
+            # which headers the compiler found and where is unknown
+            inc_dirs = self.recursive_inc_lib_dirs(used_libs)
+        else:
+            # a library root and directories its headers were found in
+            # by name are enough, the core is in cppflags already
+            inc_dirs = []
+            for lib in used_libs:
+                if lib not in self.resolver.include_dirs:
+                    inc_dirs.append(lib)
+                    inc_dirs.extend(sorted(self.resolver.search_dirs.get(lib, set()) - set([lib])))
+        self.e['cppflags'].extend(self.include_flags(inc_dirs, 'includes.rsp'))
+
+    def build_state_args(self, args):
+        """
+        Return build arguments that affect the result in a JSON-compatible form.
+        """
+        significant = dict((key, value) for key, value in vars(args).iteritems()
+                           if key.split('.')[0] not in (
+                               'func', 'jobs', 'verbose', 'trace', 'trace_top', 'set_baseline',
+                               'matrix', 'targets', 'check_budget', 'flash_budget',
+                               'ram_budget', 'max_growth'))
+        return json.loads(json.dumps(significant, default=str))
+
+    def track_sources(self, dirnames, recursive=True):
+        """
+        Record modification times of `dirnames` and sizes and modification
+        times of all files within them into the build state. Directory mtime
+        changes when an entry is added or removed.
+        """
+        for dirname in dirnames:
+            if not dirname or not os.path.isdir(dirname):
+                continue
+            if not recursive:
+                self.build_state['dirs'][dirname] = os.stat(dirname).st_mtime
+                continue
+            for dirpath, _, filenames in os.walk(dirname):
+                self.build_state['dirs'][dirpath] = os.stat(dirpath).st_mtime
+                self.track_files(os.path.join(dirpath, f) for f in filenames)
+
+    def track_files(self, paths):
+        for path in paths:
+            st = os.stat(path)
+            self.build_state['files'][path] = [st.st_mtime, st.st_size]
+
+    def up_to_date(self, args):
+        """
+        Return True if nothing was changed since the last successful build:
+        sources, libraries, tools and flags are the same as recorded in the
+        build state and the firmware is still in place.
+        """
+        state = self.e.build_state
+        if state.get('version') != __version__ or state.get('args') != self.build_state_args(args):
+            return False
+
+        try:
+            for path, mtime in state['dirs'].iteritems():
+                if os.stat(path).st_mtime != mtime:
+                    return False
+            for path, (mtime, size) in state['files'].iteritems():
+                st = os.stat(path)
+                if st.st_mtime != mtime or st.st_size != size:
+                    return False
+        except OSError:
+            return False
+
+        return True
+
+    def save_build_state(self, args):
+        self.track_files([self.e.hex_path])
+        self.build_state['version'] = __version__
+        self.build_state['args'] = self.build_state_args(args)
+        for key, value in self.build_state.iteritems():
+            self.e.build_state[key] = value
+        self.e.build_state.save()
+
+    def write_trace(self, path, top):
+        self.trace.write(path)
+        print colorize('Build trace saved to %s' % path, 'green')
+
+        slowest = self.trace.slowest('compile', top)
+        if not slowest:
+            return
+
+        print 'Slowest compiled files:'
+        width = max(len(event['args']['group'] or '') for event in slowest)
+        for event in slowest:
+            print '%8.3fs  %s  %s' % (event['dur'] / 1e6,
+                                      (event['args']['group'] or '').ljust(width),
+                                      event['name'])
+
+    def matrix_targets(self, args):
+        """
+        Return (name, model, cpu) tuples for targets of `--targets`. A
+        target without a CPU variant is built with `--cpu` as given.
+        """
+        targets = args.targets or []
+        # a list if set in ano.ini
+        if isinstance(targets, basestring):
+            targets = targets.split(',')
+
+        result = OrderedDict()
+        for target in targets:
+            model, _, cpu = target.strip().partition(':')
+            if model:
+                result[target.strip()] = (model, cpu or args.cpu)
+        if not result:
+            raise Abort("No targets to build, list them with --targets or as "
+                        "`targets' in the [build] section of ano.ini")
+        return [(name, model, cpu) for name, (model, cpu) in result.iteritems()]
+
+    def build_matrix(self, args):
+        """
+        Build every target of `--targets` in a thread of its own, with its
+        own environment and build directory, as `ano build -m MODEL --cpu
+        CPU' would. Directory listings, library headers and parsed
+        sources do not depend on the board and are shared, and so is the
+        persistent state, which is saved with the main environment only.
+        Output of a target is printed as a whole once it is built, then a
+        summary of all targets is.
+        """
+        targets = self.matrix_targets(args)
+        jobs = max(args.jobs // len(targets), 1)
+        output = CapturedOutput(sys.stdout)
+        results = Queue()
+
+        threads = []
+        for name, model, cpu in targets:
+            target_args = argparse.Namespace(**vars(args))
+            target_args.board_model = model
+            target_args.cpu = cpu
+            target_args.jobs = jobs
+            target_args.matrix = False
+
+            builder = self.__class__(type(self.e)())
+            builder.e.share_state(self.e)
+            builder.arg_parser = self.arg_parser
+            builder.trace = self.trace
+            builder.dir_index = self.dir_index
+            builder.scan_cache = self.scan_cache
+            thread = threading.Thread(target=builder.build_target,
+                                      args=[name, target_args, output, results])
+            thread.daemon = True
+            threads.append(thread)
+
+        print 'Building %s with %d jobs each' % (', '.join(name for name, _, _ in targets), jobs)
+        summary = {}
+        sys.stdout = output
+        try:
+            for thread in threads:
+                thread.start()
+            for _ in threads:
+                # a timeout keeps the wait interruptible by Ctrl+C
+                name, status, elapsed, usage, lines = results.get(True, 86400)
+                print colorize('==> %s' % name, 'yellow')
+                output.write(''.join(lines))
+                summary[name] = status, elapsed, usage
+        finally:
+            sys.stdout = output.stream
+
+        self.report_matrix([name for name, _, _ in targets], summary)
+        failed = [name for name, (status, _, _) in summary.iteritems() if status == 'failed']
+        if failed:
+            raise Abort('%d of %d targets failed: %s' % (len(failed), len(targets),
+                                                       ', '.join(sorted(failed))))
+
+    def build_target(self, name, args, output, results):
+        """
+        Build a target of --matrix capturing its output, then put its name,
+        result, build time, flash and RAM usage and output to `results`.
+        """
+        start = time.time()
+        status = 'failed'
+        usage = None
+        with output.capture() as lines:
+            try:
+                self.e.process_args(args)
+                makedirs(self.e.build_dir)
+                status = 'built' if self.build(args) else 'up to date'
+                flash, sram = self.e.sizes.get('profiles', {}).get(args.profile, [None, None])
+                usage = (flash, sram) + self.memory_limits(args)
+            except Abort as exc:
+                print colorize(str(exc), 'red')
+            except Exception:
+                # other targets are still built
+                print traceback.format_exc()
+        results.put((name, status, time.time() - start, usage, lines))
+
+    def report_matrix(self, names, summary):
+        def used(size, size_max):
+            if size is None:
+                return '?'
+            if size_max > 0:
+                return '{:,d} ({:d}%)'.format(size, size * 100 / size_max)
+            return '{:,d}'.format(size)
+
+        width = max(len(name) for name in names + ['target'])
+        row = '{:<%d}  {:<10} {:>8} {:>16} {:>14}' % width
+        print row.format('target', 'result', 'time', 'flash', 'RAM')
+        for name in names:
+            status, elapsed, usage = summary[name]
+            flash = sram = '-'
+            if usage is not None:
+                flash_size, sram_size, flash_max, sram_max = usage
+                flash = used(flash_size, flash_max)
+                sram = used(sram_size, sram_max)
+            line = row.format(name, status, '%.1fs' % elapsed, flash, sram)
+            print colorize(line, 'red') if status == 'failed' else line
 
     def run(self, args):
-        self.discover(args)
+        self.trace = Trace()
+        # every directory is listed once per build
+        self.dir_index = DirectoryIndex()
+        self.scan_cache = {}
+        try:
+            if args.matrix:
+                self.build_matrix(args)
+            else:
+                self.build(args)
+        finally:
+            if args.trace:
+                self.write_trace(args.trace, args.trace_top)
+
+    def build(self, args):
+        """
+        Build the firmware unless it is up to date. Return True if it was
+        built.
+        """
+        # a profile from ano.ini is not checked by argparse
+        if args.profile not in self.profiles:
+            raise Abort('Unknown profile %s, choose from %s' % (args.profile, ', '.join(self.profiles)))
+
+        usage = self.e.sizes.get('profiles', {}).get(args.profile)
+        if args.check_budget and usage is None:
+            # e.g. of a build directory older than --check-budget
+            print 'Memory usage of the %s profile is unknown, building to check the budget' % \
+                args.profile
+        elif self.up_to_date(args):
+            print colorize('%s is up to date' % self.e.hex_path, 'green')
+            if args.set_baseline:
+                self.set_baseline(args.profile)
+            if args.check_budget:
+                self.check_budget(args, usage[0], usage[1],
+                                  self.e.sizes.get('sections', {}).get(args.profile, {}))
+            return False
+
+        # make would link objects compiled with flags of another profile
+        previous = self.e.build_state.get('args')
+        if previous and previous.get('profile', self.default_profile) != args.profile:
+            print 'Profile changed from %s to %s, building from scratch' % (
+                previous.get('profile', self.default_profile), args.profile)
+            shutil.rmtree(self.e.build_dir)
+            makedirs(self.e.build_dir)
+
+        # sources are recorded before they are read so that changes made
+        # while the build runs would trigger the next build
+        self.e.build_state.clear()
+        self.e.build_state.save()
+        self.build_state = {'dirs': {}, 'files': {}}
+        self.track_sources([self.e.src_dir, self.e.lib_dir])
+
+        with self.trace.span('discover', 'phase'):
+            self.discover(args)
+        self.setup_make(args)
         self.setup_flags(args)
         self.create_jinja(verbose=args.verbose)
-        self.make('Makefile.sketch')
-        self.scan_dependencies()
-        self.make('Makefile')
+        with self.trace.span('preprocess', 'phase'):
+            self.preprocess_sketches()
+        with self.trace.span('scan dependencies', 'phase'):
+            self.scan_dependencies()
+        if args.prebuilt_core:
+            with self.trace.span('prebuild core', 'phase'):
+                self.prebuild_core(args)
+        if args.pch:
+            self.setup_pch()
+
+        self.track_sources(self.e.used_libs + [self.e.arduino_core_dir,
+                                               self.e.get('arduino_variants_dir')])
+        self.track_sources([self.e.lib_dir, self.e.arduino_libraries_dir,
+                            self.e.arduino_core_libraries_dir,
+                            self.e.arduino_user_libraries_dir], recursive=False)
+        self.track_files([self.e.cc, self.e.cxx, self.e.ar, self.e.objcopy] +
+                         self.e.prebuilt_libs.values())
+
+        with self.trace.span('build firmware', 'phase'):
+            self.make('Makefile')
         self.check_memory(args)
+        self.save_build_state(args)
+        return True
@@ -0,0 +1,61 @@
+# -*- coding: utf-8; -*-
+
+import argparse
+import sys
+
+from ano.cache import ObjectCache
+from ano.commands.base import Command
+from ano.exc import Abort
+
+
+class Cache(Command):
+    """
+    Manage the object cache shared by all projects of the current user.
+
+    The cache is used by `ano build --object-cache' to take compiled
+    objects of identical sources (e.g. the Arduino core or standard
+    libraries) from previous builds instead of running the compiler.
+
+        * stats  -- print cache usage
+        * clear  -- remove all cached objects
+    """
+
+    name = 'cache'
+    help_line = "Show statistics of or clear the object cache"
+
+    default_max_size = 1024
+
+    def setup_arg_parser(self, parser):
+        super(Cache, self).setup_arg_parser(parser)
+        parser.add_argument('action', choices=['stats', 'clear', 'compile'],
+                            help='Action to perform')
+        parser.add_argument('--max-size', metavar='MB', type=int,
+                            default=self.default_max_size,
+                            help='Maximum size of the cache in megabytes. Least '
+                            'recently used objects are removed when the cache '
+                            'grows bigger. Default: %(default)s.')
+        # `compile -- COMMAND' is used internally by generated Makefiles
+        parser.add_argument('command', nargs='*',
+                            help=argparse.SUPPRESS)
+
+    def run(self, args):
+        cache = ObjectCache(self.e.cache_dir, args.max_size * 1024 * 1024)
+
+        if args.action == 'compile':
+            if not args.command:
+                raise Abort("No compiler command given")
+            sys.exit(cache.compile(args.command))
+
+        if args.action == 'clear':
+            cache.clear()
+            print 'Object cache cleared'
+            return
+
+        stats = cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] * 100 / lookups if lookups else 0
+        print 'Cache directory:', cache.root
+        print 'Cached objects: {:,d}'.format(stats['entries'])
+        print 'Cache size: {:,d} of {:,d} bytes'.format(stats['size'], stats['max_size'])
+        print 'Hits: {:,d}, misses: {:,d} ({:d}% hit rate)'.format(
+            stats['hits'], stats['misses'], hit_rate)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8; -*-
+
+import os.path
+import shutil
+
+from ano.commands.base import Command
+from ano.filters import colorize
+from ano.utils import format_available_options
+
+
+class Doctor(Command):
+    """
+    Show locations of tools and Arduino directories found by earlier runs.
+
+    Found locations are cached in the user cache directory and shared by
+    all projects, so that a new checkout skips searching for them. A cached
+    location is used for as long as it exists.
+
+    Run with --refresh after Arduino software is installed, upgraded or
+    moved to forget all cached locations and board indexes. They are
+    searched for again on the next run.
+    """
+
+    name = 'doctor'
+    help_line = "Show or refresh cached locations of tools"
+
+    def setup_arg_parser(self, parser):
+        super(Doctor, self).setup_arg_parser(parser)
+        parser.add_argument('--refresh', default=False, action='store_true',
+                            help='Forget cached locations and board indexes')
+
+    def run(self, args):
+        if args.refresh:
+            self.e.discovery_cache.clear()
+            boards_dir = os.path.join(self.e.cache_dir, 'boards')
+            if os.path.isdir(boards_dir):
+                shutil.rmtree(boards_dir)
+            print 'Cached locations are forgotten and will be searched for on next run'
+            return
+
+        entries = sorted(self.e.discovery_cache.data.values(), key=lambda x: x['key'])
+        if not entries:
+            print 'No locations are cached yet'
+            return
+
+        items = []
+        for entry in entries:
+            result = entry['result']
+            if result is None:
+                text = 'not found'
+            elif isinstance(result, list):
+                text = ', '.join(result)
+            else:
+                text = result
+            if not self.e.discovery_is_current(entry):
+                text += colorize(' (outdated)', 'red')
+            items.append((entry['key'], text))
+
+        width = max(len(key) for key, _ in items)
+        print 'Cached in', self.e.discovery_cache.path
+        print format_available_options(items, head_width=width)
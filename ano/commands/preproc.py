@@ -3,9 +3,41 @@
 import sys
 import re
 
+from collections import namedtuple
+
 from ano.commands.base import Command
 
 
+# C/C++ constructs that are skipped as a whole wherever they appear.
+# Every alternative consumes input in linear time, so there is no
+# backtracking blow up even on unterminated comments or strings
+_common_tokens = r"""
+    (?P<comment>//[^\n]*|/\*[^*]*\*+(?:[^/*][^*]*\*+)*/|/\*[\s\S]*)
+  | (?P<literal>"[^"\\\n]*(?:\\.[^"\\\n]*)*"?|'[^'\\\n]*(?:\\.[^'\\\n]*)*'?)
+  | (?P<directive>^[ \t]*\#[^\\\n]*(?:\\[\s\S][^\\\n]*)*)
+  | (?P<newline>\n)
+  | (?P<space>[ \t\r\f\v]+)
+"""
+
+# tokens outside of any curly braces where prototypes are looked for
+_top_level_tokens = re.compile(_common_tokens + r"""
+  | (?P<word>[\w\[\]\*&]+)
+  | (?P<punct>.)
+""", re.MULTILINE | re.VERBOSE)
+
+# tokens within curly braces where only nesting matters, so
+# everything else is consumed in as large chunks as possible
+_nested_tokens = re.compile(_common_tokens + r"""
+  | (?P<code>[^{}"'/\#\s][^{}"'/\#\n]*)
+  | (?P<punct>.)
+""", re.MULTILINE | re.VERBOSE)
+
+_include = re.compile(r'^\s*#include\s*[<"](\S+)[">]')
+
+
+Prototype = namedtuple('Prototype', 'line text')
+
+
 class Preprocess(Command):
     """
     Preprocess an .ino or .pde sketch file and produce ready-to-compile .cpp source.
@@ -33,81 +65,164 @@ class Preprocess(Command):
         else:
             out = open(args.output, 'wt')
 
-        sketch = open(args.sketch, 'rt').read()
-        prototypes = self.prototypes(sketch)
+        out.write(self.preprocess(args.sketch))
+
+    def preprocess(self, sketch_path):
+        """
+        Return C++ source produced from the sketch file at `sketch_path`.
+        """
+        with open(sketch_path, 'rt') as f:
+            sketch = f.read()
+
+        prototypes, include_lines = self.scan(sketch)
         lines = sketch.split('\n')
-        includes, lines = self.extract_includes(lines)
+        includes = [lines[i] for i in include_lines]
+        for i in include_lines:
+            # if the line is #include directive it should be
+            # commented out in original sketch so that
+            #  1) it would not be included twice
+            #  2) line numbers will be preserved
+            lines[i] = '//' + lines[i]
 
         header = 'Arduino.h' if self.e.arduino_lib_version.major else 'WProgram.h'
-        out.write('#include <%s>\n' % header)
+        return ''.join([
+            '#include <%s>\n' % header,
+            '\n'.join(includes),
+            '\n',
+            ''.join('#line %d "%s"\n%s;\n' % (p.line + 1, sketch_path, p.text)
+                    for p in prototypes),
+            '#line 1 "%s"\n' % sketch_path,
+            '\n'.join(lines),
+        ])
 
-        out.write('\n'.join(includes))
-        out.write('\n')
+    def prototypes(self, src):
+        return [p.text + ';' for p in self.scan(src)[0]]
 
-        out.write('\n'.join(prototypes))
-        out.write('\n')
+    def scan(self, src):
+        """
+        Tokenize sketch source in a single pass and return a tuple of:
 
-        out.write('#line 1 "%s"\n' % args.sketch)
-        out.write('\n'.join(lines))
+            * list of `Prototype`s for functions defined on the top level
+            * list of zero-based line numbers of #include directives
 
-    def prototypes(self, src):
-        src = self.collapse_braces(self.strip(src))
-        regex = re.compile("[\\w\\[\\]\\*]+\\s+[&\\[\\]\\*\\w\\s]+\\([&,\\[\\]\\*\\w\\s]*\\)(?=\\s*\\{)")
-        matches = regex.findall(src)
-        return [m + ';' for m in matches]
+        A prototype is a text just before a top-level `{' matching what
+        Arduino Software finds with a regular expression:
 
-    def extract_includes(self, src_lines):
-        regex = re.compile("^\\s*#include\\s*[<\"](\\S+)[\">]")
+            [\\w\\[\\]\\*]+\\s+[&\\[\\]\\*\\w\\s]+\\([&,\\[\\]\\*\\w\\s]*\\)
+
+        where comments, literals and pre-processor directives count as
+        whitespace.
+        """
+        prototypes = []
         includes = []
-        sketch = []
-        for line in src_lines:
-            match = regex.match(line)
-            if match:
-                includes.append(line)
-                # if the line is #include directive it should be
-                # commented out in original sketch so that
-                #  1) it would not be included twice
-                #  2) line numbers will be preserved
-                sketch.append('//' + line)
+
+        line = 0
+        depth = 0
+
+        # state of the top-level signature matcher:
+        #   head   -- words preceding a `(', `params' -- text after it
+        #   after  -- whether `)' was just closed
+        head, head_line = [], 0
+        signature = None
+        params = None
+        after = False
+
+        pos, end = 0, len(src)
+        while pos < end:
+            regex = _nested_tokens if depth else _top_level_tokens
+            match = regex.match(src, pos)
+            kind = match.lastgroup
+            text = match.group(kind)
+            pos = match.end()
+            token_line = line
+
+            if kind == 'newline':
+                line += 1
+            elif kind in ('comment', 'directive'):
+                line += text.count('\n')
+                if kind == 'directive' and _include.match(text):
+                    includes.append(token_line)
+
+            if depth:
+                if text == '{' and kind == 'punct':
+                    depth += 1
+                elif text == '}' and kind == 'punct':
+                    depth -= 1
+                continue
+
+            if kind not in ('word', 'punct'):
+                # whitespace or something that is stripped to whitespace
+                if kind in ('comment', 'literal', 'directive'):
+                    text = ' '
+                if params is not None and not after:
+                    params.append(text)
+                elif not after:
+                    if not head:
+                        head_line = token_line
+                    head.append(text)
+                continue
+
+            if after and text != '{':
+                # anything but `{' after `)' breaks a signature
+                head, params, after = [], None, False
+
+            if kind == 'word':
+                if params is not None:
+                    params.append(text)
+                else:
+                    if not head:
+                        head_line = token_line
+                    head.append(text)
+            elif text == '(':
+                if params is None:
+                    signature = (''.join(head), head_line)
+                else:
+                    # `(' is not allowed in parameters, but a signature
+                    # could start again after the last comma
+                    joined = ''.join(params)
+                    comma = joined.rfind(',')
+                    signature = (joined[comma + 1:], params_line + joined[:comma + 1].count('\n'))
+                params, params_line = [], token_line
+                head = []
+            elif text == ')' and params is not None:
+                after = True
+            elif text == ',' and params is not None:
+                params.append(text)
+            elif text == '{':
+                if after:
+                    prototype = self._prototype(signature, ''.join(params))
+                    if prototype:
+                        prototypes.append(prototype)
+                depth += 1
+                head, params, after = [], None, False
             else:
-                sketch.append(line)
+                head, params, after = [], None, False
 
-        return includes, sketch
+        return prototypes, includes
 
-    def collapse_braces(self, src):
-        """
-        Remove the contents of all top-level curly brace pairs {}.
-        """
-        result = []
-        nesting = 0;
-
-        for c in src:
-            if not nesting:
-                result.append(c)
-            if c == '{':
-                nesting += 1
-            elif c == '}':
-                nesting -= 1
-                result.append(c)
-        
-        return ''.join(result)
-
-    def strip(self, src):
+    def _prototype(self, signature, params):
         """
-        Strips comments, pre-processor directives, single- and double-quoted
-        strings from a string.
+        Find the leftmost position in `signature' text where a function
+        return type and name start. Return a `Prototype' or None.
         """
-        # single-quoted character
-        p = "('.')"
-        
-        # double-quoted string
-        p += "|(\"(?:[^\"\\\\]|\\\\.)*\")"
-        
-        # single and multi-line comment
-        p += "|(//.*?$)|(/\\*[^*]*(?:\\*(?!/)[^*]*)*\\*/)"
-        
-        # pre-processor directive
-        p += "|" + "(^\\s*#.*?$)"
-
-        regex = re.compile(p, re.MULTILINE)
-        return regex.sub(' ', src)
+        head, line = signature
+        i, n = 0, len(head)
+        while i < n:
+            # runs of [\w\[\]\*] are separated by whitespace or `&'
+            while i < n and (head[i].isspace() or head[i] == '&'):
+                i += 1
+            j = i
+            while j < n and not (head[j].isspace() or head[j] == '&'):
+                j += 1
+            if i == j:
+                break
+            k = j
+            while k < n and head[k].isspace():
+                k += 1
+            # a type must be followed by whitespace and at least
+            # one more character should remain for a name
+            if k > j and (k < n or k - j >= 2):
+                return Prototype(line + head[:i].count('\n'),
+                                 '%s(%s)' % (head[i:], params))
+            i = j
+        return None
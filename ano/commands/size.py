@@ -0,0 +1,248 @@
+# -*- coding: utf-8; -*-
+
+import json
+import os.path
+import sys
+
+from ano.commands.base import Command
+from ano.elf import STB_LOCAL, STT_FILE, STT_FUNC, STT_NOTYPE, STT_OBJECT, ElfError, ElfFile, \
+    archive_members
+from ano.exc import Abort
+
+
+other = '(other)'
+
+
+class Size(Command):
+    """
+    Show what takes flash and RAM in the firmware built last.
+
+    Sections of firmware.elf are read directly and their sizes attributed
+    to symbols, then to object files and libraries that define those
+    symbols. Objects of the project and archives of libraries in the build
+    directory are read for that. Bytes not covered by any symbol they
+    define, e.g. of the C runtime or of padding, are reported as
+    `(other)'.
+
+    A report saved with --json could be compared with a later build with
+    --diff to track size regressions.
+    """
+
+    name = 'size'
+    help_line = "Show flash and RAM usage of the firmware by file and symbol"
+
+    default_top = 10
+
+    def setup_arg_parser(self, parser):
+        super(Size, self).setup_arg_parser(parser)
+        self.e.add_board_model_arg(parser)
+        self.e.add_arduino_dist_arg(parser)
+
+        parser.add_argument('--top', metavar='N', type=int, default=self.default_top,
+                            help='Number of the largest symbols to show. '
+                            'Default: %(default)s.')
+        parser.add_argument('--json', metavar='FILE',
+                            help='Save the full report as JSON into FILE, '
+                            'or print it instead of the table if FILE is "-".')
+        parser.add_argument('--diff', metavar='FILE',
+                            help='Show how usage changed since the report '
+                            'saved with --json into FILE.')
+
+    def objects(self):
+        """
+        Return (name, library, mtime, file, offset) tuples for objects the
+        firmware could be linked from: objects of the project and members
+        of library archives, including the prebuilt core one. Newest come
+        first, so that their symbols win over leftovers of earlier builds.
+        """
+        src_name = os.path.basename(self.e.src_dir)
+        src_build_dir = os.path.join(self.e.build_dir, src_name)
+        paths = [os.path.join(self.e.build_dir, name, 'lib%s.a' % name)
+                 for name in sorted(os.listdir(self.e.build_dir))]
+        paths += [path for path in self.e.build_state.get('files', {})
+                  if path.endswith('.a')]
+
+        objects = []
+        for dirpath, _, filenames in os.walk(src_build_dir):
+            for filename in filenames:
+                if filename.endswith('.o'):
+                    path = os.path.join(dirpath, filename)
+                    objects.append((os.path.relpath(path, self.e.build_dir), src_name,
+                                    os.stat(path).st_mtime, path, 0))
+
+        for path in sorted(set(paths)):
+            if not os.path.isfile(path):
+                continue
+            library = os.path.basename(os.path.dirname(path))
+            with open(path, 'rb') as f:
+                for name, mtime, offset, _ in archive_members(f):
+                    objects.append(('%s/%s' % (library, name), library, mtime, path, offset))
+
+        objects.sort(key=lambda obj: obj[2], reverse=True)
+        return objects
+
+    def symbol_owners(self, objects):
+        """
+        Return maps of global symbol names and of (source file, name)
+        pairs of local symbols to (object, library) pairs defining them.
+        """
+        globals_ = {}
+        locals_ = {}
+        for name, library, _, path, offset in objects:
+            with open(path, 'rb') as f:
+                try:
+                    elf = ElfFile(f, offset)
+                except ElfError:
+                    continue
+                source = None
+                for symbol in elf.symbols():
+                    if symbol.type == STT_FILE:
+                        source = symbol.name
+                    elif symbol.is_defined:
+                        if symbol.bind == STB_LOCAL:
+                            locals_.setdefault((source, symbol.name), (name, library))
+                        else:
+                            globals_.setdefault(symbol.name, (name, library))
+        return globals_, locals_
+
+    def report(self, elf_path):
+        """
+        Return usage of memory by sections, libraries, objects and symbols
+        of the firmware at `elf_path` in a JSON-compatible form. Usage is
+        a [flash, ram] pair of byte counts.
+        """
+        globals_, locals_ = self.symbol_owners(self.objects())
+
+        with open(elf_path, 'rb') as f:
+            elf = ElfFile(f)
+            sections = dict((s.index, s) for s in elf.sections if s.in_flash or s.in_ram)
+            usage = lambda section, size: [size if section.in_flash else 0,
+                                           size if section.in_ram else 0]
+
+            symbols = []
+            seen = set()
+            source = None
+            for symbol in elf.symbols():
+                if symbol.type == STT_FILE:
+                    source = symbol.name
+                    continue
+                section = sections.get(symbol.shndx)
+                if section is None or not symbol.size or \
+                        symbol.type not in (STT_NOTYPE, STT_OBJECT, STT_FUNC):
+                    continue
+                # aliases, e.g. of C++ constructors, take no space of their own
+                key = (symbol.shndx, symbol.value, symbol.size)
+                if key in seen:
+                    continue
+                seen.add(key)
+
+                if symbol.bind == STB_LOCAL:
+                    owner = locals_.get((source, symbol.name))
+                else:
+                    owner = globals_.get(symbol.name)
+                obj, library = owner or (other, other)
+                symbols.append({'name': symbol.name, 'object': obj, 'library': library,
+                                'usage': usage(section, symbol.size)})
+
+        total = [0, 0]
+        for section in sections.itervalues():
+            total = add(total, usage(section, section.size))
+
+        libraries = {other: total}
+        objects = {other: total}
+        for symbol in symbols:
+            for group, key in ((libraries, symbol['library']), (objects, symbol['object'])):
+                # bytes of symbols without an owner are in (other) already
+                if key != other:
+                    group[key] = add(group.get(key, [0, 0]), symbol['usage'])
+                    group[other] = add(group[other], symbol['usage'], -1)
+
+        symbols.sort(key=lambda s: (-sum(s['usage']), s['name']))
+        return {
+            'elf': elf_path,
+            'usage': total,
+            'sections': dict((s.name, usage(s, s.size)) for s in sections.itervalues()),
+            'libraries': libraries,
+            'objects': objects,
+            'symbols': symbols,
+        }
+
+    def print_report(self, report, top):
+        flash, ram = report['usage']
+        print '{}: flash {:,d} bytes, RAM {:,d} bytes'.format(report['elf'], flash, ram)
+        for title, group in (('Libraries', report['libraries']), ('Objects', report['objects'])):
+            print
+            print '{:<40} {:>8} {:>8}'.format(title, 'flash', 'RAM')
+            for name, (flash, ram) in sorted(group.iteritems(),
+                                             key=lambda item: (-sum(item[1]), item[0])):
+                print '  {:<38} {:>8,d} {:>8,d}'.format(name, flash, ram)
+
+        print
+        print '{:<40} {:>8} {:>8}  {}'.format('Largest symbols', 'flash', 'RAM', 'object')
+        for symbol in report['symbols'][:top]:
+            flash, ram = symbol['usage']
+            print '  {:<38} {:>8,d} {:>8,d}  {}'.format(symbol['name'], flash, ram, symbol['object'])
+
+    def print_diff(self, previous, report, top, path):
+        flash, ram = report['usage']
+        old_flash, old_ram = previous['usage']
+        print '{}: flash {:,d} bytes ({:+,d}), RAM {:,d} bytes ({:+,d}) since {}'.format(
+            report['elf'], flash, flash - old_flash, ram, ram - old_ram, path)
+
+        symbol_usage = lambda r: dict(((s['object'], s['name']), s['usage']) for s in r['symbols'])
+        groups = [
+            ('Libraries', previous['libraries'], report['libraries']),
+            ('Objects', previous['objects'], report['objects']),
+            ('Symbols', symbol_usage(previous), symbol_usage(report)),
+        ]
+        for title, old, new in groups:
+            changes = []
+            for key in set(old) | set(new):
+                delta = add(new.get(key, [0, 0]), old.get(key, [0, 0]), -1)
+                if delta != [0, 0]:
+                    name = '%s (%s)' % (key[1], key[0]) if isinstance(key, tuple) else key
+                    changes.append((name, delta, key not in old, key not in new))
+            if not changes:
+                continue
+            changes.sort(key=lambda c: (-abs(c[1][0]) - abs(c[1][1]), c[0]))
+            print
+            print '{:<40} {:>8} {:>8}'.format(title, 'flash', 'RAM')
+            for name, (flash, ram), added, removed in changes[:top]:
+                note = ' (new)' if added else ' (removed)' if removed else ''
+                print '  {:<38} {:>+8,d} {:>+8,d}{}'.format(name, flash, ram, note)
+            if len(changes) > top:
+                print '  ... %d more changed' % (len(changes) - top)
+
+    def run(self, args):
+        elf_path = os.path.join(self.e.build_dir, 'firmware.elf')
+        if not os.path.isfile(elf_path):
+            raise Abort("%s not found, run `ano build' first" % elf_path)
+        try:
+            report = self.report(elf_path)
+        except ElfError as e:
+            raise Abort('Could not read %s: %s' % (elf_path, e))
+
+        previous = None
+        if args.diff:
+            try:
+                with open(args.diff) as f:
+                    previous = json.load(f)
+            except (IOError, ValueError) as e:
+                raise Abort('Could not read a size report from %s: %s' % (args.diff, e))
+
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            print
+            return
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+        if previous is not None:
+            self.print_diff(previous, report, args.top, args.diff)
+        else:
+            self.print_report(report, args.top)
+
+
+def add(usage, other_usage, sign=1):
+    return [a + sign * b for a, b in zip(usage, other_usage)]
@@ -3,6 +3,8 @@
 from __future__ import absolute_import
 
 import os.path
+import re
+import shutil
 import subprocess
 import platform
 
@@ -10,9 +12,11 @@ from time import sleep
 from serial import Serial
 from serial.serialutil import SerialException
 
+from ano import ihex, programmers
 from ano.commands.base import Command
 from ano.exc import Abort
 from ano.environment import BoardModels
+from ano.utils import makedirs
 
 
 class Upload(Command):
@@ -34,6 +38,19 @@ class Upload(Command):
                             help='Serial port to upload firmware to\nTry to guess if not specified')
         parser.add_argument('-q', '--quiet', default=False, action='store_true',
                             help='Quell progress output')
+        parser.add_argument('--programmer', choices=['avrdude', 'native'], default='avrdude',
+                            help='Upload with avrdude or talk to the bootloader '
+                            'directly. The native programmer supports STK500v1, '
+                            'STK500v2 and AVR109 bootloaders, connects as soon as '
+                            'the bootloader starts, skips pages of flash the board '
+                            'holds already and reads written ones back to verify '
+                            'them. Default: "%(default)s".')
+        parser.add_argument('--full', default=False, action='store_true',
+                            help='With --programmer=native, compare every page of '
+                            'the firmware with flash instead of writing only those '
+                            'that changed since the last upload to the port. '
+                            'Needed after the board was flashed by another tool '
+                            'or project.')
 
         self.e.add_board_model_arg(parser)
         self.e.add_arduino_dist_arg(parser)
@@ -51,8 +68,10 @@ class Upload(Command):
             self.e.find_arduino_file('avrdude.conf', ['hardware', 'tools', 'avr', 'etc'])
     
     def run(self, args):
-        self.discover()
-        port = args.serial_port or self.e.guess_serial_port()
+        native = args.programmer == 'native'
+        if not native:
+            self.discover()
+        port = device = args.serial_port or self.e.guess_serial_port()
         boardVariant = args.cpu if ('cpu' in args) else None;
         board = self.e.board_model(args.board_model)
 
@@ -66,21 +85,22 @@ class Upload(Command):
         if not os.path.exists(port):
             raise Abort("%s doesn't exist. Is Arduino connected?" % port)
 
-        # send a hangup signal when the last process closes the tty
-        file_switch = '-f' if platform.system() == 'Darwin' else '-F'
-        ret = subprocess.call([self.e['stty'], file_switch, port, 'hupcl'])
-        if ret:
-            raise Abort("stty failed")
+        if not native:
+            # send a hangup signal when the last process closes the tty
+            file_switch = '-f' if platform.system() == 'Darwin' else '-F'
+            ret = subprocess.call([self.e['stty'], file_switch, port, 'hupcl'])
+            if ret:
+                raise Abort("stty failed")
 
-        # pulse on DTR
-        try:
-            s = Serial(port, 115200)
-        except SerialException as e:
-            raise Abort(str(e))
-        s.setDTR(False)
-        sleep(0.1)
-        s.setDTR(True)
-        s.close()
+            # pulse on DTR
+            try:
+                s = Serial(port, 115200)
+            except SerialException as e:
+                raise Abort(str(e))
+            s.setDTR(False)
+            sleep(0.1)
+            s.setDTR(True)
+            s.close()
 
         # Need to do a little dance for Leonardo and derivatives:
         # open then close the port at the magic baudrate (usually 1200 bps) first
@@ -110,7 +130,8 @@ class Upload(Command):
                     sleep(0.3)
 
             elapsed = 0
-            enum_delay = 0.25
+            # the native programmer connects once the bootloader shows up
+            enum_delay = 0.05 if native else 0.25
             while elapsed < 10:
                 now = self.e.list_serial_ports()
                 diff = list(set(now) - set(before))
@@ -130,8 +151,15 @@ class Upload(Command):
 
             port = new_port
 
+        if native:
+            return self.upload_natively(args, port, device, protocol, board, boardVariant,
+                                        reset=not touch_port)
+
+        # what the device holds is unknown until avrdude succeeds
+        self.forget_upload(device)
+
         # call avrdude to upload .hex
-        subprocess.call([
+        ret = subprocess.call([
             self.e['avrdude'],
             '-C', self.e['avrdude.conf'],
             '-p', BoardModels.getValueForVariant(board, boardVariant, 'build', 'mcu'),
@@ -142,3 +170,94 @@ class Upload(Command):
             '-qq' if args.quiet else '',
             '-U', 'flash:w:%s:i' % self.e['hex_path'],
         ])
+        if ret == 0:
+            self.remember_upload(device, board, boardVariant)
+
+    def uploaded_hex_path(self, device):
+        name = re.sub(r'[^\w.-]', '_', device.strip('/\\'))
+        return os.path.join(self.e.build_dir, 'uploaded', name + '.hex')
+
+    def forget_upload(self, device):
+        if device in self.e.uploads:
+            del self.e.uploads[device]
+            self.e.uploads.save()
+
+    def remember_upload(self, device, board, boardVariant):
+        """
+        Keep a copy of the firmware just uploaded to `device` to tell which
+        pages of the next one differ.
+        """
+        path = self.uploaded_hex_path(device)
+        makedirs(os.path.dirname(path))
+        shutil.copyfile(self.e.hex_path, path)
+        self.e.uploads[device] = {
+            'hex': path,
+            'mcu': BoardModels.getValueForVariant(board, boardVariant, 'build', 'mcu'),
+        }
+        self.e.uploads.save()
+
+    def last_upload(self, device, mcu, page_size):
+        """
+        Return pages of the firmware last uploaded to `device` completely
+        or None if it is unknown.
+        """
+        last = self.e.uploads.get(device)
+        if not last or last['mcu'] != mcu:
+            return None
+        try:
+            return ihex.paginate(ihex.read(last['hex']), page_size)
+        except (IOError, ihex.HexError):
+            return None
+
+    def upload_natively(self, args, port, device, protocol, board, boardVariant, reset):
+        try:
+            programmer_class = programmers.protocols[protocol]
+        except KeyError:
+            raise Abort("The %s protocol is not supported natively, "
+                        "use --programmer=avrdude" % protocol)
+
+        mcu = BoardModels.getValueForVariant(board, boardVariant, 'build', 'mcu')
+        try:
+            signature, page_size = programmers.devices[mcu]
+        except KeyError:
+            raise Abort("Flash pages of %s are unknown, use --programmer=avrdude" % mcu)
+        try:
+            pages = ihex.paginate(ihex.read(self.e.hex_path), page_size)
+        except (IOError, ihex.HexError) as e:
+            raise Abort("Could not read %s: %s" % (self.e.hex_path, e))
+        last = None if args.full else self.last_upload(device, mcu, page_size)
+
+        speed = int(BoardModels.getValueForVariant(board, boardVariant, 'upload', 'speed'))
+        try:
+            serial = Serial(port, speed)
+        except SerialException as e:
+            raise Abort(str(e))
+
+        try:
+            programmer = programmer_class(serial)
+            if reset:
+                programmer.reset()
+            programmer.connect()
+            found = programmer.read_signature()
+            if found != signature:
+                raise Abort("Device signature %s does not match %s of %s" % (
+                    found.encode('hex'), signature.encode('hex'), mcu))
+            programmer.enter()
+
+            # an interrupted upload leaves flash unknown
+            self.forget_upload(device)
+            if last is None:
+                written = programmer.program(pages)
+            else:
+                written = programmer.update(pages, last)
+            programmer.leave()
+        except (programmers.ProgrammerError, SerialException, OSError) as e:
+            # the board could also be gone or reset in the middle
+            raise Abort("Upload failed: %s" % e)
+        finally:
+            serial.close()
+        self.remember_upload(device, board, boardVariant)
+
+        if not args.quiet:
+            print "Wrote %d of %d pages of flash, %d were up to date" % (
+                len(written), len(pages), len(pages) - len(written))
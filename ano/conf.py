@@ -2,23 +2,47 @@
 
 import os.path
 
-from configobj import ConfigObj
-
 
 class Configuration(object):
+    booleans = {
+        'true': True, 'yes': True, 'on': True,
+        'false': False, 'no': False, 'off': False,
+    }
+
     def __init__(self, *files):
-        self.cfg = ConfigObj()
-        for f in files:
-            self.cfg.merge(ConfigObj(os.path.expanduser(f)))
-
-    def as_dict(self, section_name):
-        section = self.cfg.get(section_name, ConfigObj())
-        result = self._as_plain_dict(self.cfg)
-        result.update(self._as_plain_dict(section))
+        # configobj is only imported if there is anything to read
+        files = [f for f in map(os.path.expanduser, files) if os.path.exists(f)]
+        self.cfg = {}
+        if files:
+            from configobj import ConfigObj
+            self.cfg = ConfigObj()
+            for f in files:
+                self.cfg.merge(ConfigObj(f))
+
+    def as_dict(self, section_name, switches=()):
+        """
+        Return values of the top level and of `section_name` by option
+        name. Values of `switches`, e.g. `verbose = true', are read as
+        booleans; any other value is left as is.
+        """
+        if not self.cfg:
+            return {}
+        result = self._as_plain_dict(self.cfg, switches)
+        if section_name in self.cfg:
+            result.update(self._as_plain_dict(self.cfg[section_name], switches))
+        return result
+
+    def _as_plain_dict(self, section, switches):
+        result = {}
+        for key in section.scalars:
+            name = key.replace('-', '_')
+            result[name] = self._value(section[key]) if name in switches else section[key]
         return result
 
-    def _as_plain_dict(self, section):
-        return dict((key.replace('-', '_'), section[key]) for key in section.scalars)
+    def _value(self, value):
+        if isinstance(value, basestring) and value.lower() in self.booleans:
+            return self.booleans[value.lower()]
+        return value
 
 
 def configure():
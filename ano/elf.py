@@ -0,0 +1,211 @@
+# -*- coding: utf-8; -*-
+
+"""
+Readers of ELF files and of `ar' archives of them, enough to tell sizes
+of sections and symbols without binutils.
+
+Only the file header, section headers and symbol and string tables are
+read, so a firmware with debugging information is never loaded whole.
+"""
+
+import struct
+
+from collections import namedtuple
+
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+SHN_COMMON = 0xfff2
+SHN_XINDEX = 0xffff
+
+STB_LOCAL = 0
+
+STT_NOTYPE = 0
+STT_OBJECT = 1
+STT_FUNC = 2
+STT_SECTION = 3
+STT_FILE = 4
+
+# allocated, but programmed into memories other than flash
+non_program_sections = ['.eeprom', '.fuse', '.lock', '.signature', '.user_signatures']
+
+
+class ElfError(Exception):
+    pass
+
+
+class Section(namedtuple('Section', 'index name type flags addr size link')):
+    @property
+    def in_flash(self):
+        # code, constants and initial values of variables
+        return bool(self.flags & SHF_ALLOC) and self.type != SHT_NOBITS and \
+            self.name not in non_program_sections
+
+    @property
+    def in_ram(self):
+        return bool(self.flags & SHF_ALLOC) and bool(self.flags & SHF_WRITE) and \
+            self.name not in non_program_sections
+
+
+class Symbol(namedtuple('Symbol', 'name value size type bind shndx')):
+    @property
+    def is_defined(self):
+        return self.shndx != SHN_UNDEF and \
+            (self.shndx < SHN_LORESERVE or self.shndx == SHN_COMMON)
+
+
+class ElfFile(object):
+    """
+    Sections and symbols of an ELF file in `f`, a file object open in
+    binary mode, that starts at `offset`, e.g. of an archive member.
+    Both 32 and 64-bit files of either byte order are read.
+    """
+
+    chunk_symbols = 1024
+
+    def __init__(self, f, offset=0):
+        self.f = f
+        self.offset = offset
+
+        ident = self.read(0, 16)
+        if len(ident) < 16 or ident[:4] != '\x7fELF':
+            raise ElfError('Not an ELF file')
+        elf_class, data = ord(ident[4]), ord(ident[5])
+        if elf_class not in (1, 2) or data not in (1, 2):
+            raise ElfError('Unsupported ELF class %d or byte order %d' % (elf_class, data))
+
+        self.is64 = elf_class == 2
+        self.endian = '<' if data == 1 else '>'
+        header = self.unpack('HHIQQQIHHHHHH' if self.is64 else 'HHIIIIIHHHHHH', 16)
+        self.type, self.machine = header[:2]
+        shoff, shentsize, shnum, shstrndx = header[5], header[10], header[11], header[12]
+
+        self.sections = []
+        self.headers = []
+        if not shoff:
+            return
+        section_fmt = 'IIQQQQIIQQ' if self.is64 else 'IIIIIIIIII'
+        headers = []
+        count = shnum
+        while len(headers) < (count or 1):
+            name, type, flags, addr, offset, size, link, info, _, entsize = \
+                self.unpack(section_fmt, shoff + len(headers) * shentsize)
+            if not headers and not shnum:
+                # more than SHN_LORESERVE sections, their number is kept here
+                count = size
+                if shstrndx == SHN_XINDEX:
+                    shstrndx = link
+            headers.append((name, type, flags, addr, offset, size, link, entsize))
+        self.headers = headers
+
+        names = self.read_section(shstrndx)
+        for index, (name, type, flags, addr, _, size, link, _) in enumerate(headers):
+            self.sections.append(Section(index, self.string(names, name), type, flags,
+                                         addr, size, link))
+
+    def read(self, position, size):
+        self.f.seek(self.offset + position)
+        return self.f.read(size)
+
+    def unpack(self, fmt, position):
+        fmt = self.endian + fmt
+        data = self.read(position, struct.calcsize(fmt))
+        if len(data) != struct.calcsize(fmt):
+            raise ElfError('Truncated ELF file')
+        return struct.unpack(fmt, data)
+
+    def read_section(self, index):
+        _, type, _, _, offset, size, _, _ = self.headers[index]
+        if type == SHT_NOBITS:
+            return ''
+        return self.read(offset, size)
+
+    def string(self, table, offset):
+        end = table.find('\0', offset)
+        return table[offset:end if end >= 0 else len(table)]
+
+    def symbols(self):
+        """
+        Yield symbols of the symbol table in order. Entries are read in
+        chunks; names are looked up in the string table, which is read
+        whole.
+        """
+        for _, type, _, _, offset, size, link, entsize in self.headers:
+            if type == SHT_SYMTAB:
+                break
+        else:
+            return
+
+        names = self.read_section(link)
+        fmt = self.endian + ('IBBHQQ' if self.is64 else 'IIIBBH')
+        entsize = entsize or struct.calcsize(fmt)
+        count = size // entsize
+        # the first entry is always a null symbol
+        for start in range(1, count, self.chunk_symbols):
+            end = min(start + self.chunk_symbols, count)
+            data = self.read(offset + start * entsize, (end - start) * entsize)
+            for i in range(end - start):
+                entry = struct.unpack_from(fmt, data, i * entsize)
+                if self.is64:
+                    name, info, _, shndx, value, sym_size = entry
+                else:
+                    name, value, sym_size, info, _, shndx = entry
+                yield Symbol(self.string(names, name), value, sym_size,
+                             info & 0xf, info >> 4, shndx)
+
+
+def archive_members(f):
+    """
+    Yield (name, mtime, offset, size) tuples for members of an `ar'
+    archive in `f`, a file object open in binary mode, in order. Symbol
+    and long name tables are skipped. Both GNU and BSD long names are
+    supported.
+    """
+    if f.read(8) != '!<arch>\n':
+        raise ElfError('Not an ar archive')
+
+    long_names = ''
+    position = 8
+    while True:
+        f.seek(position)
+        header = f.read(60)
+        if len(header) < 60:
+            return
+        if header[58:60] != '`\n':
+            raise ElfError('Corrupt ar archive member at %d' % position)
+
+        name = header[:16].rstrip(' ')
+        mtime = int(header[16:28].strip() or 0)
+        size = int(header[48:58].strip())
+        offset = position + 60
+        # members are aligned to even offsets
+        position = offset + size + (size & 1)
+
+        if name == '//':
+            f.seek(offset)
+            long_names = f.read(size)
+            continue
+        if name in ('/', '/SYM64/'):
+            continue
+
+        if name.startswith('#1/'):
+            length = int(name[3:])
+            f.seek(offset)
+            name = f.read(length).rstrip('\0')
+            offset += length
+            size -= length
+        elif name.startswith('/') and name[1:].isdigit():
+            start = int(name[1:])
+            end = long_names.find('\n', start)
+            name = long_names[start:end if end >= 0 else len(long_names)]
+        name = name.rstrip('/')
+
+        if name == '__.SYMDEF' or name.startswith('__.SYMDEF '):
+            continue
+        yield name, mtime, offset, size
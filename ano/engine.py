@@ -0,0 +1,306 @@
+# -*- coding: utf-8; -*-
+
+"""
+A small make replacement used by `ano build --engine=native'.
+
+Build steps are `Task's producing a single target from a list of inputs.
+Tasks whose inputs are targets of other tasks form a graph that
+`Executor' walks running at most `jobs' tools at a time.
+"""
+
+import os
+import re
+import json
+import subprocess
+import tempfile
+import time
+
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+from ano.utils import makedirs
+
+
+_depfile_rule = re.compile(r':(?:\s|$)')
+_depfile_word = re.compile(r'(?:\\.|[^\s\\])+')
+
+
+def parse_depfile(path):
+    """
+    Return a list of prerequisites found in a make-style dependency file
+    like the ones `cc -MM' produces. Targets of the rules are ignored.
+    An empty list is returned if there is no such file.
+    """
+    try:
+        with open(path) as f:
+            contents = f.read()
+    except IOError:
+        return []
+
+    prerequisites = []
+    for rule in contents.replace('\\\n', ' ').splitlines():
+        parts = _depfile_rule.split(rule, 1)
+        if len(parts) < 2:
+            continue
+        prerequisites.extend(word.replace('\\ ', ' ')
+                             for word in _depfile_word.findall(parts[1]))
+    return prerequisites
+
+
+class Task(object):
+    """
+    A build step that produces `target` from `inputs`.
+
+    `depfile` lists additional prerequisites, e.g. headers a source
+    includes. `signature` is what the step does; a target is rebuilt
+    when it differs from the one of the last build, e.g. when a source is
+    removed from a link. `source` is reported if the step fails.
+    `category` and `group` (e.g. a library name) describe the step in
+    a build trace.
+    """
+
+    def __init__(self, target, inputs, message=None, source=None, depfile=None,
+                 category='build', group=None):
+        self.target = target
+        self.inputs = list(inputs)
+        self.message = message
+        self.source = source or target
+        self.depfile = depfile
+        self.category = category
+        self.group = group
+
+    @property
+    def signature(self):
+        return None
+
+    def execute(self):
+        """
+        Produce the target. Return a tuple of exit code and text output.
+        """
+        raise NotImplementedError
+
+
+class ToolTask(Task):
+    """
+    Run an external tool. If `stdout_prefix` is given, tool output is
+    written to the target after the prefix instead of being shown.
+    """
+
+    def __init__(self, target, inputs, args, stdout_prefix=None, **kwargs):
+        super(ToolTask, self).__init__(target, inputs, **kwargs)
+        self.args = list(args)
+        self.stdout_prefix = stdout_prefix
+
+    @property
+    def signature(self):
+        return self.args
+
+    def execute(self):
+        if self.stdout_prefix is None:
+            proc = subprocess.Popen(self.args, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            output = proc.communicate()[0]
+            return proc.returncode, output
+
+        proc = subprocess.Popen(self.args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        contents, output = proc.communicate()
+        if proc.returncode == 0:
+            with open(self.target, 'wt') as f:
+                f.write(self.stdout_prefix + contents)
+        return proc.returncode, output
+
+
+class ConcatTask(Task):
+    """
+    Concatenate inputs into the target.
+    """
+
+    @property
+    def signature(self):
+        return self.inputs
+
+    def execute(self):
+        with open(self.target, 'wt') as out:
+            for path in self.inputs:
+                with open(path) as f:
+                    out.write(f.read())
+        return 0, ''
+
+
+class BuildFailed(Exception):
+    def __init__(self, returncode, source):
+        super(BuildFailed, self).__init__(returncode, source)
+        self.returncode = returncode
+        self.source = source
+
+
+class Executor(object):
+    """
+    Run tasks needed to bring goal targets up to date.
+
+    Like make, a target is out of date if it is missing or older than any
+    of its inputs or depfile prerequisites. Unlike make, a target is also
+    out of date if its task signature changed since the last build; those
+    are kept in a JSON file at `state_path`.
+
+    Tools are run by a pool of `jobs` threads, so there are never more
+    than `jobs` tools running at once. Output of every task is printed as
+    a whole once it completes. Every executed task is recorded in
+    `trace` if one is given.
+    """
+
+    def __init__(self, state_path, jobs=1, verbose=False, trace=None):
+        self.state_path = state_path
+        self.jobs = max(jobs, 1)
+        self.verbose = verbose
+        self.trace = trace
+        self.tasks = {}
+
+    def add(self, task):
+        self.tasks[task.target] = task
+
+    def extend(self, tasks):
+        for task in tasks:
+            self.add(task)
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_state(self, state):
+        dirname = os.path.dirname(self.state_path)
+        makedirs(dirname)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.state_path)
+
+    def needed(self, goals):
+        """
+        Return tasks `goals` depend on, goal tasks included.
+        """
+        needed = {}
+        stack = [self.tasks[goal] for goal in goals]
+        while stack:
+            task = stack.pop()
+            if task.target in needed:
+                continue
+            needed[task.target] = task
+            stack.extend(self.tasks[path] for path in task.inputs if path in self.tasks)
+        return needed
+
+    def mtime(self, path):
+        # sources and headers do not change during a build,
+        # so they are stat'ed once while targets are not cached
+        if path in self.tasks:
+            return os.stat(path).st_mtime
+        try:
+            mtime = self.mtimes[path]
+        except KeyError:
+            mtime = self.mtimes[path] = os.stat(path).st_mtime
+        return mtime
+
+    def is_stale(self, task, state):
+        if state.get(task.target) != json.loads(json.dumps(task.signature)):
+            return True
+
+        try:
+            target_mtime = os.stat(task.target).st_mtime
+        except OSError:
+            return True
+
+        prerequisites = task.inputs
+        if task.depfile:
+            prerequisites = prerequisites + parse_depfile(task.depfile)
+        for path in prerequisites:
+            try:
+                if self.mtime(path) > target_mtime:
+                    return True
+            except OSError:
+                # e.g. a removed header, let the tool tell if it is still used
+                return True
+        return False
+
+    def run(self, goals):
+        """
+        Bring `goals` targets up to date. Raise `BuildFailed` with the source
+        of the first failed task if any fails; tasks already running are
+        completed first.
+        """
+        tasks = self.needed(goals)
+        state = self.load_state()
+        self.mtimes = {}
+
+        waiting = {}
+        dependents = dict((target, []) for target in tasks)
+        for task in tasks.itervalues():
+            deps = set(path for path in task.inputs if path in tasks)
+            waiting[task.target] = len(deps)
+            for path in deps:
+                dependents[path].append(task)
+
+        ready = [task for task in tasks.itervalues() if not waiting[task.target]]
+        ready.sort(key=lambda t: t.target)
+        results = Queue()
+        running = 0
+        failure = None
+
+        pool = ThreadPool(self.jobs)
+        try:
+            while ready or running:
+                while ready and failure is None:
+                    task = ready.pop(0)
+                    if self.is_stale(task, state):
+                        if task.message:
+                            print task.message
+                        if self.verbose and isinstance(task, ToolTask):
+                            print subprocess.list2cmdline(task.args)
+                        state.pop(task.target, None)
+                        makedirs(os.path.dirname(task.target))
+                        pool.apply_async(self._execute, [task, results])
+                        running += 1
+                    else:
+                        ready.extend(self._done(task, dependents, waiting))
+
+                if not running:
+                    break
+
+                # a timeout keeps the wait interruptible by Ctrl+C
+                task, returncode, output = results.get(True, 86400)
+                running -= 1
+                if output:
+                    print output.rstrip('\n')
+                if returncode == 0:
+                    state[task.target] = task.signature
+                    ready.extend(self._done(task, dependents, waiting))
+                elif failure is None:
+                    failure = BuildFailed(returncode, task.source)
+        finally:
+            pool.terminate()
+            self.save_state(state)
+
+        if failure is not None:
+            raise failure
+
+    def _done(self, task, dependents, waiting):
+        unblocked = []
+        for dependent in dependents[task.target]:
+            waiting[dependent.target] -= 1
+            if not waiting[dependent.target]:
+                unblocked.append(dependent)
+        return unblocked
+
+    def _execute(self, task, results):
+        start = time.time()
+        try:
+            returncode, output = task.execute()
+        except (OSError, IOError) as e:
+            returncode, output = 127, '%s: %s' % (task.source, e)
+        if self.trace is not None:
+            self.trace.add(task.source, task.category, start, time.time(),
+                           target=task.target, group=task.group, returncode=returncode)
+        results.put((task, returncode, output))
@@ -3,10 +3,11 @@
 import sys
 import os.path
 import itertools
-import pickle
 import platform
 import hashlib
+import json
 import re
+import tempfile
 
 try:
     from collections import OrderedDict
@@ -15,11 +16,12 @@ except ImportError:
     from ordereddict import OrderedDict
 
 from collections import namedtuple
-from glob2 import glob
+from glob import has_magic
 
 from ano.filters import colorize
-from ano.utils import format_available_options
+from ano.utils import format_available_options, makedirs
 from ano.exc import Abort
+from ano.state import StateStore
 
 
 class Version(namedtuple('Version', 'major minor build')):
@@ -70,6 +72,10 @@ class Environment(dict):
     lib_dir = 'lib'
     hex_filename = 'firmware.hex'
 
+    # user-level directory for data shared between projects
+    cache_dir = os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'ano')
+
     arduino_user_dir = None
     arduino_user_dir_guesses = [
         'libraries',
@@ -96,35 +102,55 @@ class Environment(dict):
     default_board_model = 'uno'
     ano = sys.argv[0]
 
+    # version of the format of the project state
+    state_version = 1
+
     def __init__(self):
         super(Environment, self).__init__()
-        self['__ano_objectVersion__'] = 3;
-
-    def dump(self):
-        if not os.path.isdir(self.output_dir):
-            return
-        with open(self.dump_filepath, 'wb') as f:
-            pickle.dump(self.items(), f, pickle.HIGHEST_PROTOCOL)
+        self.board_model_cache = {}
 
     def load(self):
-        if not os.path.exists(self.dump_filepath):
-            return
-        needToResetPickle = False
-        with open(self.dump_filepath, 'rb') as f:
-            try:
-                unjarred = dict(pickle.load(f))
-                if unjarred['__ano_objectVersion__'] != self['__ano_objectVersion__']:
-                    needToResetPickle = True
-                else:
-                    self.update(unjarred)
-            except:
-                needToResetPickle = True
+        """
+        Set up persistent project state. Nothing is read until a value
+        is looked up:
+
+            * discovery -- Arduino distribution and its version
+            * boards    -- board models used in the project
+            * build     -- state of the last build per build directory
+
+        Found tools and directories are kept in the user cache directory
+        to be shared by all projects.
+        """
+        self.state = StateStore(os.path.join(self.output_dir, 'state'), self.state_version)
+        self.discovery = self.state.namespace('discovery')
+        self.boards = self.state.namespace('boards')
 
-        if needToResetPickle:
-            os.remove(self.dump_filepath)
+        self.user_state = StateStore(self.cache_dir, self.state_version)
+        self.discovery_cache = self.user_state.namespace('discovery')
+
+        # a leftover of older versions
+        if os.path.exists(self.legacy_dump_filepath):
+            os.remove(self.legacy_dump_filepath)
+
+    def share_state(self, other):
+        """
+        Use persistent state of `other` instead of loading it, e.g. to
+        build for several boards at once. The state is saved once `other`
+        is dumped.
+        """
+        self.state = other.state
+        self.discovery = other.discovery
+        self.boards = other.boards
+        self.user_state = other.user_state
+        self.discovery_cache = other.discovery_cache
+
+    def dump(self):
+        self.user_state.save()
+        if os.path.isdir(self.output_dir):
+            self.state.save()
 
     @property
-    def dump_filepath(self):
+    def legacy_dump_filepath(self):
         return os.path.join(self.output_dir, 'environment-ano.pickle')
 
     def __getitem__(self, key):
@@ -158,6 +184,12 @@ class Environment(dict):
         a list with all fount matches is returned.
 
         Raise `Abort` if no matches were found.
+
+        Results are cached in the user cache directory by `key`, `places`
+        and `items`. A cached match is used while the entry found exists
+        and a cached miss while the places to search are not modified.
+        Lookups of all matches are not cached as a new one could appear
+        anywhere below the places.
         """
         if key in self:
             return self[key]
@@ -168,6 +200,14 @@ class Environment(dict):
         places = itertools.chain.from_iterable(os.path.expandvars(p).split(os.pathsep) for p in places)
         places = map(os.path.expanduser, places)
 
+        cache_key = hashlib.sha1(json.dumps([key, map(os.path.abspath, places),
+                                             items, join, multi])).hexdigest()
+        cached = None if multi else self.discovery_cache.get(cache_key)
+        if cached is not None and self.discovery_is_current(cached):
+            self[key] = cached['result']
+            return [] if cached['result'] is None else cached['result']
+
+        from glob2 import glob
         glob_places = itertools.chain.from_iterable(glob(p) for p in places)
 
         print 'Searching for', human_name, ' in ', places
@@ -180,6 +220,8 @@ class Environment(dict):
                     if not multi:
                         print colorize(result, 'green')
                         self[key] = result
+                        self.discovery_cache[cache_key] = {'key': key, 'result': result,
+                                                           'match': path}
                         return result
                     results.append(result)
 
@@ -199,8 +241,38 @@ class Environment(dict):
                         (human_name, ''.join(['\n  - ' + p for p in places])))
         else:
             self[key] = None
+            if not multi:
+                self.discovery_cache[cache_key] = {'key': key, 'result': None,
+                                                   'roots': self._search_roots(places)}
             return results
 
+    def _search_roots(self, places):
+        """
+        Return modification times of the deepest existing directories
+        without wildcards leading to `places`. A new match could only
+        appear if any of them is modified.
+        """
+        roots = {}
+        for place in map(os.path.abspath, places):
+            while has_magic(place) or not os.path.isdir(place):
+                if place == os.path.dirname(place):
+                    break
+                place = os.path.dirname(place)
+            if os.path.isdir(place):
+                roots[place] = os.stat(place).st_mtime
+        return roots
+
+    def discovery_is_current(self, cached):
+        result = cached['result']
+        if result is None:
+            try:
+                return all(os.stat(root).st_mtime == mtime
+                           for root, mtime in cached['roots'].iteritems())
+            except OSError:
+                return False
+        # the entry found, not the place it was found in for directories
+        return 'match' in cached and os.path.exists(cached['match'])
+
     def find_dir(self, key, items, places, human_name=None, multi=False, optional=False):
         return self._find(key, items or ['.'], places, human_name, join=False, multi=multi, optional=optional)
 
@@ -254,53 +326,48 @@ class Environment(dict):
         # - hardware/arduino/{chipset}/boards.txt (Arduino 1.5.x, chipset like `avr`, `sam`)
         # - hardware/{platform}/boards.txt (MPIDE 0.xx, platform like `arduino`, `pic32`)
         # we should find and merge them all
-        boards_txts = self.find_arduino_file('boards.txt', ['**', 'hardware', '**'],
-                                             human_name='Board description file (boards.txt)',
-                                             multi=True)
+        dirname_parts = ['**', 'hardware', '**']
+        index_path = self.board_index_path(dirname_parts)
+
+        board_models = BoardModels.load(index_path)
+        if board_models is None:
+            boards_txts = self.find_arduino_file('boards.txt', dirname_parts,
+                                                 human_name='Board description file (boards.txt)',
+                                                 multi=True)
+            board_models = BoardModels.parse(boards_txts)
+            board_models.save(index_path)
+
+        board_models.default = self.default_board_model
+        self['board_models'] = board_models
+        return board_models
+
+    def board_index_path(self, dirname_parts=['**', 'hardware', '**']):
+        # parsed files are indexed per set of places searched
+        places = self.arduino_user_places(dirname_parts) + self.arduino_dist_places(dirname_parts)
+        return os.path.join(self.cache_dir, 'boards',
+                            hashlib.sha1('\0'.join(places)).hexdigest()[:16] + '.json')
 
-        self['board_models'] = BoardModels()
-        self['board_models'].default = self.default_board_model
-        for boards_txt in boards_txts:
-            with open(boards_txt) as f:
-                for line in f:
-                    line = line.strip()
-                    if not line or line.startswith('#'):
-                        continue
+    def board_model(self, key):
+        """
+        Return a nested dict describing board model `key`. A model looked
+        up by an earlier invocation is taken from the project state without
+        loading the whole board index unless boards.txt files were changed.
+        """
+        if key in self.board_model_cache:
+            return self.board_model_cache[key]
 
-                    # Transform lines like:
-                    #   yun.upload.maximum_data_size=2560
-                    # into a nested dict `board_models` so that
-                    #   self['board_models']['yun']['upload']['maximum_data_size'] == 2560
-                    multikey, _, val = line.partition('=')
-                    multikey = multikey.split('.')
-
-                    # traverse into dictionary up to deepest level
-                    # create nested dictionaries if they aren't exist yet
-                    subdict = self['board_models']
-                    for key in multikey[:-1]:
-                        if key not in subdict:
-                            subdict[key] = {}
-                        elif not isinstance(subdict[key], dict):
-                            # it happens that a particular key
-                            # has a value and has sublevels at same time. E.g.:
-                            #   diecimila.menu.cpu.atmega168=ATmega168
-                            #   diecimila.menu.cpu.atmega168.upload.maximum_size=14336
-                            #   diecimila.menu.cpu.atmega168.upload.maximum_data_size=1024
-                            #   diecimila.menu.cpu.atmega168.upload.speed=19200
-                            # place value `ATmega168` into a special key `_` in such case
-                            subdict[key] = {'_': subdict[key]}
-                        subdict = subdict[key]
-
-                    subdict[multikey[-1]] = val
-
-                    # store spectial `_coredir` value on top level so we later can build
-                    # paths relative to a core directory of a specific board model
-                    self['board_models'][multikey[0]]['_coredir'] = os.path.dirname(boards_txt)
-
-        return self['board_models']
+        index_path = self.board_index_path()
+        cached = self.boards.get(key)
+        if cached and cached['index'] == index_path and BoardModels.is_current(cached['sources']):
+            model = cached['model']
+        else:
+            board_models = self.board_models()
+            model = board_models[key]
+            self.boards[key] = {'index': index_path, 'sources': board_models.sources,
+                                'model': model}
 
-    def board_model(self, key):
-        return self.board_models()[key]
+        self.board_model_cache[key] = model
+        return model
 
     def add_board_model_arg(self, parser):
         helpText = '\n'.join([
@@ -335,6 +402,7 @@ Additional CPU argument required for board models available with different CPUs
         raise NotImplementedError("Not implemented for Windows")
 
     def list_serial_ports(self):
+        from glob2 import glob
         ports = []
         for p in self.serial_port_patterns():
             matches = glob(p)
@@ -359,24 +427,35 @@ Additional CPU argument required for board models available with different CPUs
 
         arduino_dist = getattr(args, 'arduino_dist', None)
         if arduino_dist:
-            self['arduino_dist_dir'] = os.path.realpath(arduino_dist)
+            self['arduino_dist_dir'] = self.discovery['arduino_dist_dir'] = \
+                os.path.realpath(arduino_dist)
+        elif 'arduino_dist_dir' in self.discovery:
+            self['arduino_dist_dir'] = self.discovery['arduino_dist_dir']
 
         board_model = getattr(args, 'board_model', None)
         if board_model:
-            all_models = self.board_models()
-            if board_model not in all_models:
+            try:
+                self.board_model(board_model)
+            except KeyError:
                 print "Supported Arduino board models are:"
-                print all_models.format()
+                print self.board_models().format()
                 raise Abort('%s is not a valid board model' % board_model)
 
         # Build artifacts for each Arduino distribution / Board model
         # pair should go to a separate subdirectory
         build_dirname = board_model or self.default_board_model
+        # and so should each CPU variant of a board model
+        cpu = getattr(args, 'cpu', None)
+        if board_model and cpu in self.board_model(board_model).get('menu', {}).get('cpu', {}):
+            build_dirname = '%s-%s' % (build_dirname, cpu)
         if arduino_dist:
             distHash = hashlib.md5(arduino_dist).hexdigest()[:8]
             build_dirname = '%s-%s' % (build_dirname, distHash)
 
         self['build_dir'] = os.path.join(self.output_dir, build_dirname)
+        self.build_state = self.state.namespace(os.path.join(build_dirname, 'build'))
+        self.sizes = self.state.namespace(os.path.join(build_dirname, 'sizes'))
+        self.uploads = self.state.namespace(os.path.join(build_dirname, 'uploads'))
 
     @property
     def arduino_lib_version(self):
@@ -384,17 +463,184 @@ Additional CPU argument required for board models available with different CPUs
                                human_name='Arduino lib version file (version.txt)')
 
         if 'arduino_lib_version' not in self:
-            with open(self['version.txt']) as f:
-                print 'Detecting Arduino software version ... ',
-                v_string = f.read().strip()
-                v = Version.parse(v_string)
-                self['arduino_lib_version'] = v
-                print colorize("%s (%s)" % (v, v_string), 'green')
+            # detected version is kept while the same version.txt is used
+            path, v_string = self.discovery.get('arduino_lib_version', [None, None])
+            if path != self['version.txt']:
+                with open(self['version.txt']) as f:
+                    print 'Detecting Arduino software version ... ',
+                    v_string = f.read().strip()
+                    print colorize("%s (%s)" % (Version.parse(v_string), v_string), 'green')
+                self.discovery['arduino_lib_version'] = [self['version.txt'], v_string]
+            self['arduino_lib_version'] = Version.parse(v_string)
 
         return self['arduino_lib_version']
 
 
-class BoardModels(OrderedDict):
+class BoardModels(object):
+    """
+    Board model descriptions found in `boards.txt' files by model id.
+
+    Files are parsed into a flat index of `key=value' entries per model
+    that is cached in the user cache directory until any of the files is
+    modified or a hardware directory they are in changes. A nested dict
+    of a model, like
+
+        board_models['yun']['upload']['maximum_data_size'] == '2560'
+
+    is built when the model is looked up for the first time.
+    """
+
+    version = 1
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.coredirs = {}
+        self.models = {}
+        self.sources = []
+        self.default = None
+
+    @classmethod
+    def parse(cls, boards_txts):
+        board_models = cls()
+        for boards_txt in boards_txts:
+            board_models.sources.append(cls._stat(boards_txt))
+            with open(boards_txt) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+
+                    # lines like `yun.upload.maximum_data_size=2560'
+                    # are kept as ('upload.maximum_data_size', '2560') of `yun'
+                    multikey, _, val = line.partition('=')
+                    model, _, key = multikey.partition('.')
+                    if not key:
+                        continue
+                    board_models.entries.setdefault(model, []).append((key, val))
+
+                    # store spectial `_coredir` value so we later can build paths
+                    # relative to a core directory of a specific board model
+                    board_models.coredirs[model] = os.path.dirname(boards_txt)
+
+            # a new core appears as a new subdirectory of `hardware'
+            dirname = os.path.dirname(boards_txt)
+            while dirname != os.path.dirname(dirname):
+                board_models.sources.append(cls._stat(dirname))
+                if os.path.basename(dirname) == 'hardware':
+                    break
+                dirname = os.path.dirname(dirname)
+
+        return board_models
+
+    @classmethod
+    def load(cls, index_path):
+        """
+        Return models from the index at `index_path` or None if there is no
+        index or it is outdated.
+        """
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if index.get('version') != cls.version:
+            return None
+
+        # strings are stored as latin-1 so that any bytes survive the round trip
+        decode = lambda s: s.encode('latin-1')
+        sources = [[decode(path), mtime, size] for path, mtime, size in index['sources']]
+        if not cls.is_current(sources):
+            return None
+
+        board_models = cls()
+        board_models.sources = sources
+        for model, coredir, entries in index['models']:
+            model = decode(model)
+            board_models.coredirs[model] = decode(coredir)
+            board_models.entries[model] = [(decode(k), decode(v)) for k, v in entries]
+        return board_models
+
+    def save(self, index_path):
+        encode = lambda s: s.decode('latin-1')
+        index = {
+            'version': self.version,
+            'sources': [[encode(path), mtime, size] for path, mtime, size in self.sources],
+            'models': [[encode(model), encode(self.coredirs[model]),
+                        [(encode(k), encode(v)) for k, v in entries]]
+                       for model, entries in self.entries.iteritems()],
+        }
+
+        # written aside and moved in place so that concurrent
+        # invocations never read a partial index
+        dirname = os.path.dirname(index_path)
+        makedirs(dirname)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp_path, index_path)
+
+    @classmethod
+    def is_current(cls, sources):
+        """
+        Return True if files and directories models were parsed from
+        are not changed since.
+        """
+        try:
+            return all(cls._stat(path) == [path, mtime, size] for path, mtime, size in sources)
+        except OSError:
+            return False
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return [path, st.st_mtime, 0 if os.path.isdir(path) else st.st_size]
+
+    def __contains__(self, model):
+        return model in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def __getitem__(self, model):
+        try:
+            return self.models[model]
+        except KeyError:
+            pass
+
+        board = {}
+        for key, val in self.entries[model]:
+            multikey = key.split('.')
+
+            # traverse into dictionary up to deepest level
+            # create nested dictionaries if they aren't exist yet
+            subdict = board
+            for part in multikey[:-1]:
+                if part not in subdict:
+                    subdict[part] = {}
+                elif not isinstance(subdict[part], dict):
+                    # it happens that a particular key
+                    # has a value and has sublevels at same time. E.g.:
+                    #   diecimila.menu.cpu.atmega168=ATmega168
+                    #   diecimila.menu.cpu.atmega168.upload.maximum_size=14336
+                    #   diecimila.menu.cpu.atmega168.upload.maximum_data_size=1024
+                    #   diecimila.menu.cpu.atmega168.upload.speed=19200
+                    # place value `ATmega168` into a special key `_` in such case
+                    subdict[part] = {'_': subdict[part]}
+                subdict = subdict[part]
+
+            subdict[multikey[-1]] = val
+
+        board['_coredir'] = self.coredirs[model]
+        self.models[model] = board
+        return board
+
+    def name(self, model):
+        names = [val for key, val in self.entries[model] if key == 'name']
+        return names[-1] if names else None
 
     @classmethod
     def getValueForVariant(cls, boardsDict, variant, keyType, key):
@@ -413,5 +659,5 @@ class BoardModels(OrderedDict):
                 raise e;
 
     def format(self):
-        boardsMap = [(key, val['name']) for key, val in self.iteritems() if 'name' in val]
+        boardsMap = [(key, self.name(key)) for key in self if self.name(key) is not None]
         return format_available_options(boardsMap, head_width=12, default=self.default)
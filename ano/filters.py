@@ -4,7 +4,7 @@ import sys
 import os.path
 import fnmatch
 
-from ano.utils import FileMap, SpaceList
+from ano.utils import DirectoryIndex, FileMap, SpaceList
 
 
 class GlobFile(object):
@@ -32,19 +32,16 @@ def filter(f):
 def glob(dirname, *patterns, **kwargs):
     recursive = kwargs.get('recursive', True)
     subdir = kwargs.get('subdir', '')
+    index = kwargs.get('index') or DirectoryIndex()
 
     result = SpaceList()
-    scan_dir = os.path.join(dirname, subdir)
-    if not os.path.isdir(scan_dir):
-        return result
-
-    for entry in os.listdir(scan_dir):
-        path = os.path.join(scan_dir, entry)
-        if os.path.isdir(path) and recursive:
+    scan_dir = os.path.join(dirname, subdir) if subdir else dirname
+    for entry, is_dir, is_file in index.listdir(scan_dir):
+        if is_dir and recursive:
             subglob = glob(dirname, *patterns, recursive=True,
-                           subdir=os.path.join(subdir, entry))
+                           subdir=os.path.join(subdir, entry), index=index)
             result.extend(subglob)
-        elif os.path.isfile(path) and any(fnmatch.fnmatch(entry, p) for p in patterns):
+        elif is_file and any(fnmatch.fnmatch(entry, p) for p in patterns):
             result.append(GlobFile(os.path.join(subdir, entry), dirname))
 
     return result
@@ -91,9 +88,15 @@ def filemap(sources, target_dir, rename_rule):
                    for source in sources)
 
 @filter
-def libmap(source_dirs, target_dir):
+def libmap(source_dirs, target_dir, prebuilt={}):
+    """
+    Map library source directories to archives to be built in `target_dir`.
+    Archives for directories found in `prebuilt` are taken as is.
+    """
     return FileMap((
         source_dir, 
+        GlobFile(basename(prebuilt[source_dir]), dirname(prebuilt[source_dir]))
+        if source_dir in prebuilt else
         GlobFile(libname(basename(source_dir)), 
                  pjoin(target_dir, basename(source_dir))))
         for source_dir in source_dirs)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8; -*-
+
+"""
+Intel HEX firmware images, as objcopy writes them, split into pages of
+flash memory the way bootloaders program them.
+"""
+
+from ano.utils import OrderedDict
+
+
+DATA = 0
+END_OF_FILE = 1
+EXTENDED_SEGMENT_ADDRESS = 2
+EXTENDED_LINEAR_ADDRESS = 4
+
+
+class HexError(Exception):
+    pass
+
+
+def parse(lines):
+    """
+    Return a list of (address, data) tuples for contiguous runs of bytes
+    `lines` of an Intel HEX file describe, ordered by address.
+    """
+    records = []
+    base = 0
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(':'):
+            raise HexError('Line %d is not a record' % number)
+        try:
+            record = bytearray(line[1:].decode('hex'))
+        except TypeError:
+            raise HexError('Line %d is not hexadecimal' % number)
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise HexError('Line %d has a wrong length' % number)
+        if sum(record) & 0xff:
+            raise HexError('Line %d has a wrong checksum' % number)
+
+        kind = record[3]
+        data = record[4:-1]
+        if kind == DATA:
+            records.append((base + (record[1] << 8 | record[2]), data))
+        elif kind == END_OF_FILE:
+            break
+        elif kind == EXTENDED_SEGMENT_ADDRESS:
+            base = (data[0] << 8 | data[1]) << 4
+        elif kind == EXTENDED_LINEAR_ADDRESS:
+            base = (data[0] << 8 | data[1]) << 16
+        # start addresses do not matter for flashing
+
+    # records are usually in order already; overlapping ones, which
+    # objcopy never writes, are applied in order of their addresses
+    records.sort(key=lambda record: record[0])
+    segments = []
+    for address, data in records:
+        if segments and address <= segments[-1][0] + len(segments[-1][1]):
+            start, segment = segments[-1]
+            segment[address - start:address - start + len(data)] = data
+        else:
+            segments.append((address, data))
+    return [(address, str(data)) for address, data in segments]
+
+
+def read(path):
+    with open(path) as f:
+        return parse(f)
+
+
+def paginate(segments, page_size, fill='\xff'):
+    """
+    Return an ordered map of start addresses of flash pages `segments`
+    touch to contents of those pages, gaps filled with `fill` like
+    erased flash.
+    """
+    pages = OrderedDict()
+    for address, data in segments:
+        while data:
+            start = address - address % page_size
+            page = bytearray(pages.get(start, fill * page_size))
+            chunk = data[:start + page_size - address]
+            page[address - start:address - start + len(chunk)] = chunk
+            pages[start] = str(page)
+            address += len(chunk)
+            data = data[len(chunk):]
+    return pages
+
+
+def changed_pages(old, new):
+    """
+    Return pages of `new` missing from `old` or different from those
+    there, both ordered maps of page addresses to contents.
+    """
+    return OrderedDict((address, data) for address, data in new.iteritems()
+                       if old.get(address) != data)
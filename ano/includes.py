@@ -0,0 +1,258 @@
+# -*- coding: utf-8; -*-
+
+"""
+Dependency discovery without the compiler.
+
+Sources are read for `#include' directives, and every included name is
+resolved the way the Arduino IDE does it: a quoted name is looked up next
+to the including file first, then in the core and variant directories,
+then among headers that libraries export. If several libraries provide
+a header, the one whose directory is named after the header wins,
+otherwise the first one in search order does. Names not found anywhere
+are taken for toolchain headers and ignored, like `cc -MM' does.
+
+Conditions are not evaluated. Includes under `#if' that lead to headers
+of the core or of the including library itself are followed anyway, as
+those only add prerequisites. A library included under `#if', e.g. only
+for another architecture, could be picked by mistake though, so such a
+source is left to the compiler.
+"""
+
+import os
+import re
+import fnmatch
+
+from ano.utils import DirectoryIndex, list_subdirs
+
+
+header_patterns = ['*.h', '*.hh', '*.hpp']
+
+_block_comment = re.compile(r'/\*.*?\*/', re.S)
+_directive = re.compile(r'^[ \t]*#[ \t]*(\w+)[ \t]*(.*)$', re.M)
+_include = re.compile(r'"([^"\n]+)"|<([^>\n]+)>|(\S+)')
+
+
+class UnresolvedInclude(Exception):
+    """
+    A source includes something only the preprocessor could follow.
+    """
+
+    def __init__(self, path, name):
+        super(UnresolvedInclude, self).__init__(path, name)
+        self.path = path
+        self.name = name
+
+    def __str__(self):
+        return '%s includes %s' % (self.path, self.name)
+
+
+class ComputedInclude(UnresolvedInclude):
+    """
+    A source includes a macro expansion.
+    """
+
+
+class ConditionalInclude(UnresolvedInclude):
+    """
+    A source includes a header of another library under `#if'.
+    """
+
+    def __str__(self):
+        return '%s includes %s conditionally' % (self.path, self.name)
+
+
+def parse_includes(path, contents):
+    """
+    Return a list of (name, quoted, conditional) tuples for `#include'
+    directives found in `contents` of `path` in order. An include is
+    conditional if it is inside an `#if' block other than an include
+    guard, i.e. `#ifndef' right before a `#define' of the same name.
+    """
+    includes = []
+    # whether blocks opened are conditional, innermost last
+    blocks = []
+    directives = _directive.findall(_block_comment.sub('', contents))
+    for i, (directive, argument) in enumerate(directives):
+        if directive in ('if', 'ifdef', 'ifndef'):
+            following = directives[i + 1] if i + 1 < len(directives) else (None, '')
+            blocks.append(directive != 'ifndef' or following[0] != 'define' or
+                          following[1].split()[:1] != argument.split()[:1])
+        elif directive == 'endif':
+            if blocks:
+                blocks.pop()
+        elif directive == 'include':
+            quoted, angled, computed = _include.match(argument).groups() \
+                if argument else ('', '', '')
+            if not (quoted or angled):
+                raise ComputedInclude(path, computed)
+            includes.append((quoted or angled, bool(quoted), any(blocks)))
+    return includes
+
+
+class HeaderIndex(object):
+    """
+    Map of include names to headers found in library directories. Every
+    subdirectory of a library is an include directory, so a header at
+    `utility/twi.h' is known both as "utility/twi.h" and "twi.h".
+
+    Header lists of libraries are kept in `cache`, a state namespace,
+    along with modification times of the directories listed; a library is
+    listed again only when one of those changes.
+    """
+
+    exclude = ['examples', 'extras']
+
+    def __init__(self, lib_dirs, cache=None, dir_index=None):
+        self.lib_dirs = lib_dirs
+        self.cache = cache if cache is not None else {}
+        self.dir_index = dir_index or DirectoryIndex()
+        self.headers = {}
+        for lib in lib_dirs:
+            for relpath in self.library_headers(lib):
+                parts = relpath.split('/')
+                for i in range(len(parts)):
+                    self.headers.setdefault('/'.join(parts[i:]), []).append(
+                        (lib, os.path.join(lib, *parts)))
+
+    def library_headers(self, lib):
+        """
+        Return paths of headers in `lib` relative to it, '/'-separated.
+        """
+        cached = self.cache.get(lib)
+        if cached is not None and self._is_current(cached['dirs']):
+            return cached['headers']
+
+        dirs = [lib] + list_subdirs(lib, recursive=True, exclude=self.exclude,
+                                    index=self.dir_index)
+        mtimes = {}
+        headers = []
+        for dirname in dirs:
+            try:
+                mtimes[dirname] = os.stat(dirname).st_mtime
+            except OSError:
+                continue
+            relpath = os.path.relpath(dirname, lib)
+            for name, _, is_file in sorted(self.dir_index.listdir(dirname)):
+                if is_file and any(fnmatch.fnmatch(name, p) for p in header_patterns):
+                    headers.append(name if relpath == '.' else
+                                   '/'.join(relpath.split(os.path.sep) + [name]))
+
+        self.cache[lib] = {'dirs': mtimes, 'headers': headers}
+        return headers
+
+    def _is_current(self, mtimes):
+        for dirname, mtime in mtimes.iteritems():
+            try:
+                if os.stat(dirname).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def lookup(self, name):
+        """
+        Return a (library, path) tuple for the header `name` or None if no
+        library has it.
+        """
+        candidates = self.headers.get(name)
+        if not candidates:
+            return None
+        stem = os.path.splitext(name.split('/')[-1])[0]
+        for lib, path in candidates:
+            if os.path.basename(lib) == stem:
+                return lib, path
+        return candidates[0]
+
+
+class IncludeResolver(object):
+    """
+    Find headers sources depend on and libraries those belong to.
+
+    `include_dirs` are searched before library headers, in order, like
+    `-I' directories given to the compiler. An include directory that is
+    also a library, i.e. the core, is reported as such.
+
+    Directories of library headers found by name are collected in
+    `search_dirs` by library; those are the only ones besides library
+    roots the compiler needs in its search path.
+
+    Includes parsed out of sources are kept in `includes`, a dict that
+    resolvers of builds for other boards could share.
+    """
+
+    def __init__(self, include_dirs, headers, includes=None):
+        self.include_dirs = include_dirs
+        self.headers = headers
+        self.libraries = set(headers.lib_dirs)
+        self.includes = includes if includes is not None else {}
+        self.exists = {}
+        self.search_dirs = {}
+
+    def parsed(self, path):
+        try:
+            return self.includes[path]
+        except KeyError:
+            with open(path) as f:
+                includes = self.includes[path] = parse_includes(path, f.read())
+            return includes
+
+    def isfile(self, path):
+        try:
+            return self.exists[path]
+        except KeyError:
+            exists = self.exists[path] = os.path.isfile(path)
+            return exists
+
+    def resolve(self, name, quoted, dirnames, owner):
+        """
+        Return a (path, library) tuple for an included `name` or None.
+        Quoted names are looked up in `dirnames` first; headers found
+        there belong to `owner`.
+        """
+        for dirname in dirnames if quoted else []:
+            path = os.path.normpath(os.path.join(dirname, name))
+            if self.isfile(path):
+                return path, owner
+        for dirname in self.include_dirs:
+            path = os.path.normpath(os.path.join(dirname, name))
+            if self.isfile(path):
+                return path, dirname if dirname in self.libraries else None
+        found = self.headers.lookup(name)
+        if found is None:
+            return None
+        lib, path = found
+        search_dir = path
+        for _ in name.split('/'):
+            search_dir = os.path.dirname(search_dir)
+        self.search_dirs.setdefault(lib, set()).add(search_dir)
+        return path, lib
+
+    def dependencies(self, source, owner, quote_dirs=[]):
+        """
+        Return a list of (path, library) tuples for headers `source`
+        includes directly or through other headers, in the order the
+        preprocessor would meet them. Headers next to `source` or in
+        `quote_dirs` belong to `owner`. Raise `UnresolvedInclude` if an
+        include could not be followed or would add a library only
+        conditionally.
+        """
+        found = []
+        seen = set([source])
+
+        # headers met through a conditional include are conditional too
+        def visit(path, lib, in_condition):
+            dirnames = [os.path.dirname(path)] + quote_dirs
+            for name, quoted, conditional in self.parsed(path):
+                header = self.resolve(name, quoted, dirnames, lib)
+                if header is None or header[0] in seen:
+                    continue
+                conditional = conditional or in_condition
+                if conditional and header[1] not in (None, lib) and \
+                        header[1] not in self.include_dirs:
+                    raise ConditionalInclude(path, name)
+                seen.add(header[0])
+                found.append(header)
+                visit(header[0], header[1], conditional)
+
+        visit(source, owner, False)
+        return found
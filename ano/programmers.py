@@ -0,0 +1,326 @@
+# -*- coding: utf-8; -*-
+
+"""
+Clients of bootloader protocols that `ano upload --programmer=native'
+talks instead of running avrdude:
+
+    * STK500v1 -- optiboot and other bootloaders of ATmega328 boards
+    * STK500v2 -- stk500boot of ATmega2560 boards
+    * AVR109   -- Caterina of ATmega32U4 boards
+
+A programmer works on an open serial port. Pages the device holds
+already are not written, and every page written is read back to verify
+it. Given what the last upload left in flash, only pages that differ
+from it are written and nothing else is read.
+"""
+
+import struct
+import time
+
+from ano import ihex
+
+
+# MCU name -> (signature, flash page size)
+devices = {
+    'atmega8': ('\x1e\x93\x07', 64),
+    'atmega168': ('\x1e\x94\x06', 128),
+    'atmega168p': ('\x1e\x94\x0b', 128),
+    'atmega328': ('\x1e\x95\x14', 128),
+    'atmega328p': ('\x1e\x95\x0f', 128),
+    'atmega32u4': ('\x1e\x95\x87', 128),
+    'atmega644p': ('\x1e\x96\x0a', 256),
+    'atmega1280': ('\x1e\x97\x03', 256),
+    'atmega1284p': ('\x1e\x97\x05', 256),
+    'atmega2560': ('\x1e\x98\x01', 256),
+}
+
+
+class ProgrammerError(Exception):
+    pass
+
+
+class VerificationError(ProgrammerError):
+    pass
+
+
+class Programmer(object):
+    """
+    Base of bootloader clients. Subclasses implement commands of their
+    protocol: `sync', `read_signature', `enter', `leave', `read_page'
+    and `write_page'.
+
+    A bootloader listens for a short time after reset only, so instead
+    of waiting for it to start, `connect' tries to get in sync over and
+    over with `sync_timeout` until `connect_timeout` passes. Other
+    commands wait for answers up to `timeout`.
+    """
+
+    sync_timeout = 0.05
+    connect_timeout = 2.0
+    timeout = 1.0
+
+    def __init__(self, port):
+        self.port = port
+
+    def reset(self):
+        """
+        Reset the board with a pulse on DTR and RTS, which are wired to
+        the reset pin through a capacitor. Ports without modem control
+        lines, e.g. virtual ones, are left as is.
+        """
+        try:
+            self.port.setDTR(False)
+            self.port.setRTS(False)
+            time.sleep(0.01)
+            self.port.setDTR(True)
+            self.port.setRTS(True)
+        except IOError:
+            pass
+
+    def connect(self):
+        deadline = time.time() + self.connect_timeout
+        self.port.timeout = self.sync_timeout
+        try:
+            while True:
+                self.port.flushInput()
+                try:
+                    if self.sync():
+                        break
+                except ProgrammerError:
+                    pass
+                if time.time() > deadline:
+                    raise ProgrammerError('No answer from the bootloader')
+            # garbage of failed attempts
+            time.sleep(self.sync_timeout)
+            self.port.flushInput()
+        finally:
+            self.port.timeout = self.timeout
+
+    def read(self, size):
+        data = self.port.read(size)
+        if len(data) != size:
+            raise ProgrammerError('Timed out waiting for the bootloader')
+        return data
+
+    def expect(self, answer, what):
+        data = self.read(len(answer))
+        if data != answer:
+            raise ProgrammerError('Unexpected answer to %s: %r' % (what, data))
+
+    def program(self, pages, verify=True, compare=True):
+        """
+        Write `pages`, an ordered map of page addresses to contents, to
+        flash. Unless `compare` is False, pages the device holds already
+        are skipped. Return the list of addresses of written pages.
+        """
+        written = []
+        for address, data in pages.iteritems():
+            if not compare or self.read_page(address, len(data)) != data:
+                self.write_page(address, data)
+                if verify and self.read_page(address, len(data)) != data:
+                    raise VerificationError('Verification of the page at 0x%05x failed' % address)
+                written.append(address)
+        return written
+
+    def update(self, pages, last, verify=True):
+        """
+        Write `pages` to flash that holds `last` still, both ordered maps
+        of page addresses to contents, writing only pages that differ
+        from `last` without reading them first. If a written page fails
+        verification, flash is not what `last` says, so every page is
+        compared and written if it differs. Return the list of addresses
+        of written pages.
+        """
+        try:
+            return self.program(ihex.changed_pages(last, pages), verify, compare=False)
+        except VerificationError:
+            return self.program(pages, verify)
+
+
+class Stk500v1(Programmer):
+    STK_OK = '\x10'
+    STK_INSYNC = '\x14'
+    CRC_EOP = '\x20'
+
+    def command(self, what, payload, answer_size=0):
+        self.port.write(payload + self.CRC_EOP)
+        self.expect(self.STK_INSYNC, what)
+        answer = self.read(answer_size)
+        self.expect(self.STK_OK, what)
+        return answer
+
+    def sync(self):
+        self.port.write('\x30' + self.CRC_EOP)
+        return self.port.read(2) == self.STK_INSYNC + self.STK_OK
+
+    def read_signature(self):
+        return self.command('reading signature', '\x75', 3)
+
+    def enter(self):
+        self.command('entering programming mode', '\x50')
+
+    def leave(self):
+        self.command('leaving programming mode', '\x51')
+
+    def load_address(self, address):
+        if address >= 0x20000:
+            raise ProgrammerError('Address 0x%05x is out of reach of STK500v1' % address)
+        self.command('loading address', struct.pack('<cH', '\x55', address // 2))
+
+    def read_page(self, address, size):
+        self.load_address(address)
+        return self.command('reading flash', struct.pack('>cHc', '\x74', size, 'F'), size)
+
+    def write_page(self, address, data):
+        self.load_address(address)
+        self.command('writing flash', struct.pack('>cHc', '\x64', len(data), 'F') + data)
+
+
+class Stk500v2(Programmer):
+    MESSAGE_START = '\x1b'
+    TOKEN = '\x0e'
+    STATUS_CMD_OK = '\x00'
+
+    CMD_SIGN_ON = '\x01'
+    CMD_LOAD_ADDRESS = '\x06'
+    CMD_ENTER_PROGMODE_ISP = '\x10'
+    CMD_LEAVE_PROGMODE_ISP = '\x11'
+    CMD_PROGRAM_FLASH_ISP = '\x13'
+    CMD_READ_FLASH_ISP = '\x14'
+    CMD_READ_SIGNATURE_ISP = '\x1b'
+
+    def __init__(self, port):
+        super(Stk500v2, self).__init__(port)
+        self.sequence = 0
+
+    def checksum(self, data):
+        result = 0
+        for byte in bytearray(data):
+            result ^= byte
+        return chr(result)
+
+    def command(self, what, body):
+        """
+        Send a message with `body` and return the body of the answer with
+        its command and status stripped.
+        """
+        self.sequence = (self.sequence + 1) & 0xff
+        message = self.MESSAGE_START + chr(self.sequence) + \
+            struct.pack('>H', len(body)) + self.TOKEN + body
+        self.port.write(message + self.checksum(message))
+
+        header = self.read(5)
+        if header[0] != self.MESSAGE_START or header[4] != self.TOKEN or \
+                ord(header[1]) != self.sequence:
+            raise ProgrammerError('Unexpected answer to %s: %r' % (what, header))
+        answer = self.read(struct.unpack('>H', header[2:4])[0])
+        if self.read(1) != self.checksum(header + answer):
+            raise ProgrammerError('Wrong checksum of the answer to %s' % what)
+        if answer[:2] != body[0] + self.STATUS_CMD_OK:
+            raise ProgrammerError('%s failed: %r' % (what.capitalize(), answer[:2]))
+        return answer[2:]
+
+    def sync(self):
+        return self.command('signing on', self.CMD_SIGN_ON).startswith('\x08AVRISP')
+
+    def read_signature(self):
+        return ''.join(self.command('reading signature',
+                                    self.CMD_READ_SIGNATURE_ISP + '\x04\x30\x00' + chr(i) + '\x00')[0]
+                       for i in range(3))
+
+    def enter(self):
+        # timeout, stabilization, execution delays, sync loops, byte delay,
+        # poll value and index, then the ISP `Programming Enable' instruction
+        self.command('entering programming mode',
+                     self.CMD_ENTER_PROGMODE_ISP + '\xc8\x64\x19\x20\x00\x53\x03\xac\x53\x00\x00')
+
+    def leave(self):
+        self.command('leaving programming mode', self.CMD_LEAVE_PROGMODE_ISP + '\x01\x01')
+
+    def load_address(self, address):
+        word = address // 2
+        # beyond 64K words the bootloader has to set the extended address too
+        if address >= 0x20000:
+            word |= 0x80000000
+        self.command('loading address', self.CMD_LOAD_ADDRESS + struct.pack('>I', word))
+
+    def read_page(self, address, size):
+        self.load_address(address)
+        answer = self.command('reading flash',
+                              self.CMD_READ_FLASH_ISP + struct.pack('>H', size) + '\x20')
+        if len(answer) != size + 1:
+            raise ProgrammerError('Read %d bytes of flash instead of %d' % (len(answer) - 1, size))
+        return answer[:size]
+
+    def write_page(self, address, data):
+        self.load_address(address)
+        # page mode with the write page instruction, then the ISP
+        # instructions to load, write and read flash
+        self.command('writing flash', self.CMD_PROGRAM_FLASH_ISP + struct.pack('>H', len(data)) +
+                     '\xc1\x0a\x40\x4c\x20\x00\x00' + data)
+
+
+class Avr109(Programmer):
+    CR = '\r'
+
+    def __init__(self, port):
+        super(Avr109, self).__init__(port)
+        self.block_size = None
+
+    def command(self, what, payload):
+        self.port.write(payload)
+        self.expect(self.CR, what)
+
+    def sync(self):
+        self.port.write('S')
+        return len(self.port.read(7)) == 7
+
+    def read_signature(self):
+        self.port.write('s')
+        # the last byte comes first
+        return self.read(3)[::-1]
+
+    def enter(self):
+        self.port.write('b')
+        answer = self.read(3)
+        if answer[0] != 'Y':
+            raise ProgrammerError('The bootloader does not support block mode')
+        self.block_size = struct.unpack('>H', answer[1:])[0]
+        self.command('entering programming mode', 'P')
+
+    def leave(self):
+        self.command('leaving programming mode', 'L')
+        # start the sketch
+        self.command('exiting the bootloader', 'E')
+
+    def load_address(self, address):
+        self.command('loading address', struct.pack('>cH', 'A', address // 2))
+
+    def blocks(self, address, size):
+        for offset in range(0, size, self.block_size):
+            yield address + offset, min(self.block_size, size - offset)
+
+    def read_page(self, address, size):
+        data = []
+        for block, block_size in self.blocks(address, size):
+            self.load_address(block)
+            self.port.write(struct.pack('>cHc', 'g', block_size, 'F'))
+            data.append(self.read(block_size))
+        return ''.join(data)
+
+    def write_page(self, address, data):
+        for block, block_size in self.blocks(address, len(data)):
+            self.load_address(block)
+            chunk = data[block - address:block - address + block_size]
+            self.command('writing flash', struct.pack('>cHc', 'B', block_size, 'F') + chunk)
+
+
+# upload.protocol of boards.txt -> programmer
+protocols = {
+    'arduino': Stk500v1,
+    'stk500': Stk500v1,
+    'stk500v1': Stk500v1,
+    'stk500v2': Stk500v2,
+    'wiring': Stk500v2,
+    'avr109': Avr109,
+}
@@ -18,12 +18,8 @@ or mercurial do. The full list is provided below. You may run any of them with
 import sys
 import os.path
 import argparse
-import inspect
 
-import ano.commands
-
-from ano.commands.base import Command
-from ano.conf import configure
+from ano.commands import load_command, registry
 from ano.exc import Abort
 from ano.filters import colorize
 from ano.environment import Environment
@@ -34,8 +30,6 @@ def main():
     e = Environment()
     e.load()
 
-    conf = configure()
-
     try:
         current_command = sys.argv[1]
     except IndexError:
@@ -43,19 +37,23 @@ def main():
 
     parser = argparse.ArgumentParser(prog='ano', formatter_class=FlexiFormatter, description=__doc__)
     subparsers = parser.add_subparsers()
-    is_command = lambda x: inspect.isclass(x) and issubclass(x, Command) and x != Command
-    commands = [cls(e) for _, cls in inspect.getmembers(ano.commands, is_command)]
-    for cmd in commands:
-        p = subparsers.add_parser(cmd.name, formatter_class=FlexiFormatter, help=cmd.help_line)
-        if current_command != cmd.name:
+    for name, (_, _, help_line) in registry.iteritems():
+        p = subparsers.add_parser(name, formatter_class=FlexiFormatter, help=help_line)
+        if current_command != name:
             continue
+
+        # only the command being run is imported and configured
+        from ano.conf import configure
+        cmd = load_command(name)(e)
         cmd.setup_arg_parser(p)
-        p.set_defaults(func=cmd.run, **conf.as_dict(cmd.name))
+        switches = [action.dest for action in p._actions
+                    if isinstance(action, (argparse._StoreTrueAction, argparse._StoreFalseAction))]
+        p.set_defaults(func=cmd.run, **configure().as_dict(cmd.name, switches))
 
     args = parser.parse_args()
 
     try:
-        run_anywhere = "init clean list-models serial version"
+        run_anywhere = "init clean cache doctor list-models serial version"
 
         e.process_args(args)
 
@@ -0,0 +1,145 @@
+# -*- coding: utf-8; -*-
+
+import os
+import json
+import tempfile
+
+from contextlib import contextmanager
+
+from ano.utils import makedirs
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: concurrent invocations could lose each other's updates
+    fcntl = None
+
+
+_deleted = object()
+
+
+def _to_str(obj):
+    # json gives unicode strings while the rest of ano works with str
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [_to_str(x) for x in obj]
+    if isinstance(obj, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in obj.iteritems())
+    return obj
+
+
+class Namespace(object):
+    """
+    A dict-like collection of JSON values persisted in a file.
+
+    The file is read on first access only and its contents are ignored if
+    saved with other `version'. `save' writes entries set or deleted since
+    then, merging them with the file contents under a lock, so that
+    concurrent invocations keep each other's updates.
+    """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.lock_path = path + '.lock'
+        self._data = None
+        self.dirty = {}
+        self.cleared = False
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._read()
+        return self._data
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                contents = _to_str(json.load(f))
+        except (IOError, ValueError):
+            return {}
+        if contents.get('version') != self.version:
+            return {}
+        return contents['entries']
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __setitem__(self, key, value):
+        if self.data.get(key, _deleted) == value:
+            return
+        self.data[key] = value
+        self.dirty[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.dirty[key] = _deleted
+
+    def clear(self):
+        self._data = {}
+        self.dirty = {}
+        self.cleared = True
+
+    @contextmanager
+    def locked(self):
+        with open(self.lock_path, 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def save(self):
+        if not self.dirty and not self.cleared:
+            return
+
+        dirname = os.path.dirname(self.path)
+        makedirs(dirname)
+        with self.locked():
+            data = {} if self.cleared else self._read()
+            for key, value in self.dirty.iteritems():
+                if value is _deleted:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+
+            fd, tmp_path = tempfile.mkstemp(dir=dirname)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': self.version, 'entries': data}, f)
+            os.rename(tmp_path, self.path)
+
+        self.dirty = {}
+        self.cleared = False
+
+
+class StateStore(object):
+    """
+    Namespaces of persistent state kept as JSON files in `dirname`. State
+    saved by other `version' of the store is discarded.
+    """
+
+    def __init__(self, dirname, version):
+        self.dirname = dirname
+        self.version = version
+        self.namespaces = {}
+
+    def namespace(self, name):
+        try:
+            return self.namespaces[name]
+        except KeyError:
+            namespace = Namespace(os.path.join(self.dirname, name + '.json'), self.version)
+            self.namespaces[name] = namespace
+            return namespace
+
+    def save(self):
+        for namespace in self.namespaces.itervalues():
+            namespace.save()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8; -*-
+
+import os
+import re
+import json
+import time
+import threading
+
+from contextlib import contextmanager
+
+
+class Trace(object):
+    """
+    Timings of build steps that could be saved in Chrome trace event
+    format and viewed with chrome://tracing or https://ui.perfetto.dev.
+
+    Steps could be recorded from several threads at once; every thread
+    gets its own lane in the viewer.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.events = []
+        self.lock = threading.Lock()
+        self.threads = {}
+
+    @contextmanager
+    def span(self, name, category, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.time(), **args)
+
+    def add(self, name, category, start, end, **args):
+        with self.lock:
+            self._add(threading.current_thread().ident, name, category, start, end, args)
+
+    def _add(self, lane, name, category, start, end, args):
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int((start - self.started) * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': self.threads.setdefault(lane, len(self.threads) + 1),
+            'args': args,
+        })
+
+    def merge(self, path):
+        """
+        Add steps other processes logged into the file at `path`, one per
+        line: start and end times in seconds since the epoch, category,
+        group or `-' and name separated by spaces. Steps that overlap get
+        lanes of their own.
+        """
+        seconds = lambda s: float(re.match(r'\d+(\.\d+)?', s).group())
+        steps = []
+        with open(path) as f:
+            for line in f:
+                parts = line.rstrip('\n').split(' ', 4)
+                if len(parts) < 5:
+                    continue
+                start, end, category, group, name = parts
+                steps.append((seconds(start), seconds(end), category,
+                              None if group == '-' else group, name))
+
+        lanes = []
+        steps.sort()
+        with self.lock:
+            for start, end, category, group, name in steps:
+                for lane, busy_until in enumerate(lanes):
+                    if busy_until <= start:
+                        break
+                else:
+                    lane = len(lanes)
+                    lanes.append(None)
+                lanes[lane] = end
+                self._add((path, lane), name, category, start, end, {'group': group})
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def slowest(self, category, n):
+        """
+        Return up to `n` events of `category` that took the longest.
+        """
+        events = [e for e in self.events if e['cat'] == category]
+        events.sort(key=lambda e: e['dur'], reverse=True)
+        return events[:n]
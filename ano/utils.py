@@ -1,5 +1,6 @@
 # -*- coding: utf-8; -*-
 
+import os
 import os.path
 import itertools
 
@@ -10,6 +11,16 @@ except ImportError:
     # Python < 2.7
     from ordereddict import OrderedDict
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python < 3.5
+        from scandir import scandir
+    except ImportError:
+        # entries are stat'ed one by one then
+        scandir = None
+
 
 class SpaceList(list):
     def __add__(self, other):
@@ -37,15 +48,92 @@ class FileMap(OrderedDict):
         return SpaceList(x.path for x in self.targets())
 
 
-def list_subdirs(dirname, recursive=False, exclude=[]):
+def makedirs(dirname):
+    """
+    Create `dirname` with all intermediate directories unless it exists.
+    Safe to be called concurrently for the same path.
+    """
+    if os.path.isdir(dirname):
+        return
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        if not os.path.isdir(dirname):
+            raise
+
+
+def write_if_changed(path, contents):
+    """
+    Write `contents` to `path` unless it has them already, so that its
+    modification time changes only along with them.
+    """
+    try:
+        with open(path) as f:
+            if f.read() == contents:
+                return
+    except IOError:
+        pass
+    makedirs(os.path.dirname(path))
+    with open(path, 'wt') as f:
+        f.write(contents)
+
+
+class DirectoryIndex(object):
+    """
+    Snapshot of directory listings to be shared by all globs and
+    subdirectory searches of a build, so that every directory is listed
+    once. With scandir, types of entries come with the listing instead
+    of a stat call per entry.
+
+    Listings of directories modified after they are read must be
+    `invalidate'd.
+    """
+
+    def __init__(self):
+        self.listings = {}
+
+    def listdir(self, dirname):
+        """
+        Return a list of (name, is_dir, is_file) tuples for entries of
+        `dirname` in the order os.listdir gives them. An empty list is
+        returned for a missing directory.
+        """
+        try:
+            return self.listings[dirname]
+        except KeyError:
+            pass
+
+        try:
+            if scandir is not None:
+                listing = [(entry.name, entry.is_dir(), entry.is_file())
+                           for entry in scandir(dirname)]
+            else:
+                listing = []
+                for name in os.listdir(dirname):
+                    path = os.path.join(dirname, name)
+                    listing.append((name, os.path.isdir(path), os.path.isfile(path)))
+        except OSError:
+            listing = []
+
+        self.listings[dirname] = listing
+        return listing
+
+    def invalidate(self, dirname):
+        prefix = os.path.join(dirname, '')
+        for key in self.listings.keys():
+            if key == dirname or key.startswith(prefix):
+                del self.listings[key]
+
+
+def list_subdirs(dirname, recursive=False, exclude=[], index=None):
     if dirname is None:
         return []
-    entries = [e for e in os.listdir(dirname) if e not in exclude and not e.startswith('.')]
-    paths = [os.path.join(dirname, e) for e in entries]
-    dirs = filter(os.path.isdir, paths)
+    index = index or DirectoryIndex()
+    dirs = [os.path.join(dirname, name) for name, is_dir, _ in index.listdir(dirname)
+            if is_dir and name not in exclude and not name.startswith('.')]
     if recursive:
         sub = itertools.chain.from_iterable(
-            list_subdirs(d, recursive=True, exclude=exclude) for d in dirs)
+            list_subdirs(d, recursive=True, exclude=exclude, index=index) for d in dirs)
         dirs.extend(sub)
     return dirs
 
@@ -0,0 +1,109 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8; -*-
+
+"""\
+Compare sketch prototype extraction of `ano preproc' against the
+regex-based implementation it replaced on large synthetic sketches.
+
+    python benchmarks/preproc.py [--size KB] [--repeat N]
+"""
+
+import argparse
+import os.path
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ano.commands.preproc import Preprocess
+
+
+class LegacyPreprocess(object):
+    """
+    Prototype extraction as it was done before the single-pass lexer:
+    strip comments and strings with a regex, collapse braces char by
+    char, then run a prototype regex over the result.
+    """
+
+    def prototypes(self, src):
+        src = self.collapse_braces(self.strip(src))
+        regex = re.compile("[\\w\\[\\]\\*]+\\s+[&\\[\\]\\*\\w\\s]+\\([&,\\[\\]\\*\\w\\s]*\\)(?=\\s*\\{)")
+        matches = regex.findall(src)
+        return [m + ';' for m in matches]
+
+    def collapse_braces(self, src):
+        result = []
+        nesting = 0;
+
+        for c in src:
+            if not nesting:
+                result.append(c)
+            if c == '{':
+                nesting += 1
+            elif c == '}':
+                nesting -= 1
+                result.append(c)
+
+        return ''.join(result)
+
+    def strip(self, src):
+        p = "('.')"
+        p += "|(\"(?:[^\"\\\\]|\\\\.)*\")"
+        p += "|(//.*?$)|(/\\*[^*]*(?:\\*(?!/)[^*]*)*\\*/)"
+        p += "|" + "(^\\s*#.*?$)"
+
+        regex = re.compile(p, re.MULTILINE)
+        return regex.sub(' ', src)
+
+
+def synthetic_sketch(size, seed=0):
+    """
+    Generate a sketch of about `size` bytes: functions, comments,
+    strings and big PROGMEM lookup tables like generated code has.
+    """
+    rnd = random.Random(seed)
+    parts = ['#include <avr/pgmspace.h>\n', '// generated sketch\n']
+    n = 0
+    while sum(map(len, parts)) < size:
+        n += 1
+        kind = rnd.randint(0, 3)
+        if kind == 0:
+            values = ', '.join('0x%02x' % rnd.randint(0, 255) for _ in range(4096))
+            parts.append('const uint8_t table%d[] PROGMEM = {\n  %s\n};\n' % (n, values))
+        elif kind == 1:
+            parts.append('/* block comment %d { with braces } */\n' % n)
+            parts.append('static const char *msg%d = "text { %d }";\n' % (n, n))
+        else:
+            parts.append('int func%d(int a, char *b)\n{\n' % n)
+            parts.append('  if (a > %d) { return a; }\n' % n)
+            parts.append('  // comment { \n  return b[0] + \'{\';\n}\n\n')
+    parts.append('void setup() {\n}\n\nvoid loop() {\n}\n')
+    return ''.join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, action='append',
+                        help='Sketch size in KB, may be repeated (default: 64, 512, 4096)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Best of N runs is reported (default: %(default)s)')
+    args = parser.parse_args()
+
+    legacy = LegacyPreprocess()
+    lexer = Preprocess(None)
+
+    print '%10s %12s %12s %8s %8s' % ('size, KB', 'legacy, s', 'lexer, s', 'speedup', 'same')
+    for size in args.size or [64, 512, 4096]:
+        src = synthetic_sketch(size * 1024)
+        old_time = min(timeit.repeat(lambda: legacy.prototypes(src), number=1, repeat=args.repeat))
+        new_time = min(timeit.repeat(lambda: lexer.prototypes(src), number=1, repeat=args.repeat))
+        same = legacy.prototypes(src) == lexer.prototypes(src)
+        print '%10d %12.3f %12.3f %7.1fx %8s' % (size, old_time, new_time,
+                                                 old_time / new_time, same)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8; -*-
+
+"""\
+Compare clean build times of `ano build' with and without --unity on a
+synthetic project with many small sources in `src' and in a library.
+
+    python benchmarks/unity.py -d ARDUINO_DIST [--files N] [--batch N]
+                               [--repeat N] [-- BUILD_ARGS...]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+checkout = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ano = os.path.join(checkout, 'bin', 'ano')
+
+
+def write(path, contents):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+def synthetic_project(root, files):
+    """
+    Generate a project of `files` sources in `src' and as many in a
+    `lib/Parts' library, every one including Arduino.h and defining a few
+    small functions like drivers and helpers do.
+    """
+    write(os.path.join(root, 'lib', 'Parts', 'Parts.h'),
+          ''.join('int part%d(int);\n' % i for i in range(files)))
+    for i in range(files):
+        write(os.path.join(root, 'lib', 'Parts', 'part%d.cpp' % i),
+              '#include <Arduino.h>\n#include "Parts.h"\n'
+              'int part%d(int x) { return x * %d + millis(); }\n' % (i, i))
+        write(os.path.join(root, 'src', 'module%d.cpp' % i),
+              '#include <Arduino.h>\n#include <Parts.h>\n#include <stdlib.h>\n#include <string.h>\n'
+              'int module%d(int x) {\n  pinMode(%d, 1);\n'
+              '  return part%d(x) + %d;\n}\n' % (i, i % 14, i, i))
+
+    write(os.path.join(root, 'src', 'sketch.ino'),
+          '#include <Parts.h>\n' +
+          ''.join('int module%d(int);\n' % i for i in range(files)) +
+          'void setup() {\n}\n\nvoid loop() {\n' +
+          ''.join('  module%d(%d);\n' % (i, i) for i in range(files)) + '}\n')
+
+
+def build_time(root, args):
+    shutil.rmtree(os.path.join(root, '.build_ano'), ignore_errors=True)
+    start = time.time()
+    # ano of this checkout is measured
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [checkout] + filter(None, [os.environ.get('PYTHONPATH')])))
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, ano, 'build'] + args,
+                              cwd=root, stdout=devnull, env=env)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', '--arduino-dist', required=True,
+                        help='Arduino distribution to build with')
+    parser.add_argument('--files', type=int, default=48,
+                        help='Sources in src and in the library (default: %(default)s)')
+    parser.add_argument('--batch', type=int, action='append',
+                        help='--unity batch size, may be repeated (default: 4, 8, 16)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Best of N builds is reported (default: %(default)s)')
+    parser.add_argument('build_args', nargs='*',
+                        help='More arguments for ano build, e.g. -j 1 or --pch')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='ano-unity-')
+    try:
+        synthetic_project(root, args.files)
+        common = ['-d', args.arduino_dist] + args.build_args
+        measure = lambda extra: min(build_time(root, common + extra)
+                                    for _ in range(args.repeat))
+
+        normal = measure([])
+        print '%12s %10s %8s' % ('mode', 'build, s', 'speedup')
+        print '%12s %10.2f %8s' % ('normal', normal, '')
+        for batch in args.batch or [4, 8, 16]:
+            unity = measure(['--unity', str(batch)])
+            print '%12s %10.2f %7.1fx' % ('unity %d' % batch, unity, normal / unity)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
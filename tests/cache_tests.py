@@ -0,0 +1,62 @@
+# -*- coding: utf-8; -*-
+
+import os.path
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_not_equal, assert_true, assert_false
+
+from ano.cache import ObjectCache
+
+
+class TestObjectCache(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = ObjectCache(os.path.join(self.tmp, 'cache'), max_size=100)
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_key_ignores_paths(self):
+        args = ['cc', '-Os', '-Ia', '-iquote', 'src', '-o', 'x.o', '-c', 'x.c']
+        other = ['cc', '-Os', '-Ib', '-Ic', '-o', 'y.o', '-c', 'x.c']
+        assert_equal(self.cache.key(args, 'int x;'), self.cache.key(other, 'int x;'))
+        assert_not_equal(self.cache.key(args, 'int x;'), self.cache.key(args, 'int y;'))
+        assert_not_equal(self.cache.key(args, 'int x;'),
+                         self.cache.key(['cc', '-O2'] + args[2:], 'int x;'))
+
+    def test_key_expands_response_files(self):
+        rsp = os.path.join(self.tmp, 'flags.rsp')
+        with open(rsp, 'w') as f:
+            f.write('-I"/some lib"\n-DX\n')
+        args = ['cc', '-Os', '@' + rsp, '-c', 'x.c']
+        assert_equal(self.cache.key(args, 'int x;'),
+                     self.cache.key(['cc', '-Os', '-Ia', '-DX', '-c', 'x.c'], 'int x;'))
+        assert_not_equal(self.cache.key(args, 'int x;'),
+                         self.cache.key(['cc', '-Os', '-c', 'x.c'], 'int x;'))
+
+    def test_store_and_lookup(self):
+        obj = os.path.join(self.tmp, 'x.o')
+        with open(obj, 'wb') as f:
+            f.write('object')
+
+        target = os.path.join(self.tmp, 'y.o')
+        assert_false(self.cache.lookup('abcdef', target))
+        self.cache.store('abcdef', obj)
+        assert_true(self.cache.lookup('abcdef', target))
+        assert_equal(open(target, 'rb').read(), 'object')
+
+        stats = self.cache.stats()
+        assert_equal((stats['hits'], stats['misses'], stats['entries']), (1, 1, 1))
+
+    def test_eviction(self):
+        obj = os.path.join(self.tmp, 'x.o')
+        with open(obj, 'wb') as f:
+            f.write('x' * 40)
+
+        for key in ['aa1', 'bb2', 'cc3']:
+            self.cache.store(key, obj)
+
+        # the oldest entries are removed to fit 90% of the limit
+        assert_equal(self.cache.stats()['entries'], 2)
+        assert_equal(self.cache.stats()['size'], 80)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8; -*-
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from cStringIO import StringIO
+from nose.tools import assert_equal, assert_raises
+
+from ano.commands import load_command, registry
+from ano.commands.build import Build, CapturedOutput
+from ano.environment import Environment
+from ano.exc import Abort
+
+
+class TestRegistry(object):
+    def test_registered_commands(self):
+        for name, (_, _, help_line) in registry.iteritems():
+            cls = load_command(name)
+            assert_equal((cls.name, cls.help_line), (name, help_line))
+
+
+class TestMatrix(object):
+    def test_targets(self):
+        build = Build(Environment())
+        args = argparse.Namespace(targets='uno, pro:8MHz,uno', cpu='uno')
+        assert_equal(build.matrix_targets(args),
+                     [('uno', 'uno', 'uno'), ('pro:8MHz', 'pro', '8MHz')])
+        # as ano.ini gives it
+        args.targets = ['mega2560']
+        assert_equal(build.matrix_targets(args), [('mega2560', 'mega2560', 'uno')])
+
+    def test_captured_output(self):
+        stream = StringIO()
+        output = CapturedOutput(stream)
+
+        def target():
+            with output.capture() as lines:
+                output.write('target\n')
+                output.forward(output.write)('forwarded\n')
+                thread = threading.Thread(target=output.forward(output.write),
+                                          args=['pool\n'])
+                thread.start()
+                thread.join()
+            captured.extend(lines)
+
+        captured = []
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+        output.write('main\n')
+        assert_equal(captured, ['target\n', 'forwarded\n', 'pool\n'])
+        assert_equal(stream.getvalue(), 'main\n')
+
+
+class RecordingBuild(Build):
+    def build(self, args):
+        print 'building for', args.board_model
+        if args.board_model == 'mega':
+            raise Abort('mega is broken')
+        self.e.sizes['profiles'] = {args.profile: [100, 10]}
+        self.e.user_state.namespace('headers')[args.board_model] = []
+        return True
+
+
+class TestMatrixBuild(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        core_dir = os.path.join(self.tmp, 'dist', 'hardware', 'arduino', 'avr')
+        os.makedirs(core_dir)
+        with open(os.path.join(core_dir, 'boards.txt'), 'w') as f:
+            for model in ['uno', 'mega']:
+                f.write('%s.upload.maximum_size=1000\n%s.upload.maximum_data_size=100\n' %
+                        (model, model))
+
+        class TestEnvironment(Environment):
+            cache_dir = os.path.join(self.tmp, 'cache')
+            output_dir = os.path.join(self.tmp, 'project', '.build_ano')
+            arduino_user_dir_guesses = []
+
+        self.e = TestEnvironment()
+        self.e.load()
+        self.args = argparse.Namespace(
+            matrix=True, targets='uno,mega', board_model='uno', cpu=None, jobs=2,
+            profile='size', trace=None, arduino_dist=os.path.join(self.tmp, 'dist'))
+        self.e.process_args(self.args)
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+
+    def teardown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmp)
+
+    def test_build_matrix(self):
+        stdout = sys.stdout
+        assert_raises(Abort, RecordingBuild(self.e).run, self.args)
+        assert 'building for uno' in stdout.getvalue()
+        assert 'mega is broken' in stdout.getvalue()
+
+        # state of all targets is saved with the main environment
+        self.e.dump()
+        e = self.e.__class__()
+        e.load()
+        assert_equal(sorted(e.user_state.namespace('headers').data), ['uno'])
+        e.process_args(self.args)
+        assert_equal(e.sizes['profiles'], {'size': [100, 10]})
+
+
+class TestBudget(object):
+    def setup(self):
+        self.build = Build(Environment())
+        self.build.e.sizes = {}
+        self.build.memory_limits = lambda args: (1000, 100)
+        self.parser = argparse.ArgumentParser()
+        self.build.setup_arg_parser(self.parser)
+        # as ano.ini would set it
+        self.parser.set_defaults(flash_budget='90')
+        self.args = self.parser.parse_args(['-m', 'uno'])
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+
+    def teardown(self):
+        sys.stdout = self.stdout
+
+    def check(self, flash, sram):
+        self.build.check_budget(self.args, flash, sram,
+                                {'.text': flash - 10, '.data': 10, '.bss': sram - 10})
+
+    def test_budgets(self):
+        self.check(900, 75)
+        assert_raises(Abort, self.check, 901, 75)
+        assert_raises(Abort, self.check, 900, 76)
+
+        # set for the board model in ano.ini
+        setattr(self.args, 'flash_budget.uno', '80')
+        assert_raises(Abort, self.check, 900, 75)
+        setattr(self.args, 'flash_budget.mega', '95')
+        self.check(800, 75)
+
+    def test_command_line_wins(self):
+        self.parser.set_defaults(**{'flash_budget.uno': '80', 'ram_budget.uno': '50'})
+        self.args = self.parser.parse_args(['-m', 'uno', '--flash-budget', '95'])
+        self.check(950, 50)
+        assert_raises(Abort, self.check, 950, 51)
+
+        # errors name the setting that holds the value
+        setattr(self.args, 'flash_budget.uno', 'lots')
+        self.args.flash_budget = 90.0
+        with assert_raises(Abort) as cm:
+            self.check(950, 50)
+        assert_equal(str(cm.exception), 'flash_budget.uno should be a percentage, not lots')
+        delattr(self.args, 'flash_budget.uno')
+        self.args.flash_budget = 'lots'
+        with assert_raises(Abort) as cm:
+            self.check(950, 50)
+        assert_equal(str(cm.exception), '--flash-budget should be a percentage, not lots')
+
+    def test_growth(self):
+        # the baseline is of the release profile, this build of another one
+        self.build.e.sizes['baseline'] = ['release', 500, 50, {'.text': 490, '.data': 10}]
+        self.check(510, 50)
+        assert_raises(Abort, self.check, 511, 50)
+        assert_raises(Abort, self.check, 510, 52)
+        assert 'since the baseline of the release profile' in sys.stdout.getvalue()
+
+        # older baselines lack sections
+        self.build.e.sizes['baseline'] = ['release', 500, 50]
+        assert_raises(Abort, self.check, 511, 50)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8; -*-
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ano.conf import Configuration
+
+
+class TestConfiguration(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'ano.ini')
+        with open(self.path, 'w') as f:
+            f.write('verbose = yes\n[build]\nobject-cache = on\nboard_model = on\ncpu = no\n')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_switches(self):
+        cfg = Configuration(self.path)
+        assert_equal(cfg.as_dict('build', ['verbose', 'object_cache']), {
+            'verbose': True,
+            'object_cache': True,
+            'board_model': 'on',
+            'cpu': 'no',
+        })
@@ -0,0 +1,165 @@
+# -*- coding: utf-8; -*-
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+from cStringIO import StringIO
+from nose.tools import assert_equal, assert_in, assert_raises
+
+from ano.commands.size import Size
+from ano.elf import SHF_ALLOC, SHF_WRITE, SHT_NOBITS, SHT_SYMTAB, STB_LOCAL, STT_FILE, \
+    STT_FUNC, STT_OBJECT, ElfError, ElfFile, archive_members
+from ano.environment import Environment
+
+
+def elf32(sections, symbols):
+    """
+    Return contents of a little-endian ELF32 file with `sections` given
+    as (name, type, flags, size) and a symbol table of `symbols` given as
+    (name, size, type, bind, section index).
+    """
+    names = '\0'
+    strtab = '\0'
+    symtab = '\0' * 16
+    for name, size, type, bind, shndx in symbols:
+        symtab += struct.pack('<IIIBBH', len(strtab), 0, size, bind << 4 | type, 0, shndx)
+        strtab += name + '\0'
+
+    body = ''
+    headers = [struct.pack('<10I', *[0] * 10)]
+    all_sections = sections + [('.symtab', SHT_SYMTAB, 0, symtab),
+                               ('.strtab', 3, 0, strtab),
+                               ('.shstrtab', 3, 0, None)]
+    for name, type, flags, contents in all_sections:
+        names += name + '\0'
+    for name, type, flags, contents in all_sections:
+        if contents is None:
+            contents = names
+        size = contents if isinstance(contents, int) else len(contents)
+        offset = 52 + len(body)
+        if not isinstance(contents, int):
+            body += contents
+        elif type != SHT_NOBITS:
+            body += '\0' * contents
+        link = len(sections) + 2 if type == SHT_SYMTAB else 0
+        headers.append(struct.pack('<10I', names.index('\0' + name + '\0') + 1, type, flags,
+                                   0, offset, size, link, 0, 1, 16 if type == SHT_SYMTAB else 0))
+
+    ident = '\x7fELF\x01\x01\x01' + '\0' * 9
+    header = struct.pack('<HHIIIIIHHHHHH', 1, 83, 1, 0, 0, 52 + len(body), 0,
+                         52, 0, 0, 40, len(headers), len(headers) - 1)
+    return ident + header + body + ''.join(headers)
+
+
+def archive(members):
+    contents = '!<arch>\n'
+    long_names = ''.join(name + '/\n' for name, _ in members if len(name) > 15)
+    if long_names:
+        contents += '%-16s%-12s%-6s%-6s%-8s%-10d`\n' % ('//', '', '', '', '', len(long_names))
+        contents += long_names + '\n' * (len(long_names) & 1)
+    for name, data in members:
+        if len(name) > 15:
+            name = '/%d' % long_names.index(name + '/\n')
+        else:
+            name += '/'
+        contents += '%-16s%-12d%-6d%-6d%-8s%-10d`\n' % (name, 42, 0, 0, '644', len(data))
+        contents += data + '\n' * (len(data) & 1)
+    return contents
+
+
+class TestElfFile(object):
+    def setup(self):
+        sections = [
+            ('.text', 1, 0x6, 10),
+            ('.data', 1, SHF_ALLOC | SHF_WRITE, 3),
+            ('.bss', SHT_NOBITS, SHF_ALLOC | SHF_WRITE, 8),
+            ('.eeprom', 1, SHF_ALLOC | SHF_WRITE, 2),
+            ('.comment', 1, 0, 5),
+        ]
+        symbols = [
+            ('a.c', 0, STT_FILE, STB_LOCAL, 0xfff1),
+            ('counter', 8, STT_OBJECT, STB_LOCAL, 3),
+            ('main', 10, STT_FUNC, 1, 1),
+            ('value', 3, STT_OBJECT, 1, 2),
+            ('external', 0, 0, 1, 0),
+        ]
+        self.contents = elf32(sections, symbols)
+
+    def test_sections(self):
+        elf = ElfFile(StringIO(self.contents))
+        usage = [(s.name, s.size, s.in_flash, s.in_ram) for s in elf.sections[1:6]]
+        assert_equal(usage, [
+            ('.text', 10, True, False),
+            ('.data', 3, True, True),
+            ('.bss', 8, False, True),
+            ('.eeprom', 2, False, False),
+            ('.comment', 5, False, False),
+        ])
+
+    def test_symbols(self):
+        elf = ElfFile(StringIO(self.contents))
+        elf.chunk_symbols = 2
+        symbols = [(s.name, s.size, s.shndx, s.is_defined) for s in elf.symbols()]
+        assert_equal(symbols, [
+            ('a.c', 0, 0xfff1, False),
+            ('counter', 8, 3, True),
+            ('main', 10, 1, True),
+            ('value', 3, 2, True),
+            ('external', 0, 0, False),
+        ])
+
+    def test_not_elf(self):
+        assert_raises(ElfError, ElfFile, StringIO('!<arch>\n'))
+
+    def test_archive_members(self):
+        contents = archive([('a.c.o', self.contents), ('a_rather_long_name.cpp.o', 'x')])
+        f = StringIO(contents)
+        members = list(archive_members(f))
+        assert_equal([(name, mtime, size) for name, mtime, _, size in members],
+                     [('a.c.o', 42, len(self.contents)), ('a_rather_long_name.cpp.o', 42, 1)])
+
+        elf = ElfFile(f, members[0][2])
+        assert_equal([s.name for s in elf.symbols()][:2], ['a.c', 'counter'])
+
+
+class TestSizeReport(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        e = Environment()
+        e['src_dir'] = 'src'
+        e['build_dir'] = self.tmp
+        e.build_state = {}
+        self.size = Size(e)
+
+        os.makedirs(os.path.join(self.tmp, 'A'))
+        member = elf32([('.text', 1, 0x6, 30)], [('main', 30, STT_FUNC, 1, 1),
+                                                  ('helper', 0, 0, 1, 0)])
+        with open(os.path.join(self.tmp, 'A', 'libA.a'), 'wb') as f:
+            f.write(archive([('a.c.o', member)]))
+
+        self.elf_path = os.path.join(self.tmp, 'firmware.elf')
+        with open(self.elf_path, 'wb') as f:
+            f.write(elf32([('.text', 1, 0x6, 100)], [('main', 30, STT_FUNC, 1, 1),
+                                                      ('helper', 20, STT_FUNC, 1, 1)]))
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_report(self):
+        report = self.size.report(self.elf_path)
+        assert_equal(report['usage'], [100, 0])
+        assert_equal(report['libraries'], {'A': [30, 0], '(other)': [70, 0]})
+        assert_equal(report['objects'], {'A/a.c.o': [30, 0], '(other)': [70, 0]})
+        assert_equal([(s['name'], s['library']) for s in report['symbols']],
+                     [('main', 'A'), ('helper', '(other)')])
+
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.size.print_report(report, 10)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        assert_in('  (other)                                      70        0\n', output)
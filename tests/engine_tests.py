@@ -0,0 +1,68 @@
+# -*- coding: utf-8; -*-
+
+import os.path
+import shutil
+import tempfile
+import time
+
+from nose.tools import assert_equal, assert_raises
+
+from ano.engine import BuildFailed, ConcatTask, Executor, Task, parse_depfile
+
+
+class FailingTask(Task):
+    def execute(self):
+        return 2, 'failed'
+
+
+class TestExecutor(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, name, contents=None):
+        path = os.path.join(self.tmp, name)
+        if contents is not None:
+            with open(path, 'w') as f:
+                f.write(contents)
+        return path
+
+    def executor(self, *tasks):
+        executor = Executor(self.path('state.json'), jobs=2)
+        executor.extend(tasks)
+        return executor
+
+    def test_parse_depfile(self):
+        depfile = self.path('x.d', 'x.d build/x.o: src/x.cpp \\\n src/x.h lib/a\\ b.h\nsrc/x.h:\n')
+        assert_equal(parse_depfile(depfile), ['src/x.cpp', 'src/x.h', 'lib/a b.h'])
+        assert_equal(parse_depfile(self.path('missing.d')), [])
+
+    def test_rebuilds_stale_targets(self):
+        a, b = self.path('a', 'a'), self.path('b', 'b')
+        ab, out = self.path('ab'), self.path('out')
+        tasks = [ConcatTask(ab, [a, b]), ConcatTask(out, [ab, a])]
+        self.executor(*tasks).run([out])
+        assert_equal(open(out).read(), 'aba')
+
+        # inputs are older than targets now
+        past = time.time() - 10
+        os.utime(a, (past, past))
+        os.utime(b, (past, past))
+        os.remove(ab)
+        self.executor(*tasks).run([out])
+        assert_equal(open(out).read(), 'aba')
+
+        # removed input changes the signature
+        self.executor(ConcatTask(ab, [a, b]), ConcatTask(out, [ab])).run([out])
+        assert_equal(open(out).read(), 'ab')
+
+    def test_reports_first_failure(self):
+        out = self.path('out')
+        executor = self.executor(FailingTask(self.path('x'), [], source='x.cpp'),
+                                 ConcatTask(out, [self.path('x')]))
+        with assert_raises(BuildFailed) as cm:
+            executor.run([out])
+        assert_equal((cm.exception.returncode, cm.exception.source), (2, 'x.cpp'))
+        assert not os.path.exists(out)
@@ -1,8 +1,12 @@
 # -*- coding: utf-8; -*-
 
-from nose.tools import assert_equal
+import os
+import shutil
+import tempfile
 
-from ano.environment import Version
+from nose.tools import assert_equal, assert_is_none
+
+from ano.environment import BoardModels, Environment, Version
 
 
 class TestVersion(object):
@@ -18,3 +22,98 @@ class TestVersion(object):
         assert_equal(Version(1, 0, 0).as_int(), 100)
         assert_equal(Version(1, 0, 5).as_int(), 105)
         assert_equal(Version(1, 5, 1).as_int(), 151)
+
+
+class TestBoardModels(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.core_dir = os.path.join(self.tmp, 'hardware', 'arduino', 'avr')
+        os.makedirs(self.core_dir)
+        self.boards_txt = os.path.join(self.core_dir, 'boards.txt')
+        with open(self.boards_txt, 'w') as f:
+            f.write('\n'.join([
+                '# comment',
+                'menu.cpu=Processor',
+                'pro.name=Arduino Pro',
+                'pro.build.mcu=atmega328p',
+                'pro.menu.cpu.8MHz=ATmega168',
+                'pro.menu.cpu.8MHz.build.mcu=atmega168',
+            ]))
+        self.index_path = os.path.join(self.tmp, 'cache', 'boards.json')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_lookup(self):
+        models = BoardModels.parse([self.boards_txt])
+        assert_equal(models.keys(), ['menu', 'pro'])
+        assert_equal(models.name('pro'), 'Arduino Pro')
+        assert_is_none(models.name('menu'))
+        assert_equal(models['pro']['menu']['cpu']['8MHz'],
+                     {'_': 'ATmega168', 'build': {'mcu': 'atmega168'}})
+        assert_equal(models['pro']['_coredir'], self.core_dir)
+        assert_equal(BoardModels.getValueForVariant(models['pro'], '8MHz', 'build', 'mcu'), 'atmega168')
+        assert_equal(BoardModels.getValueForVariant(models['pro'], None, 'build', 'mcu'), 'atmega328p')
+
+    def test_index(self):
+        assert_is_none(BoardModels.load(self.index_path))
+        BoardModels.parse([self.boards_txt]).save(self.index_path)
+
+        models = BoardModels.load(self.index_path)
+        assert_equal(models.entries, BoardModels.parse([self.boards_txt]).entries)
+        assert_equal(models['pro']['build'], {'mcu': 'atmega328p'})
+
+        # a modified file invalidates the index
+        with open(self.boards_txt, 'a') as f:
+            f.write('\npro.build.f_cpu=8000000L')
+        assert_is_none(BoardModels.load(self.index_path))
+
+
+class TestDiscoveryCache(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.first, self.second = os.path.join(self.tmp, 'a'), os.path.join(self.tmp, 'b')
+        for dirname in [self.first, self.second]:
+            os.makedirs(dirname)
+            open(os.path.join(dirname, 'avr-gcc'), 'w').close()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def find(self, places, multi=False):
+        e = Environment()
+        e.cache_dir = os.path.join(self.tmp, 'cache')
+        e.output_dir = os.path.join(self.tmp, 'project')
+        e.load()
+        try:
+            return e.find_dir('cc', ['avr-gcc'], places, multi=multi, optional=True)
+        finally:
+            e.dump()
+
+    def test_cached_result_is_validated(self):
+        assert_equal(self.find([self.second]), self.second)
+
+        # other places make another key
+        assert_equal(self.find([self.first, self.second]), self.first)
+
+        # cached location is used while the entry found there exists
+        assert_equal(self.find([self.first, self.second]), self.first)
+        os.remove(os.path.join(self.first, 'avr-gcc'))
+        assert_equal(self.find([self.first, self.second]), self.second)
+
+        # misses are cached until a place is modified
+        shutil.rmtree(self.second)
+        assert_equal(self.find([self.second]), [])
+        assert_equal(self.find([self.second]), [])
+        os.makedirs(self.second)
+        open(os.path.join(self.second, 'avr-gcc'), 'w').close()
+        assert_equal(self.find([self.second]), self.second)
+
+    def test_all_matches_are_searched_for(self):
+        places = [os.path.join(self.tmp, '*')]
+        assert_equal(sorted(self.find(places, multi=True)), [self.first, self.second])
+
+        third = os.path.join(self.tmp, 'c')
+        os.makedirs(third)
+        open(os.path.join(third, 'avr-gcc'), 'w').close()
+        assert_equal(sorted(self.find(places, multi=True)), [self.first, self.second, third])
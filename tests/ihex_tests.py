@@ -0,0 +1,47 @@
+# -*- coding: utf-8; -*-
+
+from nose.tools import assert_equal, assert_raises
+
+from ano.ihex import HexError, changed_pages, paginate, parse
+
+
+def record(address, kind, data):
+    body = bytearray([len(data), address >> 8, address & 0xff, kind]) + bytearray(data)
+    return ':%s%02X\n' % (str(body).encode('hex').upper(), -sum(body) & 0xff)
+
+
+class TestIntelHex(object):
+    def test_parse(self):
+        lines = [
+            record(0x0000, 0, 'abcd'),
+            record(0x0004, 0, 'ef'),
+            record(0x0010, 0, 'gh'),
+            record(0x0000, 4, '\x00\x01'),
+            record(0x0000, 0, 'ij'),
+            record(0x0000, 1, ''),
+            record(0x0020, 0, 'ignored'),
+        ]
+        assert_equal(parse(lines), [(0, 'abcdef'), (0x10, 'gh'), (0x10000, 'ij')])
+
+    def test_errors(self):
+        assert_raises(HexError, parse, ['0000000000\n'])
+        assert_raises(HexError, parse, [':0100000041BF\n'])
+        assert_raises(HexError, parse, [':02000000414100\n'])
+        assert_raises(HexError, parse, [':0x\n'])
+
+    def test_paginate(self):
+        pages = paginate([(2, 'abcdef'), (12, 'gh')], 4)
+        assert_equal(pages.items(), [
+            (0, '\xff\xffab'),
+            (4, 'cdef'),
+            (12, 'gh\xff\xff'),
+        ])
+
+    def test_changed_pages(self):
+        old = paginate([(0, 'abcdefgh')], 4)
+        new = paginate([(0, 'abcdxfghij')], 4)
+        assert_equal(changed_pages(old, new).items(), [
+            (4, 'xfgh'),
+            (8, 'ij\xff\xff'),
+        ])
+        assert_equal(changed_pages(new, new).items(), [])
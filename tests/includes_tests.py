@@ -0,0 +1,102 @@
+# -*- coding: utf-8; -*-
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_raises
+
+from ano.includes import ComputedInclude, ConditionalInclude, HeaderIndex, IncludeResolver, \
+    parse_includes
+
+
+def test_parse_includes():
+    contents = '#include "a.h"\n  # include <b/c.h>\n/* #include <d.h> */\n// #include <e.h>\n'
+    assert_equal(parse_includes('x.c', contents), [('a.h', True, False), ('b/c.h', False, False)])
+    assert_raises(ComputedInclude, parse_includes, 'x.c', '#include HEADER\n')
+
+
+def test_conditional_includes():
+    contents = '\n'.join([
+        '#ifndef X_H',
+        '#define X_H',
+        '#include <a.h>',
+        '#if defined(ARDUINO_ARCH_SAM)',
+        '#  include <b.h>',
+        '#else',
+        '#  ifndef F_CPU',
+        '#    include <c.h>',
+        '#  endif',
+        '#endif',
+        '#include <d.h>',
+        '#endif',
+    ])
+    assert_equal(parse_includes('x.h', contents), [
+        ('a.h', False, False),
+        ('b.h', False, True),
+        ('c.h', False, True),
+        ('d.h', False, False),
+    ])
+
+
+class TestIncludeResolver(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        files = {
+            'core/Arduino.h': '',
+            'libs/Servo/Servo.h': '#include "utility/timer.h"\n',
+            'libs/Servo/utility/timer.h': '#include <Arduino.h>\n',
+            'libs/Other/Servo.h': '',
+            'src/main.cpp': '#include "local.h"\n#include <Servo.h>\n#include <avr/io.h>\n',
+            'src/local.h': '#include <timer.h>\n',
+        }
+        for path, contents in files.iteritems():
+            path = self.path(path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+
+        self.core = self.path('core')
+        self.libs = [self.core, self.path('libs/Other'), self.path('libs/Servo')]
+        self.cache = {}
+        self.resolver = IncludeResolver([self.core], HeaderIndex(self.libs, self.cache))
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def test_dependencies(self):
+        servo = self.path('libs/Servo')
+        assert_equal(self.resolver.dependencies(self.path('src/main.cpp'), self.path('src')), [
+            (self.path('src/local.h'), self.path('src')),
+            (self.path('libs/Servo/utility/timer.h'), servo),
+            (self.path('core/Arduino.h'), self.core),
+            (self.path('libs/Servo/Servo.h'), servo),
+        ])
+        # Arduino.h is found in the core include directory
+        assert_equal(self.resolver.search_dirs,
+                     {servo: set([servo, self.path('libs/Servo/utility')])})
+
+    def test_index_cache(self):
+        assert_equal(self.cache[self.path('libs/Servo')]['headers'],
+                     ['Servo.h', 'utility/timer.h'])
+        self.cache[self.path('libs/Servo')]['headers'] = ['Cached.h']
+        assert_equal(HeaderIndex(self.libs, self.cache).lookup('Cached.h'),
+                     (self.path('libs/Servo'), self.path('libs/Servo/Cached.h')))
+
+    def test_conditional_library(self):
+        with open(self.path('src/main.cpp'), 'w') as f:
+            f.write('#ifdef ARDUINO_ARCH_SAM\n#include <Arduino.h>\n#endif\n')
+        # the core is fine
+        assert_equal(self.resolver.dependencies(self.path('src/main.cpp'), self.path('src')),
+                     [(self.path('core/Arduino.h'), self.core)])
+
+        # local.h includes a header of Servo
+        with open(self.path('src/main.cpp'), 'w') as f:
+            f.write('#ifdef ARDUINO_ARCH_SAM\n#include "local.h"\n#endif\n')
+        self.resolver.includes.clear()
+        assert_raises(ConditionalInclude, self.resolver.dependencies,
+                      self.path('src/main.cpp'), self.path('src'))
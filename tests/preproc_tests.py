@@ -0,0 +1,48 @@
+# -*- coding: utf-8; -*-
+
+from nose.tools import assert_equal
+
+from ano.commands.preproc import Preprocess, Prototype
+
+
+class TestPrototypes(object):
+    def setup(self):
+        self.preproc = Preprocess(None)
+
+    def test_functions(self):
+        src = '\n'.join([
+            '#include <Servo.h>',
+            'int led = 13;',
+            'void setup() {',
+            '  pinMode(led, OUTPUT);',
+            '}',
+            'static unsigned long',
+            'twice(int *x, char &c)',
+            '{ if (x) { return 2; } }',
+            'struct A { int f() { return 1; } };',
+        ])
+        prototypes, includes = self.preproc.scan(src)
+        assert_equal(prototypes, [
+            Prototype(2, 'void setup()'),
+            Prototype(5, 'static unsigned long\ntwice(int *x, char &c)'),
+        ])
+        assert_equal(includes, [0])
+
+    def test_stripped_constructs(self):
+        src = '\n'.join([
+            '/* void commented() { } */',
+            '// void commented() {',
+            'const char *s = "void quoted() {";',
+            'char c = \'{\';',
+            '#define BRACE {',
+            'void loop() { s = "}"; }',
+        ])
+        assert_equal(self.preproc.prototypes(src), ['void loop();'])
+
+    def test_includes_in_comments(self):
+        src = '/*\n#include <Skipped.h>\n*/\n  #include "real.h"\n'
+        assert_equal(self.preproc.scan(src)[1], [3])
+
+    def test_unterminated_comment(self):
+        src = 'void f() {}\n/* ' + '/* { ' * 10000
+        assert_equal(self.preproc.prototypes(src), ['void f();'])
@@ -0,0 +1,233 @@
+# -*- coding: utf-8; -*-
+
+import os
+import pty
+import struct
+import threading
+
+from nose.tools import assert_equal, assert_raises
+from serial import Serial
+
+from ano.programmers import Avr109, ProgrammerError, Stk500v1, Stk500v2
+from ano.utils import OrderedDict
+
+
+class Bootloader(threading.Thread):
+    """
+    A simulated bootloader with `flash` memory that answers `protocol`
+    on the slave end of a pty at `path`. The first `deaf` requests are
+    ignored as if it was still starting; with `corrupt` set every byte
+    written to flash gets its lowest bit flipped.
+    """
+
+    signature = '\x1e\x95\x0f'
+
+    def __init__(self, protocol, deaf=0, corrupt=False):
+        super(Bootloader, self).__init__()
+        self.daemon = True
+        self.master, self.slave = pty.openpty()
+        self.path = os.ttyname(self.slave)
+        self.protocol = protocol
+        self.deaf = deaf
+        self.corrupt = corrupt
+        self.flash = bytearray('\xff' * 0x8000)
+        self.address = 0
+
+    def read(self, size):
+        data = ''
+        while len(data) < size:
+            data += os.read(self.master, size - len(data))
+        return data
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def run(self):
+        handle = getattr(self, 'handle_' + self.protocol)
+        try:
+            while True:
+                handle()
+        except OSError:
+            # closed
+            pass
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+    def program(self, size):
+        data = bytearray(self.read(size))
+        if self.corrupt:
+            data = bytearray(byte ^ 1 for byte in data)
+        self.flash[self.address:self.address + size] = data
+
+    def handle_stk500v1(self):
+        command = self.read(1)
+        if command == '\x55':
+            self.address = struct.unpack('<H', self.read(2))[0] * 2
+        elif command in '\x64\x74':
+            size = struct.unpack('>H', self.read(2))[0]
+            self.read(1)
+            if command == '\x64':
+                self.program(size)
+        self.read(1)
+        if self.deaf:
+            self.deaf -= 1
+            return
+
+        answer = ''
+        if command == '\x75':
+            answer = self.signature
+        elif command == '\x74':
+            answer = str(self.flash[self.address:self.address + size])
+        self.write('\x14' + answer + '\x10')
+
+    def handle_stk500v2(self):
+        header = self.read(5)
+        body = self.read(struct.unpack('>H', header[2:4])[0])
+        self.read(1)
+        if self.deaf:
+            self.deaf -= 1
+            return
+
+        command = body[0]
+        answer = ''
+        if command == '\x01':
+            answer = '\x08AVRISP_2'
+        elif command == '\x06':
+            self.address = (struct.unpack('>I', body[1:5])[0] & 0x7fffffff) * 2
+        elif command == '\x13':
+            size = struct.unpack('>H', body[1:3])[0]
+            self.flash[self.address:self.address + size] = bytearray(
+                byte ^ 1 if self.corrupt else byte for byte in bytearray(body[10:]))
+        elif command == '\x14':
+            size = struct.unpack('>H', body[1:3])[0]
+            answer = str(self.flash[self.address:self.address + size]) + '\x00'
+        elif command == '\x1b':
+            answer = self.signature[ord(body[4])] + '\x00'
+
+        answer = command + '\x00' + answer
+        message = '\x1b' + header[1] + struct.pack('>H', len(answer)) + '\x0e' + answer
+        checksum = 0
+        for byte in bytearray(message):
+            checksum ^= byte
+        self.write(message + chr(checksum))
+
+    def handle_avr109(self):
+        command = self.read(1)
+        if command == 'A':
+            self.address = struct.unpack('>H', self.read(2))[0] * 2
+        elif command in 'Bg':
+            size = struct.unpack('>H', self.read(2))[0]
+            self.read(1)
+            if command == 'B':
+                self.program(size)
+        if self.deaf:
+            self.deaf -= 1
+            return
+
+        if command == 'S':
+            self.write('CATERIN')
+        elif command == 'b':
+            self.write('Y\x00\x40')
+        elif command == 's':
+            self.write(self.signature[::-1])
+        elif command == 'g':
+            self.write(str(self.flash[self.address:self.address + size]))
+        else:
+            self.write('\r')
+
+
+class TestProgrammers(object):
+    def setup(self):
+        self.bootloaders = []
+        self.ports = []
+
+    def teardown(self):
+        for port in self.ports:
+            port.close()
+        for bootloader in self.bootloaders:
+            bootloader.close()
+
+    def connect(self, cls, protocol, **kwargs):
+        bootloader = Bootloader(protocol, **kwargs)
+        bootloader.start()
+        self.bootloaders.append(bootloader)
+        port = Serial(bootloader.path, 115200)
+        self.ports.append(port)
+        programmer = cls(port)
+        programmer.connect()
+        return programmer, bootloader
+
+    def check_programming(self, cls, protocol):
+        programmer, bootloader = self.connect(cls, protocol, deaf=2)
+        assert_equal(programmer.read_signature(), Bootloader.signature)
+        programmer.enter()
+
+        pages = OrderedDict([(0, 'a' * 128), (0x100, 'b' * 128), (0x180, '\xff' * 128)])
+        assert_equal(programmer.program(pages), [0, 0x100])
+        assert_equal(str(bootloader.flash[:0x200]),
+                     'a' * 128 + '\xff' * 128 + 'b' * 128 + '\xff' * 128)
+
+        # only the page that differs is written again
+        pages[0] = 'c' * 128
+        assert_equal(programmer.program(pages), [0])
+        assert_equal(str(bootloader.flash[:128]), 'c' * 128)
+
+        # pages known to differ are written without reading them first
+        pages = OrderedDict([(0x180, 'd' * 128)])
+        assert_equal(programmer.program(pages, compare=False), [0x180])
+        assert_equal(str(bootloader.flash[0x180:0x200]), 'd' * 128)
+        programmer.leave()
+
+    def test_stk500v1(self):
+        self.check_programming(Stk500v1, 'stk500v1')
+
+    def test_stk500v2(self):
+        self.check_programming(Stk500v2, 'stk500v2')
+
+    def test_avr109(self):
+        self.check_programming(Avr109, 'avr109')
+
+    def test_update(self):
+        programmer, bootloader = self.connect(Stk500v1, 'stk500v1')
+        programmer.enter()
+
+        # only the page that changed since the last upload is touched,
+        # the record is trusted for the others
+        last = OrderedDict([(0, 'a' * 128), (0x80, 'b' * 128)])
+        bootloader.flash[:0x100] = 'a' * 128 + 'x' * 128
+        pages = OrderedDict([(0, 'a' * 128), (0x80, 'b' * 128), (0x100, 'c' * 128)])
+        assert_equal(programmer.update(pages, last), [0x100])
+        assert_equal(str(bootloader.flash[:0x180]), 'a' * 128 + 'x' * 128 + 'c' * 128)
+
+    def test_update_fallback(self):
+        programmer, bootloader = self.connect(Stk500v1, 'stk500v1')
+        programmer.enter()
+        bootloader.flash[:0x100] = 'x' * 256
+
+        # the first write fails verification, so the record is not trusted
+        write_page = programmer.write_page
+        failures = ['z' * 128]
+        programmer.write_page = lambda address, data: write_page(
+            address, failures.pop() if failures else data)
+
+        last = OrderedDict([(0, 'a' * 128), (0x80, 'b' * 128)])
+        pages = OrderedDict([(0, 'a' * 128), (0x80, 'c' * 128)])
+        assert_equal(programmer.update(pages, last), [0, 0x80])
+        assert_equal(str(bootloader.flash[:0x100]), 'a' * 128 + 'c' * 128)
+
+    def test_verification(self):
+        programmer, _ = self.connect(Stk500v1, 'stk500v1', corrupt=True)
+        programmer.enter()
+        assert_raises(ProgrammerError, programmer.program, OrderedDict([(0, 'a' * 128)]))
+
+    def test_no_answer(self):
+        bootloader = Bootloader('stk500v1', deaf=1000)
+        bootloader.start()
+        self.bootloaders.append(bootloader)
+        port = Serial(bootloader.path, 115200)
+        self.ports.append(port)
+        programmer = Stk500v1(port)
+        programmer.connect_timeout = 0.2
+        assert_raises(ProgrammerError, programmer.connect)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8; -*-
+
+import os.path
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_false
+
+from ano.state import StateStore
+
+
+class TestStateStore(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def store(self, version=1):
+        return StateStore(os.path.join(self.tmp, 'state'), version)
+
+    def test_concurrent_updates_are_merged(self):
+        first = self.store().namespace('discovery')
+        second = self.store().namespace('discovery')
+        assert_false('cc' in first)
+
+        first['cc'] = '/usr/bin/avr-gcc'
+        second['make'] = '/usr/bin/make'
+        first.save()
+        second.save()
+
+        namespace = self.store().namespace('discovery')
+        assert_equal(namespace['cc'], '/usr/bin/avr-gcc')
+        assert_equal(namespace['make'], '/usr/bin/make')
+        assert_equal(type(namespace['make']), str)
+
+        del namespace['cc']
+        namespace.save()
+        assert_equal(self.store().namespace('discovery').data, {'make': '/usr/bin/make'})
+
+    def test_namespaces_and_versions(self):
+        store = self.store()
+        store.namespace('boards')['uno'] = {'build': {'mcu': 'atmega328p'}}
+        store.namespace('uno/build')['version'] = '1'
+        store.save()
+
+        assert_equal(self.store().namespace('boards')['uno'], {'build': {'mcu': 'atmega328p'}})
+        assert_false('uno' in self.store().namespace('uno/build'))
+        assert_false('uno' in self.store(version=2).namespace('boards'))
+
+        build = self.store().namespace('uno/build')
+        build.clear()
+        build.save()
+        assert_equal(self.store().namespace('uno/build').data, {})
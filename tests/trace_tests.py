@@ -0,0 +1,57 @@
+# -*- coding: utf-8; -*-
+
+import json
+import os.path
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ano.trace import Trace
+
+
+class TestTrace(object):
+    def test_write_and_slowest(self):
+        trace = Trace()
+        start = trace.started
+        trace.add('a.cpp', 'compile', start, start + 1, group='src')
+        trace.add('b.cpp', 'compile', start + 1, start + 4, group='Foo')
+        trace.add('libFoo.a', 'archive', start, start + 9)
+        with trace.span('size', 'phase'):
+            pass
+
+        assert_equal([e['name'] for e in trace.slowest('compile', 5)], ['b.cpp', 'a.cpp'])
+        assert_equal([e['name'] for e in trace.slowest('compile', 1)], ['b.cpp'])
+
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'trace.json')
+            trace.write(path)
+            with open(path) as f:
+                events = json.load(f)['traceEvents']
+        finally:
+            shutil.rmtree(tmp)
+
+        assert_equal(len(events), 4)
+        assert_equal((events[1]['ph'], events[1]['ts'], events[1]['dur']), ('X', 1000000, 3000000))
+        assert_equal(events[1]['args'], {'group': 'Foo'})
+
+    def test_merge(self):
+        trace = Trace()
+        start = trace.started
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'Makefile.trace')
+            with open(path, 'w') as f:
+                f.write('%.9f %.9f compile src src/a b.cpp\n' % (start + 1, start + 3.5))
+                f.write('%.9f %.9f compile - core.c\n' % (start, start + 2))
+                f.write('%d.N %d.N link - firmware.elf\n' % (start + 3, start + 4))
+            trace.merge(path)
+        finally:
+            shutil.rmtree(tmp)
+
+        events = [(e['name'], e['tid'], e['args']['group']) for e in trace.events]
+        # overlapping steps get lanes of their own, others share them
+        assert_equal(events, [('core.c', 1, None), ('src/a b.cpp', 2, 'src'),
+                              ('firmware.elf', 1, None)])
+        assert_equal([e['name'] for e in trace.slowest('compile', 1)], ['src/a b.cpp'])
@@ -0,0 +1,42 @@
+# -*- coding: utf-8; -*-
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ano.filters import glob
+from ano.utils import DirectoryIndex, list_subdirs
+
+
+class TestDirectoryIndex(object):
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        for path in ['a.c', 'b.cpp', 'sub/c.c', 'sub/deeper/d.c', '.hidden/e.c']:
+            path = os.path.join(self.tmp, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        self.index = DirectoryIndex()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_glob(self):
+        paths = sorted(f.filename for f in glob(self.tmp, '*.c', index=self.index))
+        assert_equal(paths, ['.hidden/e.c', 'a.c', 'sub/c.c', 'sub/deeper/d.c'])
+        paths = sorted(f.filename for f in glob(self.tmp, '*.c', recursive=False))
+        assert_equal(paths, ['a.c'])
+
+    def test_list_subdirs(self):
+        subdirs = list_subdirs(self.tmp, recursive=True, exclude=['deeper'], index=self.index)
+        assert_equal(subdirs, [os.path.join(self.tmp, 'sub')])
+        assert_equal(list_subdirs(os.path.join(self.tmp, 'missing')), [])
+
+    def test_invalidate(self):
+        assert_equal(len(glob(self.tmp, '*.c', index=self.index)), 4)
+        open(os.path.join(self.tmp, 'sub', 'new.c'), 'w').close()
+        assert_equal(len(glob(self.tmp, '*.c', index=self.index)), 4)
+        self.index.invalidate(os.path.join(self.tmp, 'sub'))
+        assert_equal(len(glob(self.tmp, '*.c', index=self.index)), 5)